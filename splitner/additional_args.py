@@ -80,6 +80,81 @@ class AdditionalArguments:
     pattern_vocab_path: str = field(default="pattern_vocab.txt", metadata={"help": "pattern vocab file path"})
     pattern_vocab_size: int = field(default=0, metadata={"help": "pattern vocab file path"})
     run_dir: str = field(default="42", metadata={"help": "for tracking multiple random seed runs (default: 42)"})
+    inference_only: bool = field(default=False, metadata=
+    {"help": "do not load train/dev/test corpora (only vocabularies), e.g. when serving a trained model"})
+    predict_chunk_size: int = field(default=1000, metadata=
+    {"help": "sentences per journaled chunk when writing predictions: an interrupted prediction run continues with "
+             "the first unfinished chunk (0: single pass without journal)"})
+    inference_token_budget: int = field(default=0, metadata=
+    {"help": "predict_iter: sort the contexts by sub-token length and batch them up to this many (padded) tokens per "
+             "batch, predictions are restored to input order (0: batches of batch size sentences in input order)"})
+    length_sort_window: int = field(default=1024, metadata=
+    {"help": "inference_token_budget, pack_sequences: sentences read (and sorted by length or packed) at a time"})
+    pack_sequences: bool = field(default=False, metadata=
+    {"help": "pack several contexts into one sequence of up to max seq len sub-tokens with block-diagonal attention, "
+             "in training (batches of packed rows) and predict_iter (windows of length_sort_window sentences)"})
+    window_stride: int = field(default=0, metadata=
+    {"help": "sentence parts longer than max seq len are not truncated but split into overlapping windows starting "
+             "every window_stride sub-tokens, each sub-token is predicted by the window it is most central in. Span "
+             "classification keeps the sentence sub-tokens around the mention instead (0: truncate)"})
+    span_context_words: int = field(default=0, metadata=
+    {"help": "span classification: keep only this many words around the mention (half on either side, moved to the "
+             "other side at a sentence edge) in training and inference (0: whole sentence)"})
+    dedup_inputs: bool = field(default=False, metadata=
+    {"help": "predict_iter: run identical model inputs (repeated sentences, sentence and mention pairs) through the "
+             "model once and share the prediction, the dedup ratio is logged with the predictions"})
+    dedup_cache_size: int = field(default=10000, metadata=
+    {"help": "dedup_inputs: distinct inputs whose predictions are kept for later batches (0: within a batch only)"})
+    prediction_cache_path: str = field(default=None, metadata=
+    {"help": "predict_iter: SQLite file caching the decoded predictions of this model (tags of a sentence, type of a "
+             "mention) across runs, cached inputs are not predicted again (None: no cache)"})
+    prediction_cache_size: int = field(default=1000000, metadata=
+    {"help": "prediction_cache_path: entries kept in the cache file, the least recently used are evicted beyond"})
+    gazetteer_purity: float = field(default=0.0, metadata=
+    {"help": "span classification: mentions whose text has one type in at least this share of its training set "
+             "occurrences get that type without the model (0: every mention is classified by the model)"})
+    gazetteer_min_count: int = field(default=3, metadata=
+    {"help": "gazetteer_purity: training set occurrences needed for a mention text to be resolved"})
+    inference_backend: str = field(default="torch", metadata=
+    {"help": "model used for inference (torch|int8|onnx|torchscript|early_exit|bundle|mmap). int8: dynamically "
+             "quantized model saved by quantize.py, onnx: ONNX Runtime (CPU) over the graph saved by export_onnx.py, "
+             "torchscript: traced model saved by export_torchscript.py, early_exit: model with exit heads trained by "
+             "early_exit.py, bundle: memory-mapped weights of a bundle written by bundle.py (set by "
+             "bundle.load_bundle), mmap: memory-mapped checkpoint weights (converted on first use, or by "
+             "mmap_checkpoint.py)"})
+    bundle_path: str = field(default=None, metadata={"help": "bundle backend: single-file bundle written by bundle.py"})
+    bundle_stage: str = field(default=None, metadata={"help": "bundle backend: model of the bundle (detector|classifier)"})
+    cpu_instances: int = field(default=0, metadata=
+    {"help": "inference processes sharing this host's cores. >0 plans this process' threads (cpu_plan.py): the "
+             "physical cores are split between the instances (0: keep PyTorch's thread settings)"})
+    cpu_instance_index: int = field(default=0, metadata=
+    {"help": "cpu plan: index of this process among the instances, picks its cores with cpu_affinity (can also be "
+             "set by the SPLITNER_CPU_INSTANCE environment variable)"})
+    intra_op_threads: int = field(default=0, metadata={"help": "cpu plan: intra-op threads (0: auto)"})
+    inter_op_threads: int = field(default=0, metadata={"help": "cpu plan: inter-op threads (0: auto)"})
+    cpu_affinity: bool = field(default=False, metadata={"help": "cpu plan: pin the process to its share of cores"})
+    early_exit_threshold: float = field(default=0.9, metadata=
+    {"help": "early_exit backend: exit once the exit head confidence (max softmax prob.) reaches this threshold"})
+    early_exit_mode: str = field(default="sample", metadata=
+    {"help": "early_exit backend: confident samples exit individually or the batch exits once all are (sample|batch)"})
+    distill_teacher: str = field(default=None, metadata=
+    {"help": "trained span detector checkpoint used as teacher. If set, training distills it into the base_model"})
+    distill_alpha: float = field(default=0.5, metadata={"help": "weight of teacher soft labels (1 - alpha: gold labels)"})
+    distill_temperature: float = field(default=2.0, metadata={"help": "softmax temperature for the teacher soft labels"})
+    distill_unlabeled_path: str = field(default=None, metadata=
+    {"help": "unlabeled text (one sentence per line) relative to data root, labeled by the teacher only"})
+    student_num_layers: int = field(default=0, metadata=
+    {"help": "keep only these many (evenly spaced) encoder layers of the student (0: keep all)"})
+    dual_schedule: str = field(default="mixed", metadata=
+    {"help": "shared-encoder model (main_dual.py): train both objectives on every batch or alternate them per "
+             "optimization step (mixed|alternate)"})
+    dual_span_weight: float = field(default=1.0, metadata=
+    {"help": "shared-encoder model: weight of the span classification loss (mixed schedule)"})
+    train_token_budget: int = field(default=0, metadata=
+    {"help": "training batches of up to this many (padded) tokens formed from length buckets, instead of per device "
+             "train batch size samples (0: off)"})
+    train_bucket_size: int = field(default=1024, metadata=
+    {"help": "train_token_budget: samples of similar length per bucket, batches are formed (at random) within buckets"})
 
     def __post_init__(self):
         self.run_root = os.path.join(self.out_root, self.dataset_dir, self.model_name, f"run-{self.run_dir}")
@@ -100,6 +175,8 @@ class AdditionalArguments:
         self.dep_tag_vocab_path = os.path.join(self.abs_dataset_dir, self.dep_tag_vocab_path)
         self.tag_names_path = os.path.join(self.abs_dataset_dir, self.tag_names_path)
         self.pattern_vocab_path = os.path.join(self.abs_dataset_dir, self.pattern_vocab_path)
+        if self.distill_unlabeled_path:
+            self.distill_unlabeled_path = os.path.join(self.abs_dataset_dir, self.distill_unlabeled_path)
 
     def to_dict(self):
         """
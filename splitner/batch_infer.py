@@ -0,0 +1,186 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+from splitner.cpu_plan import apply_plan, plan_threads
+from splitner.dataset import NerDataset
+from splitner.inference import load_executor, write_predictions
+from splitner.pipeline import SplitNerPipeline
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+PLAN_NAME = "plan.json"
+
+# model of the current worker process (loaded once by init_worker, used for all of its shards)
+predictor = None
+
+
+def find_shard_offsets(file_path, num_shards):
+    # byte offsets splitting the file into num_shards ranges of about equal size. Each boundary is moved forward to
+    # the start of a sentence (after a blank line), so no sentence is split. Empty ranges are dropped
+    size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, "rb") as f:
+        for k in range(1, num_shards):
+            target = max(size * k // num_shards, offsets[-1])
+            # line start at or after target
+            f.seek(max(target - 1, 0))
+            if target > 0:
+                f.readline()
+            while True:
+                line = f.readline()
+                if not line or line.strip() == b"":
+                    break
+            offsets.append(f.tell())
+    offsets.append(size)
+    offsets = sorted(set(offsets))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def get_shard_path(shards_dir, index):
+    return os.path.join(shards_dir, "shard-{0:05d}.tsv".format(index))
+
+
+def load_plan(args, shards_dir):
+    # the shard plan is kept with the shard outputs, a rerun with the same (unchanged) input only redoes the shards
+    # without output. A changed input or shard count starts over
+    stat = os.stat(args.input)
+    plan = {"input": os.path.abspath(args.input), "size": stat.st_size, "mtime": stat.st_mtime,
+            "num_shards": args.shards}
+    plan_path = os.path.join(shards_dir, PLAN_NAME)
+    if os.path.isfile(plan_path):
+        with open(plan_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if {k: saved.get(k) for k in plan.keys()} == plan:
+            return saved
+        logger.info("input or shard count changed, discarding the previous shards in: {0}".format(shards_dir))
+        shutil.rmtree(shards_dir)
+    os.makedirs(shards_dir, exist_ok=True)
+    plan["shards"] = find_shard_offsets(args.input, args.shards)
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump(plan, f)
+    return plan
+
+
+def load_predictor(args):
+    # a single model (executor over the config) or the SplitNER pipeline
+    if args.config:
+        return load_executor(args.config, args.executor, dedup_inputs=args.dedup,
+                             prediction_cache_path=args.prediction_cache)
+    return SplitNerPipeline.from_args(args)
+
+
+def get_additional_args(model):
+    return model.detector.additional_args if isinstance(model, SplitNerPipeline) else model.additional_args
+
+
+def init_worker(args):
+    global predictor
+    apply_plan(plan_threads(args.workers, intra_op_threads=args.threads_per_worker))
+    predictor = load_predictor(args)
+
+
+def run_shard(args, start, end, output_path):
+    start_time = time.time()
+    with open(args.input, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").splitlines()
+    sentences = NerDataset.read_sentences(lines, get_additional_args(predictor))
+    # written under a temporary name, the shard output only exists once it is complete
+    tmp_path = output_path + ".tmp"
+    write_predictions(tmp_path, sentences, predictor.predict_iter(sentences, args.batch_size))
+    os.replace(tmp_path, output_path)
+    return len(sentences), time.time() - start_time
+
+
+def run_shards(args, plan, shards_dir, pending):
+    # one round over the pending shards. Returns the shards which failed (including those lost with a crashed worker)
+    failed = []
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=init_worker,
+                             initargs=(args,)) as pool:
+        futures = {pool.submit(run_shard, args, *plan["shards"][index], get_shard_path(shards_dir, index)): index
+                   for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                num_sentences, elapsed = future.result()
+                logger.info("shard {0}/{1} done: {2} sentences in {3:.1f}s"
+                            .format(index + 1, len(plan["shards"]), num_sentences, elapsed))
+            except Exception as e:
+                logger.error("shard {0}/{1} failed: {2!r}".format(index + 1, len(plan["shards"]), e))
+                failed.append(index)
+    return sorted(failed)
+
+
+def merge_shards(plan, shards_dir, output_path):
+    # shards are consecutive byte ranges of the input, so their outputs in shard order follow the input order
+    with open(output_path, "wb") as out:
+        for index in range(len(plan["shards"])):
+            with open(get_shard_path(shards_dir, index), "rb") as f:
+                shutil.copyfileobj(f, out)
+
+
+def main(args):
+    setup_logging()
+    shards_dir = args.shards_dir or args.output + ".shards"
+    plan = load_plan(args, shards_dir)
+    pending = [index for index in range(len(plan["shards"])) if not os.path.isfile(get_shard_path(shards_dir, index))]
+    logger.info("input: {0} | shards: {1} | done: {2} | workers: {3}"
+                .format(args.input, len(plan["shards"]), len(plan["shards"]) - len(pending), args.workers))
+
+    start = time.time()
+    for attempt in range(args.retries + 1):
+        if len(pending) == 0:
+            break
+        if attempt > 0:
+            logger.info("retrying {0} failed shards (attempt {1}/{2})".format(len(pending), attempt, args.retries))
+        pending = run_shards(args, plan, shards_dir, pending)
+    if len(pending) > 0:
+        # finished shards are kept: running the same command again only redoes these
+        raise RuntimeError("shards failed after {0} retries: {1}. Rerun to retry them"
+                           .format(args.retries, [index + 1 for index in pending]))
+
+    merge_shards(plan, shards_dir, args.output)
+    if not args.keep_shards:
+        shutil.rmtree(shards_dir)
+    elapsed = time.time() - start
+    logger.info("elapsed time: {0} seconds: {1}".format(str(elapsed), str(timedelta(seconds=elapsed))))
+    logger.info("Outputs published in file: {0}".format(args.output))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Sharded Batch Inference")
+    ap.add_argument("--config", type=str, default=None, help="config json file of a single model (instead of the "
+                                                              "pipeline configs)")
+    ap.add_argument("--executor", type=str, default="qa", help="single model executor (qa|seqtag|dual)")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--inference_backend", type=str, default=None,
+                    help="inference backend for both models (torch|int8|mmap), overrides the configs")
+    ap.add_argument("--input", type=str, required=True, help="input file in dataset (TSV) format")
+    ap.add_argument("--output", type=str, required=True, help="output predictions file (token, gold, predicted)")
+    ap.add_argument("--workers", type=int, default=4, help="worker processes, each with its own model")
+    ap.add_argument("--threads_per_worker", type=int, default=0,
+                    help="intra-op (torch) threads of each worker (0: auto, cores split between workers)")
+    ap.add_argument("--shards", type=int, default=16, help="number of shards (units of work and of retry)")
+    ap.add_argument("--shards_dir", type=str, default=None, help="shard outputs (default: <output>.shards)")
+    ap.add_argument("--retries", type=int, default=2, help="retries of failed shards within one run")
+    ap.add_argument("--batch_size", type=int, default=16, help="sentences per model batch")
+    ap.add_argument("--dedup", dest="dedup", action="store_true",
+                    help="predict repeated sentences and sentence and mention pairs once within each worker")
+    ap.add_argument("--prediction_cache", type=str, default=None,
+                    help="SQLite file caching the predictions across runs, shared by the workers")
+    ap.add_argument("--keep_shards", dest="keep_shards", action="store_true",
+                    help="keep the shard outputs after merging")
+    ap = ap.parse_args()
+    main(ap)
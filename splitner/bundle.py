@@ -0,0 +1,270 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from splitner.gazetteer import GAZETTEER_NAME, get_gazetteer_path, save_gazetteer
+from splitner.inference import get_executor_class, load_executor
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# file layout: magic | header length (uint64, little endian) | JSON header | padding | data. The data section holds the
+# raw (C-contiguous) tensor bytes, each aligned so that it can be memory-mapped in place, followed by the stage files
+BUNDLE_MAGIC = b"SPLITNER"
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+STAGES = ["detector", "classifier"]
+VOCAB_FIELDS = ["tag_vocab_path", "tag_names_path", "pos_tag_vocab_path", "dep_tag_vocab_path", "pattern_vocab_path"]
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def get_data_offset(header_len):
+    return align(len(BUNDLE_MAGIC) + 8 + header_len)
+
+
+def read_stage_files(executor):
+    # model config and tokenizer files (as saved by save_pretrained) and the vocabularies used by the dataset
+    files = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        executor.model.config.save_pretrained(tmp_dir)
+        executor.trainer.tokenizer.save_pretrained(tmp_dir)
+        for name in os.listdir(tmp_dir):
+            with open(os.path.join(tmp_dir, name), "rb") as f:
+                files[name] = f.read()
+    for field_name in VOCAB_FIELDS:
+        path = getattr(executor.additional_args, field_name)
+        if path and os.path.isfile(path):
+            with open(path, "rb") as f:
+                files[os.path.join("vocab", field_name + ".txt")] = f.read()
+    # the span classifier's gazetteer (gazetteer_purity), read from the extracted model dir at load
+    gazetteer = getattr(executor, "gazetteer", None)
+    if gazetteer is not None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_gazetteer(gazetteer, tmp_dir)
+            with open(get_gazetteer_path(tmp_dir), "rb") as f:
+                files[GAZETTEER_NAME] = f.read()
+    return files
+
+
+def pack_tensors(state_dict, blobs, offset):
+    # appends the tensors to blobs (data offset, array) at aligned offsets. Returns the tensor index and the end offset
+    tensors = dict()
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().contiguous().numpy()
+        offset = align(offset)
+        tensors[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        blobs.append((offset, array))
+        offset += array.nbytes
+    return tensors, offset
+
+
+def write_container(output_path, header, blobs):
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = get_data_offset(len(header_bytes))
+    with open(output_path, "wb") as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for blob_offset, array in blobs:
+            f.write(b"\0" * (data_offset + blob_offset - f.tell()))
+            f.write(array.tobytes())
+    return os.path.getsize(output_path)
+
+
+def write_bundle(output_path, stages):
+    # stages: stage name -> (executor type, executor loaded with the torch backend)
+    header = {"version": BUNDLE_VERSION, "stages": dict()}
+    blobs = []
+    offset = 0
+    for stage, (executor_type, executor) in stages.items():
+        tensors, offset = pack_tensors(executor.model.state_dict(), blobs, offset)
+        files = dict()
+        for name, content in read_stage_files(executor).items():
+            files[name] = [offset, len(content)]
+            blobs.append((offset, np.frombuffer(content, dtype=np.uint8)))
+            offset += len(content)
+        # frozen inference config: the dataset/model arguments as resolved at build time
+        header["stages"][stage] = {"executor_type": executor_type,
+                                   "additional_args": executor.additional_args.to_dict(),
+                                   "eval_batch_size": executor.train_args.per_device_eval_batch_size,
+                                   "seed": executor.train_args.seed,
+                                   "no_cuda": executor.train_args.no_cuda,
+                                   "tensors": tensors,
+                                   "files": files}
+    return write_container(output_path, header, blobs)
+
+
+def read_header(bundle_path):
+    with open(bundle_path, "rb") as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError("not a SplitNER bundle: {0}".format(bundle_path))
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    if header["version"] != BUNDLE_VERSION:
+        raise ValueError("unsupported bundle version: {0}".format(header["version"]))
+    return header, get_data_offset(header_len)
+
+
+def map_data(bundle_path, data_offset):
+    # copy-on-write mapping: pages are read lazily from the page cache (shared between processes) and the file is
+    # never modified, even if a tensor is written to
+    return np.memmap(bundle_path, dtype=np.uint8, mode="c", offset=data_offset)
+
+
+@contextmanager
+def skip_init(model_class):
+    # all parameters are replaced by the bundle's tensors, so their random initialization is wasted start-up time
+    # the pretrained base class (eg. BertPreTrainedModel) also initializes the nested encoder (eg. BertModel)
+    pretrained_class = next(cls for cls in model_class.__mro__ if "_init_weights" in cls.__dict__)
+    owners = [nn.Linear, nn.Embedding, nn.LayerNorm, nn.modules.conv._ConvNd, nn.RNNBase, pretrained_class]
+    names = ["reset_parameters"] * (len(owners) - 1) + ["_init_weights"]
+    saved = [owner.__dict__.get(name) for owner, name in zip(owners, names)]
+    for owner, name in zip(owners, names):
+        setattr(owner, name, lambda *args: None)
+    try:
+        yield
+    finally:
+        for owner, name, method in zip(owners, names, saved):
+            if method is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, method)
+
+
+def assign_tensor(model, name, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attr] = tensor
+
+
+def load_mapped_model(model_class, config, additional_args, tensors, data):
+    # model with its weights backed by the memory-mapped data section (tensors: index written by pack_tensors)
+    with skip_init(model_class):
+        model = model_class(config, additional_args=additional_args)
+
+    missing = set(model.state_dict().keys()) - set(tensors.keys())
+    if missing:
+        raise ValueError("bundle has no weights for: {0}".format(sorted(missing)))
+    for name, meta in tensors.items():
+        dtype = np.dtype(meta["dtype"])
+        num_bytes = int(np.prod(meta["shape"], dtype=np.int64)) * dtype.itemsize
+        array = data[meta["offset"]:meta["offset"] + num_bytes].view(dtype).reshape(meta["shape"])
+        # zero-copy: the tensor is backed by the mapped file
+        assign_tensor(model, name, torch.from_numpy(array))
+    return model.eval()
+
+
+def load_bundle_model(model_class, config, additional_args):
+    header, data_offset = read_header(additional_args.bundle_path)
+    tensors = header["stages"][additional_args.bundle_stage]["tensors"]
+    data = map_data(additional_args.bundle_path, data_offset)
+    return load_mapped_model(model_class, config, additional_args, tensors, data)
+
+
+def extract_stage_files(data, files, stage_dir):
+    for name, (offset, length) in files.items():
+        path = os.path.join(stage_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data[offset:offset + length].tobytes())
+
+
+def load_bundle(bundle_path, extract_dir=None):
+    from transformers.trainer import TrainingArguments
+    from splitner.additional_args import AdditionalArguments
+    from splitner.pipeline import SplitNerPipeline
+
+    header, data_offset = read_header(bundle_path)
+    data = map_data(bundle_path, data_offset)
+    if extract_dir is None:
+        # tokenizer and vocabularies are read from files, they live as long as the process
+        extract_dir = tempfile.mkdtemp(prefix="splitner-bundle-")
+        atexit.register(shutil.rmtree, extract_dir, ignore_errors=True)
+
+    executors = dict()
+    for stage in STAGES:
+        meta = header["stages"][stage]
+        stage_dir = os.path.join(extract_dir, stage)
+        extract_stage_files(data, meta["files"], stage_dir)
+        args = dict(meta["additional_args"],
+                    resume=None,
+                    base_model=stage_dir,
+                    out_root=stage_dir,
+                    infer_inp_path=None,
+                    distill_teacher=None,
+                    distill_unlabeled_path=None,
+                    inference_only=True,
+                    inference_backend="bundle",
+                    bundle_path=os.path.abspath(bundle_path),
+                    bundle_stage=stage)
+        for field_name in VOCAB_FIELDS:
+            if os.path.join("vocab", field_name + ".txt") in meta["files"]:
+                args[field_name] = os.path.join(stage_dir, "vocab", field_name + ".txt")
+        train_args = TrainingArguments(output_dir=stage_dir,
+                                       per_device_eval_batch_size=meta["eval_batch_size"],
+                                       seed=meta["seed"],
+                                       no_cuda=meta["no_cuda"])
+        executors[stage] = get_executor_class(meta["executor_type"])(train_args, AdditionalArguments(**args))
+    return SplitNerPipeline(executors["detector"], executors["classifier"])
+
+
+def main(args):
+    setup_logging()
+    from splitner.dataset import NerDataset
+    from splitner.pipeline import SplitNerPipeline
+
+    # only the plain PyTorch weights are bundled (exported backends keep their own artifacts)
+    stages = {"detector": (args.detector_type, load_executor(args.detector_config, args.detector_type,
+                                                             inference_backend="torch")),
+              "classifier": ("span", load_executor(args.classifier_config, "span", inference_backend="torch"))}
+    size = write_bundle(args.output, stages)
+    logger.info("bundle saved in: {0} ({1:.1f}MB)".format(args.output, size / (1024 * 1024)))
+
+    if args.benchmark:
+        # both loaders run after all modules are imported, the difference is the work done at start-up
+        start = time.time()
+        pipeline = SplitNerPipeline.from_configs(args.detector_config, args.classifier_config, args.detector_type,
+                                                 inference_backend="torch")
+        configs_time = time.time() - start
+        start = time.time()
+        bundled = load_bundle(args.output)
+        bundle_time = time.time() - start
+        logger.info("load time | configs: {0:.2f}s | bundle: {1:.2f}s".format(configs_time, bundle_time))
+
+        if args.input:
+            sentences = NerDataset.read_dataset(args.input, pipeline.classifier.additional_args)
+            mismatches = sum(int(a != b) for a, b in zip(pipeline.predict_iter(sentences),
+                                                         bundled.predict_iter(sentences)))
+            logger.info("sentences with different predictions: {0}/{1}".format(mismatches, len(sentences)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Deployment Bundle")
+    ap.add_argument("--detector_config", type=str, required=True, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, required=True, help="span classifier config json file")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag)")
+    ap.add_argument("--output", type=str, required=True, help="output bundle file")
+    ap.add_argument("--benchmark", dest="benchmark", action="store_true",
+                    help="set this flag to compare the load time of the bundle with loading from the configs")
+    ap.add_argument("--input", type=str, default=None,
+                    help="benchmark: input file in dataset (TSV) format to compare the predictions on")
+    ap = ap.parse_args()
+    main(ap)
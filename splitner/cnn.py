@@ -53,15 +53,14 @@ class CharCNN(nn.Module):
         x = self.emb(char_ids)
         # x = self.dropout(x)
         batch_size, seq_len, word_len, emb_dim = x.shape
-        x = x.permute(0, 1, 3, 2)
-        out = torch.zeros(batch_size, seq_len, self.hidden_dim, device=x.device, dtype=x.dtype)
-        for k in range(seq_len):
-            x_proj = x[:, k, :, :]
-            cnn_outputs = []
-            for i in range(len(self.cnn_layer_config)):
-                conv = getattr(self, "char_conv_{}".format(i))
-                v, _ = torch.max(conv(x_proj), dim=2)
-                cnn_outputs.append(v)
-            out[:, k, :] = F.relu(torch.cat(cnn_outputs, dim=1))
+        # all words of the batch go through the convolutions at once (no loop over seq_len, keeps the sequence axis
+        # dynamic when traced for ONNX/TorchScript export)
+        x_proj = x.reshape(batch_size * seq_len, word_len, emb_dim).permute(0, 2, 1)
+        cnn_outputs = []
+        for i in range(len(self.cnn_layer_config)):
+            conv = getattr(self, "char_conv_{}".format(i))
+            v, _ = torch.max(conv(x_proj), dim=2)
+            cnn_outputs.append(v)
+        out = F.relu(torch.cat(cnn_outputs, dim=1)).reshape(batch_size, seq_len, self.hidden_dim)
         out = self.lin(out)
         return out
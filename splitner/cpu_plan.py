@@ -0,0 +1,150 @@
+import argparse
+import itertools
+import logging
+import os
+import time
+
+import torch
+
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# (pid, plan) last applied: thread settings are process-wide, models loaded later in the same process (the second
+# pipeline stage, the models of a registry) keep the plan instead of applying it again
+applied_plan = None
+
+
+def get_core_groups():
+    # logical CPUs available to this process, grouped by physical core (SMT siblings share a group)
+    cpus = sorted(os.sched_getaffinity(0))
+    groups = dict()
+    for cpu in cpus:
+        siblings_path = "/sys/devices/system/cpu/cpu{0}/topology/thread_siblings_list".format(cpu)
+        try:
+            with open(siblings_path) as f:
+                key = f.read().strip()
+        except OSError:
+            key = str(cpu)
+        groups.setdefault(key, []).append(cpu)
+    return sorted(groups.values())
+
+
+def plan_threads(num_instances=1, instance_index=0, intra_op_threads=0, inter_op_threads=0, affinity=False):
+    # thread plan of one of num_instances inference processes sharing the host. 0 threads: auto, i.e. the physical
+    # cores split evenly between the instances (SMT siblings add little to the GEMM bound BERT inference) and one
+    # inter-op thread (eager inference runs one op at a time). With affinity, each instance is pinned to its own cores
+    core_groups = get_core_groups()
+    cores_per_instance = max(len(core_groups) // num_instances, 1)
+    intra_op_threads = intra_op_threads or cores_per_instance
+    inter_op_threads = inter_op_threads or 1
+    cpus = None
+    if affinity:
+        # instances beyond the core count wrap around (oversubscribed, but still spread evenly)
+        start = instance_index * cores_per_instance % len(core_groups)
+        groups = [core_groups[(start + k) % len(core_groups)] for k in range(cores_per_instance)]
+        cpus = [group[0] for group in groups]
+        # more threads than physical cores: use the SMT siblings as well
+        if intra_op_threads > len(cpus):
+            cpus = [cpu for group in groups for cpu in group]
+    return {"instance": instance_index,
+            "instances": num_instances,
+            "physical_cores": len(core_groups),
+            "intra_op_threads": intra_op_threads,
+            "inter_op_threads": inter_op_threads,
+            "cpus": cpus}
+
+
+def apply_plan(plan):
+    global applied_plan
+    torch.set_num_threads(plan["intra_op_threads"])
+    try:
+        torch.set_num_interop_threads(plan["inter_op_threads"])
+    except RuntimeError:
+        # only possible before the first inter-op parallel work of the process (or its parent, when forked)
+        logger.warning("inter-op threads already initialized, keeping {0}".format(torch.get_num_interop_threads()))
+    if plan["cpus"] is not None:
+        os.sched_setaffinity(0, plan["cpus"])
+    logger.info("cpu plan: instance {0}/{1} | physical cores: {2} | intra-op threads: {3} | inter-op threads: {4} | "
+                "cpus: {5}".format(plan["instance"] + 1, plan["instances"], plan["physical_cores"],
+                                   torch.get_num_threads(), torch.get_num_interop_threads(),
+                                   plan["cpus"] if plan["cpus"] is not None else "any"))
+    applied_plan = (os.getpid(), plan)
+    return plan
+
+
+def configure_cpu(additional_args):
+    # process-wide thread settings from the config, applied when the first model is loaded. cpu_instances 0 keeps
+    # PyTorch's defaults. The instance index (for the affinity) can also come from the environment, eg. per container
+    if additional_args.cpu_instances <= 0:
+        return None
+    instance_index = int(os.getenv("SPLITNER_CPU_INSTANCE", additional_args.cpu_instance_index))
+    plan = plan_threads(additional_args.cpu_instances, instance_index, additional_args.intra_op_threads,
+                        additional_args.inter_op_threads, additional_args.cpu_affinity)
+    # once per process (a forked worker applies its own plan)
+    if applied_plan is not None and applied_plan[0] == os.getpid():
+        if plan != applied_plan[1]:
+            logger.warning("cpu plan already applied in this process, keeping it: {0}".format(applied_plan[1]))
+        return applied_plan[1]
+    return apply_plan(plan)
+
+
+def parse_int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(args):
+    setup_logging()
+    from splitner.dataset import NerDataset
+    from splitner.pipeline import SplitNerPipeline
+    from splitner.worker_pool import WorkerPool
+
+    num_cores = len(get_core_groups())
+    # (instances, threads per instance): 0 threads is the auto plan. Configurations using more threads than physical
+    # cores are skipped unless requested explicitly
+    configs = [(instances, threads) for instances, threads in itertools.product(parse_int_list(args.instances),
+                                                                                parse_int_list(args.threads))
+               if threads == 0 or instances * threads <= num_cores or args.oversubscribe]
+    logger.info("physical cores: {0} | configurations: {1}".format(num_cores, configs))
+
+    sentences = None
+    results = []
+    for instances, threads in configs:
+        pool = WorkerPool(lambda: SplitNerPipeline.from_args(args), instances, threads, affinity=args.affinity)
+        if sentences is None:
+            sentences = NerDataset.read_dataset(args.input, pool.pipeline.detector.additional_args)
+        # warm-up batch per worker (first forward passes allocate and initialize the thread pools)
+        list(pool.predict_iter(sentences[:instances * args.batch_size], args.batch_size))
+        start = time.time()
+        for _ in pool.predict_iter(sentences, args.batch_size):
+            pass
+        elapsed = time.time() - start
+        pool.close()
+        del pool
+        results.append((len(sentences) / elapsed, instances, threads))
+        logger.info("instances: {0} | threads per instance: {1} | affinity: {2} | {3:.2f} sentences/s"
+                    .format(instances, threads or "auto", args.affinity, results[-1][0]))
+
+    throughput, instances, threads = max(results)
+    logger.info("best: instances: {0} | threads per instance: {1} | {2:.2f} sentences/s"
+                .format(instances, threads or "auto", throughput))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="CPU Thread Plan Benchmark")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--inference_backend", type=str, default=None,
+                    help="inference backend for both models (torch|int8|mmap), overrides the configs")
+    ap.add_argument("--input", type=str, required=True, help="input file in dataset (TSV) format")
+    ap.add_argument("--instances", type=str, default="1,2,4", help="comma separated instance (worker) counts to sweep")
+    ap.add_argument("--threads", type=str, default="0,1,2,4",
+                    help="comma separated intra-op threads per instance to sweep (0: auto plan)")
+    ap.add_argument("--affinity", dest="affinity", action="store_true", help="pin each instance to its own cores")
+    ap.add_argument("--oversubscribe", dest="oversubscribe", action="store_true",
+                    help="also run configurations with more threads in total than physical cores")
+    ap.add_argument("--batch_size", type=int, default=16, help="sentences per batch sent to an instance")
+    ap = ap.parse_args()
+    main(ap)
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import logging
 import re
 from collections import defaultdict
@@ -146,30 +147,46 @@ class NerDataset(Dataset):
         for index in range(len(self.sentences)):
             self.process_sentence(index)
 
+    def make_chunk(self, sentences):
+        # view over the given sentences sharing tokenizer/vocabs with this dataset (used for batched inference)
+        chunk = copy.copy(self)
+        chunk.sentences = sentences
+        chunk.parse_dataset()
+        return chunk
+
     @staticmethod
     def read_dataset(file_path, args: AdditionalArguments):
-        sentences = []
+        if file_path is None:
+            # corpus-less dataset (e.g. for inference), only carries the tokenizer and vocabularies
+            return []
         with open(file_path, "r", encoding="utf-8") as f:
-            tokens = []
-            offset = 0
-            for line in f:
-                line = line.strip()
-                if line:
-                    row = line.split("\t")
-                    for rt in NerDataset.get_row_tokens(row, args):
-                        tokens.append(Token(text=rt.text, pos_tag=rt.pos_tag, dep_tag=rt.dep_tag, tags=rt.tags,
-                                            offset=offset))
-                        offset += 1
-                else:
-                    sentences.append(Sentence(tokens))
-                    tokens = []
-                    offset = 0
-        if len(tokens) > 0:
-            sentences.append(Sentence(tokens))
+            sentences = NerDataset.read_sentences(f, args)
         if args.debug_mode:
             sentences = sentences[:10]
         return sentences
 
+    @staticmethod
+    def read_sentences(lines, args: AdditionalArguments):
+        # sentences from the lines of a dataset (TSV) file, separated by blank lines
+        sentences = []
+        tokens = []
+        offset = 0
+        for line in lines:
+            line = line.strip()
+            if line:
+                row = line.split("\t")
+                for rt in NerDataset.get_row_tokens(row, args):
+                    tokens.append(Token(text=rt.text, pos_tag=rt.pos_tag, dep_tag=rt.dep_tag, tags=rt.tags,
+                                        offset=offset))
+                    offset += 1
+            else:
+                sentences.append(Sentence(tokens))
+                tokens = []
+                offset = 0
+        if len(tokens) > 0:
+            sentences.append(Sentence(tokens))
+        return sentences
+
     @staticmethod
     def get_row_tokens(row, args: AdditionalArguments):
         text = row[0]
@@ -364,6 +381,10 @@ class NerDataset(Dataset):
                 "dep_tag": bert_token_dep,
                 "labels": bert_tag_ids}
 
+    def get_num_prefix_tokens(self, index):
+        # sub-tokens before the sentence part ([CLS]), repeated in every window of a long sentence
+        return 1
+
     def get_tag_index(self, text_tag):
         if text_tag not in self.tag_vocab:
             text_tag = self.args.none_tag
@@ -466,7 +487,9 @@ class NerDataset(Dataset):
                     tmp = bert_token.token.tags[0]
                     bert_token.token.tags[0] = tmp[:2] + "ENTITY"
 
-        sentence.bert_tokens = sentence.bert_tokens[:self.args.max_seq_len - 1]
+        # long sentences are kept whole with window_stride, and split into windows at prediction (see windows.py)
+        if self.args.window_stride <= 0:
+            sentence.bert_tokens = sentence.bert_tokens[:self.args.max_seq_len - 1]
         sentence.bert_tokens.append(self.bert_first_sep_token)
 
     @staticmethod
@@ -0,0 +1,57 @@
+import torch
+
+from splitner.additional_args import AdditionalArguments
+from splitner.dataset import NerDataCollator
+from splitner.dataset_qa import NerQADataset
+from splitner.dataset_span import NerSpanDataset
+
+
+class NerDualDataset(NerQADataset):
+    # span detection contexts (detect_spans) which additionally carry the sub-token positions of the gold mentions in
+    # the sentence part, so that a single encoder pass serves both heads of NerDualModel
+
+    def __init__(self, args: AdditionalArguments, corpus_type):
+        # mention types (TAG from B-TAG/I-TAG) predicted by the span classification head
+        self.span_tag_vocab = NerSpanDataset.parse_tag_vocab(args.tag_vocab_path)
+        super(NerDualDataset, self).__init__(args, corpus_type)
+
+    def __getitem__(self, index):
+        item = super(NerDualDataset, self).__getitem__(index)
+        context = self.contexts[index]
+        mention_spans = NerSpanDataset.get_mention_spans(context.sentence)
+        item["span_start"], item["span_end"], item["span_labels"] = [], [], []
+        for mention_span, (start, end) in zip(mention_spans, self.get_span_positions(context, mention_spans)):
+            if start < 0:
+                continue
+            # TODO: Needs to be handled if working with nested entities
+            tag = context.sentence.tokens[mention_span.start].tags[0][2:]
+            item["span_start"].append(start)
+            item["span_end"].append(end)
+            item["span_labels"].append(self.span_tag_vocab.index(tag) if tag in self.span_tag_vocab else -100)
+        return item
+
+    @staticmethod
+    def get_span_positions(context, mention_spans):
+        # first sub-token of the first word and last sub-token of the last word of each (word-level) mention.
+        # (-1, -1) for mentions cut off by max_seq_len
+        first, last = dict(), dict()
+        for index, bert_token in enumerate(context.bert_tokens):
+            if bert_token.token_type != 1 or bert_token.token.offset < 0:
+                continue
+            first.setdefault(bert_token.token.offset, index)
+            last[bert_token.token.offset] = index
+        return [(first[sp.start], last[sp.end]) if sp.start in first and sp.end in last else (-1, -1)
+                for sp in mention_spans]
+
+
+class NerDualDataCollator(NerDataCollator):
+
+    def __call__(self, features):
+        batch = super(NerDualDataCollator, self).__call__(features)
+        # mentions of all contexts are flattened, span_index points to the context (batch row) a mention belongs to
+        if "span_start" in features[0]:
+            batch["span_index"] = torch.tensor([i for i, f in enumerate(features) for _ in f["span_start"]],
+                                               dtype=torch.int64)
+            for key in ["span_start", "span_end", "span_labels"]:
+                batch[key] = torch.tensor([value for f in features for value in f[key]], dtype=torch.int64)
+        return batch
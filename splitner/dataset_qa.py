@@ -1,4 +1,5 @@
 import argparse
+import copy
 import re
 
 from torch.utils.data import Dataset
@@ -102,6 +103,14 @@ class NerQADataset(Dataset):
         for sentence in self.sentences:
             self.process_sentence(sentence)
 
+    def make_chunk(self, sentences):
+        # view over the given sentences sharing tokenizer/vocabs with this dataset (used for batched inference)
+        chunk = copy.copy(self)
+        chunk.sentences = sentences
+        chunk.contexts = []
+        chunk.parse_dataset()
+        return chunk
+
     def __len__(self):
         return len(self.contexts)
 
@@ -134,6 +143,10 @@ class NerQADataset(Dataset):
                 "dep_tag": bert_token_dep,
                 "labels": bert_tag_ids}
 
+    def get_num_prefix_tokens(self, index):
+        # sub-tokens before the sentence part ([CLS], query, [SEP]), repeated in every window of a long sentence
+        return self.contexts[index].num_prefix_tokens
+
     @staticmethod
     def get_tag_index(text_tag, none_tag):
         if text_tag == none_tag:
@@ -301,10 +314,12 @@ class NerQADataset(Dataset):
         bert_tokens.append(self.bert_first_sep_token)
         if self.args.model_mode == "roberta_std":
             bert_tokens.append(self.bert_first_sep_token)  # check
+        num_prefix_tokens = len(bert_tokens)
         bert_tokens.extend(bert_sent_tokens)
-        bert_tokens = bert_tokens[:self.args.max_seq_len - 1]
+        if self.args.window_stride <= 0:
+            bert_tokens = bert_tokens[:self.args.max_seq_len - 1]
         bert_tokens.append(self.bert_second_sep_token)
-        return Context(sentence, tag, tag_text, bert_tokens)
+        return Context(sentence, tag, tag_text, bert_tokens, num_prefix_tokens=num_prefix_tokens)
 
     def prep_context_span(self, sentence):
         tag_text = self.get_tag_query_text(None)
@@ -393,10 +408,12 @@ class NerQADataset(Dataset):
         bert_tokens = [self.bert_start_token]
         bert_tokens.extend(bert_query_tokens)
         bert_tokens.append(self.bert_first_sep_token)
+        num_prefix_tokens = len(bert_tokens)
         bert_tokens.extend(bert_sent_tokens)
-        bert_tokens = bert_tokens[:self.args.max_seq_len - 1]
+        if self.args.window_stride <= 0:
+            bert_tokens = bert_tokens[:self.args.max_seq_len - 1]
         bert_tokens.append(self.bert_second_sep_token)
-        return Context(sentence, "ENTITY", tag_text, bert_tokens)
+        return Context(sentence, "ENTITY", tag_text, bert_tokens, num_prefix_tokens=num_prefix_tokens)
 
     def process_sentence(self, sentence):
         if self.args.detect_spans:
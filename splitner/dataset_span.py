@@ -1,4 +1,5 @@
 import argparse
+import copy
 import logging
 
 import torch
@@ -29,6 +30,8 @@ class NerSpanDataset(Dataset):
             NerDataset.get_bert_special_tokens(self.tokenizer, self.args.none_tag)
         self.tokenizer_cache = dict()
         self.sentences = []
+        # mention spans of each sentence (gold spans here, detector outputs in NerInferSpanDataset)
+        self.sentence_spans = []
         self.parse_dataset()
 
     @staticmethod
@@ -56,6 +59,17 @@ class NerSpanDataset(Dataset):
         for sentence in self.sentences:
             self.process_sentence(sentence)
 
+    def make_chunk(self, sentences, sentence_spans):
+        # view over the given sentences/mentions sharing tokenizer/vocabs with this dataset (used for batched inference)
+        chunk = copy.copy(self)
+        chunk.sentences = sentences
+        chunk.sentence_spans = sentence_spans
+        chunk.contexts = []
+        for sentence, spans in zip(sentences, sentence_spans):
+            for mention_span in spans:
+                chunk.contexts.append(chunk.prep_context(sentence, mention_span))
+        return chunk
+
     def __len__(self):
         return len(self.contexts)
 
@@ -86,11 +100,39 @@ class NerSpanDataset(Dataset):
             return "Classify {0} .".format(mention)
         raise NotImplementedError
 
+    @staticmethod
+    def get_context_words(num_words, mention_span: PairSpan, context_words):
+        # first and last word of the mention with context_words words around it, half on either side. The share of a
+        # side beyond the sentence edge goes to the other side
+        left = context_words // 2
+        right = context_words - left
+        left_room = mention_span.start
+        right_room = num_words - 1 - mention_span.end
+        if left > left_room:
+            right += left - left_room
+            left = left_room
+        if right > right_room:
+            left = min(left + right - right_room, left_room)
+            right = right_room
+        return mention_span.start - left, mention_span.end + right
+
     def prep_context(self, sentence: Sentence, mention_span: PairSpan):
-        # sentence
+        # sentence, or only the words around the mention with span_context_words
+        first_word, last_word = 0, len(sentence.tokens) - 1
+        if self.args.span_context_words > 0:
+            first_word, last_word = NerSpanDataset.get_context_words(len(sentence.tokens), mention_span,
+                                                                     self.args.span_context_words)
         bert_sent_tokens = []
+        # first and last sub-token of the mention
+        mention_first, mention_last = 0, 0
         for index, tok in enumerate(sentence.tokens):
+            if index < first_word or index > last_word:
+                continue
             out = self.tokenize_with_cache(tok.text)
+            if index == mention_span.start:
+                mention_first = len(bert_sent_tokens)
+            if index == mention_span.end:
+                mention_last = len(bert_sent_tokens) + len(out["input_ids"]) - 1
             for i in range(len(out["input_ids"])):
                 if index < mention_span.start or index > mention_span.end:
                     bert_tag = self.args.none_tag
@@ -119,6 +161,16 @@ class NerSpanDataset(Dataset):
                 bert_query_tokens.append(BertToken(bert_id=out["input_ids"][i], sub_text=sub_text, token_type=1,
                                                    token=bert_token, is_head=(i == 0)))
 
+        if self.args.window_stride > 0:
+            # a long sentence part is cut to the sub-tokens around the mention (instead of its tail), so that it fits
+            # next to the query with [CLS] and [SEP]s
+            num_special_tokens = 3 if self.args.model_mode == "roberta_std" else 2
+            window_len = self.args.max_seq_len - len(bert_query_tokens) - num_special_tokens - 1
+            if len(bert_sent_tokens) > window_len:
+                centre = (mention_first + mention_last) // 2
+                start = min(max(centre - window_len // 2, 0), len(bert_sent_tokens) - window_len)
+                bert_sent_tokens = bert_sent_tokens[start:start + window_len]
+
         bert_tokens = [self.bert_start_token]
         bert_tokens.extend(bert_sent_tokens)
         bert_tokens.append(self.bert_first_sep_token)
@@ -129,11 +181,16 @@ class NerSpanDataset(Dataset):
         bert_tokens.append(self.bert_second_sep_token)
         return Context(sentence, None, None, bert_tokens, mention_span)
 
-    def process_sentence(self, sentence):
+    @staticmethod
+    def get_mention_spans(sentence):
         spans = NerDataset.get_spans(sentence)
-        for tag in spans.keys():
-            for mention_span in spans[tag]:
-                self.contexts.append(self.prep_context(sentence, mention_span))
+        return [mention_span for tag in spans.keys() for mention_span in spans[tag]]
+
+    def process_sentence(self, sentence):
+        spans = NerSpanDataset.get_mention_spans(sentence)
+        self.sentence_spans.append(spans)
+        for mention_span in spans:
+            self.contexts.append(self.prep_context(sentence, mention_span))
 
 
 class NerInferSpanDataset(NerSpanDataset):
@@ -149,6 +206,7 @@ class NerInferSpanDataset(NerSpanDataset):
             self.sentences = self.sentences[:10]
             spans = spans[:10]
 
+        self.sentence_spans = spans
         for i in range(len(self.sentences)):
             for sp in spans[i]:
                 self.contexts.append(self.prep_context(self.sentences[i], sp))
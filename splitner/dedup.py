@@ -0,0 +1,113 @@
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from splitner.dataset import NerDataset
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_feature_key(feature):
+    # content hash of a model input (dataset feature). Labels are left out, gold tags don't change the prediction
+    content = json.dumps({key: value for key, value in feature.items() if key != "labels"}, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class Deduplicator:
+    # runs each distinct model input once. Duplicates within a call get the prediction of their first copy, and the
+    # predictions of the last cache_size distinct inputs are reused by later calls (duplicates across the corpus)
+    def __init__(self, cache_size=0):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.inputs = 0
+        self.model_inputs = 0
+
+    def predict(self, features, predict_fn):
+        # predict_fn gets the distinct features not in the cache and returns their predictions
+        keys = [get_feature_key(feature) for feature in features]
+        predictions = dict()
+        pending = dict()
+        for key, feature in zip(keys, features):
+            if key in predictions or key in pending:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                predictions[key] = self.cache[key]
+            else:
+                pending[key] = feature
+        if len(pending) > 0:
+            for key, prediction in zip(pending.keys(), predict_fn(list(pending.values()))):
+                # copied: a row of a batch prediction would keep the whole batch alive in the cache
+                predictions[key] = np.array(prediction)
+                if self.cache_size > 0:
+                    self.cache[key] = predictions[key]
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        self.inputs += len(features)
+        self.model_inputs += len(pending)
+        return [predictions[key] for key in keys]
+
+    def dedup_ratio(self):
+        # share of the inputs which did not go through the model
+        return 1.0 - self.model_inputs / max(self.inputs, 1)
+
+    def __str__(self):
+        return "inputs: {0} | model inputs: {1} | dedup ratio: {2:.3f}".format(self.inputs, self.model_inputs,
+                                                                             self.dedup_ratio())
+
+
+def make_stream(sentences, duplicate_share, seed=42):
+    # the sentences with copies of randomly chosen ones added, such that duplicate_share of the stream are copies
+    rng = random.Random(seed)
+    num_copies = int(len(sentences) * duplicate_share / (1.0 - duplicate_share))
+    stream = list(sentences) + [copy.deepcopy(rng.choice(sentences)) for _ in range(num_copies)]
+    rng.shuffle(stream)
+    return stream
+
+
+def main(args):
+    from splitner.pipeline import SplitNerPipeline
+
+    setup_logging()
+    pipeline = SplitNerPipeline.from_args(args)
+    sentences = NerDataset.read_dataset(args.input, pipeline.detector.additional_args)
+    stream = make_stream(sentences, args.duplicate_share)
+    logger.info("sentences: {0} | stream with duplicates: {1}".format(len(sentences), len(stream)))
+
+    results = dict()
+    for dedup_inputs in [False, True]:
+        pipeline.set_dedup(dedup_inputs)
+        for executor in pipeline.get_executors():
+            executor.deduplicator = Deduplicator(executor.additional_args.dedup_cache_size)
+        start = time.time()
+        results[dedup_inputs] = (list(pipeline.predict_iter(stream, args.batch_size)), time.time() - start)
+        logger.info("dedup: {0} | time: {1:.2f}s ({2:.1f} sentences/s)"
+                    .format(dedup_inputs, results[dedup_inputs][1], len(stream) / results[dedup_inputs][1]))
+        if dedup_inputs:
+            for executor in pipeline.get_executors():
+                logger.info("{0} | {1}".format(type(executor).__name__, executor.deduplicator))
+
+    mismatches = sum(int(a != b) for a, b in zip(results[False][0], results[True][0]))
+    logger.info("speedup: {0:.2f}x | sentences with different predictions: {1}/{2}"
+                .format(results[False][1] / results[True][1], mismatches, len(stream)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Input Deduplication Benchmark")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--input", type=str, required=True, help="input file in dataset (TSV) format")
+    ap.add_argument("--duplicate_share", type=float, default=0.3, help="share of repeated sentences in the stream")
+    ap.add_argument("--batch_size", type=int, default=None, help="sentences per batch (default: eval batch size)")
+    ap = ap.parse_args()
+    main(ap)
@@ -0,0 +1,93 @@
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from splitner.trainer import NerTrainer
+
+logger = logging.getLogger(__name__)
+
+
+class UnlabeledDataset(Dataset):
+    # contexts without gold tags: only the teacher's soft labels are used for them (hard labels are ignored)
+    def __init__(self, dataset):
+        super(UnlabeledDataset, self).__init__()
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        item["labels"] = [nn.CrossEntropyLoss().ignore_index] * len(item["labels"])
+        return item
+
+
+class DistillationTrainer(NerTrainer):
+    # trains the student on alpha * KL(teacher || student) (temperature scaled, all tokens) + (1 - alpha) * CE on the
+    # gold labels (labeled tokens only). Teacher and student share the tokenizer and the input features
+    def __init__(self, teacher, alpha, temperature, **kwargs):
+        super(DistillationTrainer, self).__init__(**kwargs)
+        self.alpha = alpha
+        self.temperature = temperature
+        self.teacher = teacher.to(self.args.device).eval()
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        inputs = dict(inputs)
+        labels = inputs.pop("labels")
+        # models output argmax predictions, return_logits adds the logits as the last output. The student's are
+        # gathered from all replicas under DataParallel (n_gpu > 1), the teacher runs unwrapped on the whole batch
+        outputs = model(**inputs, return_logits=True)
+        with torch.no_grad():
+            teacher_logits = self.teacher(**inputs, return_logits=True)[-1]
+        student_logits = outputs[-1]
+        outputs = outputs[:-1]
+
+        # logits are aligned with the (head-mask compressed) attention mask
+        head_mask = inputs.get("head_mask")
+        active = self.model.compress_with_head_mask(head_mask, inputs["attention_mask"], 0).view(-1) == 1
+        labels = self.model.compress_with_head_mask(head_mask, labels, -100).view(-1)[active]
+        num_labels = student_logits.shape[-1]
+        student_logits = student_logits.view(-1, num_labels)[active]
+        teacher_logits = teacher_logits.view(-1, num_labels)[active]
+
+        t = self.temperature
+        soft_loss = F.kl_div(F.log_softmax(student_logits / t, dim=-1), F.softmax(teacher_logits / t, dim=-1),
+                             reduction="batchmean") * t * t
+        labeled = labels != -100
+        if labeled.any():
+            hard_loss = F.cross_entropy(student_logits[labeled], labels[labeled])
+        else:
+            hard_loss = soft_loss.new_zeros(())
+        loss = self.alpha * soft_loss + (1.0 - self.alpha) * hard_loss
+        return (loss, (loss,) + tuple(outputs)) if return_outputs else loss
+
+
+def keep_encoder_layers(model, num_layers):
+    # student initialization: keeps num_layers evenly spaced layers (incl. first and last) of the encoder
+    layers = model.base_model.encoder.layer
+    if num_layers <= 0 or num_layers >= len(layers):
+        return model
+    layer_ids = np.linspace(0, len(layers) - 1, num_layers).round().astype(int).tolist()
+    logger.info("student encoder layers: {0} (of {1})".format(layer_ids, len(layers)))
+    return select_encoder_layers(model, layer_ids)
+
+
+def select_encoder_layers(model, layer_ids):
+    # physically removes the other encoder layers (saved checkpoints load with the smaller num_hidden_layers)
+    layers = model.base_model.encoder.layer
+    model.base_model.encoder.layer = nn.ModuleList([layers[i] for i in layer_ids])
+    model.config.num_hidden_layers = len(layer_ids)
+    # already pruned heads are recorded per layer index
+    model.config.pruned_heads = {k: model.config.pruned_heads[i] for k, i in enumerate(layer_ids)
+                                 if i in model.config.pruned_heads}
+    return model
+
+
+def read_unlabeled_sentences(file_path):
+    # one (whitespace tokenized) sentence per line
+    with open(file_path, "r", encoding="utf-8") as f:
+        return [line.split() for line in f if line.strip()]
@@ -0,0 +1,195 @@
+import argparse
+import logging
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from splitner.inference import evaluate_dataset, get_artifact_dir, load_executor
+from splitner.model_span import NerSpanModel
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+EXIT_HEADS_NAME = "exit_heads.bin"
+
+
+class ExitHeads(nn.Module):
+    # one linear classifier after each BERT layer except the last one (which goes through the model's own head)
+    def __init__(self, hidden_size, num_labels, num_layers):
+        super(ExitHeads, self).__init__()
+        self.heads = nn.ModuleList([nn.Linear(hidden_size, num_labels) for _ in range(num_layers - 1)])
+
+
+def encode_layers(bert, input_ids, attention_mask, token_type_ids):
+    # runs the BERT encoder layer by layer, yields the hidden states after each layer and the extended attention mask
+    hidden_states = bert.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+    extended_mask = bert.get_extended_attention_mask(attention_mask, input_ids.shape, input_ids.device)
+    for layer in bert.encoder.layer:
+        hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+        yield hidden_states, extended_mask
+
+
+class EarlyExitModel(nn.Module):
+    # NerModel / NerSpanModel with exit heads: after each layer the exit head predicts, and the samples whose confidence
+    # (max softmax probability, least confident token for token-level models) reaches the threshold stop there. In
+    # "sample" mode confident samples leave the batch, in "batch" mode the whole batch exits once all are confident
+    def __init__(self, model, exit_heads, threshold, mode="sample"):
+        super(EarlyExitModel, self).__init__()
+        self.model = model
+        self.exit_heads = exit_heads
+        self.threshold = threshold
+        self.mode = mode
+        self.config = model.config
+        self.token_level = not isinstance(model, NerSpanModel)
+        self.num_samples = 0
+        self.num_layers_executed = 0
+
+    def average_layers(self):
+        return self.num_layers_executed / max(self.num_samples, 1)
+
+    def reset_stats(self):
+        self.num_samples = 0
+        self.num_layers_executed = 0
+
+    def exit_logits(self, index, hidden_states, inputs):
+        if self.token_level:
+            # aligned with the model's predictions (head-mask compressed)
+            hidden_states = self.model.compress_with_head_mask(inputs.get("head_mask"), hidden_states, 0.0)
+            return self.exit_heads.heads[index](hidden_states)
+        return self.exit_heads.heads[index](self.model.bert.pooler(hidden_states))
+
+    def confidence(self, logits, inputs):
+        confidence = F.softmax(logits, dim=-1).max(dim=-1)[0]
+        if self.token_level:
+            mask = self.model.compress_with_head_mask(inputs.get("head_mask"), inputs["attention_mask"], 0)
+            confidence = confidence.masked_fill(mask == 0, 1.0).min(dim=1)[0]
+        return confidence
+
+    def forward(self, labels=None, **inputs):
+        input_ids = inputs["input_ids"]
+        num_layers = len(self.model.bert.encoder.layer)
+        shape = input_ids.shape if self.token_level else input_ids.shape[:1]
+        predictions = torch.zeros(shape, dtype=torch.long, device=input_ids.device)
+        # positions (in the input batch) of the samples which are still running
+        active = torch.arange(input_ids.shape[0], device=input_ids.device)
+        self.num_samples += input_ids.shape[0]
+
+        hidden_states = None
+        layers = encode_layers(self.model.bert, input_ids, inputs["attention_mask"], inputs.get("token_type_ids"))
+        for i in range(num_layers):
+            hidden_states, extended_mask = next(layers)
+            if i == num_layers - 1:
+                break
+            logits = self.exit_logits(i, hidden_states, inputs)
+            done = self.confidence(logits, inputs) >= self.threshold
+            if self.mode == "batch" and not done.all():
+                continue
+            if done.any():
+                predictions[active[done]] = torch.argmax(logits[done], dim=-1)
+                self.num_layers_executed += (i + 1) * int(done.sum())
+                keep = ~done
+                if not keep.any():
+                    return (predictions,)
+                active = active[keep]
+                inputs = {k: v[keep] for k, v in inputs.items()}
+                # the remaining layers are run on the not yet confident samples only
+                layers = self.continue_layers(hidden_states[keep], extended_mask[keep], i + 1)
+
+        pooled_output = self.model.bert.pooler(hidden_states) if self.model.bert.pooler is not None else None
+        predictions[active] = self.model(**inputs, encoder_outputs=(hidden_states, pooled_output))[0]
+        self.num_layers_executed += num_layers * len(active)
+        return (predictions,)
+
+    def continue_layers(self, hidden_states, extended_mask, start):
+        for layer in self.model.bert.encoder.layer[start:]:
+            hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+            yield hidden_states, extended_mask
+
+
+def get_exit_heads_path(additional_args):
+    return os.path.join(get_artifact_dir(additional_args), "early_exit", EXIT_HEADS_NAME)
+
+
+def load_early_exit_model(model_class, model_path, config, additional_args):
+    model = model_class.from_pretrained(model_path, config=config, additional_args=additional_args)
+    exit_heads = ExitHeads(config.hidden_size, config.num_labels, config.num_hidden_layers)
+    exit_heads.load_state_dict(torch.load(get_exit_heads_path(additional_args), map_location="cpu"))
+    return EarlyExitModel(model, exit_heads, additional_args.early_exit_threshold, additional_args.early_exit_mode)
+
+
+def train_exit_heads(executor, num_epochs, learning_rate):
+    # the trained model stays frozen, each exit head learns the gold labels from the hidden states of its layer
+    model = executor.model.eval()
+    device = executor.train_args.device
+    config = model.config
+    exit_heads = ExitHeads(config.hidden_size, config.num_labels, config.num_hidden_layers).to(device)
+    early_exit = EarlyExitModel(model, exit_heads, threshold=1.0)
+    optimizer = torch.optim.Adam(exit_heads.parameters(), lr=learning_rate)
+    loader = DataLoader(executor.train_dataset, batch_size=executor.train_args.per_device_train_batch_size,
+                        shuffle=True, collate_fn=executor.trainer.data_collator)
+    for epoch in range(num_epochs):
+        total_loss = 0.0
+        for batch in loader:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            labels = batch.pop("labels")
+            if early_exit.token_level:
+                labels = model.compress_with_head_mask(batch.get("head_mask"), labels, -100)
+            with torch.no_grad():
+                all_hidden_states = [hidden_states for hidden_states, _ in encode_layers(
+                    model.bert, batch["input_ids"], batch["attention_mask"], batch.get("token_type_ids"))]
+            loss = 0.0
+            for i in range(len(exit_heads.heads)):
+                logits = early_exit.exit_logits(i, all_hidden_states[i], batch)
+                loss = loss + F.cross_entropy(logits.view(-1, config.num_labels), labels.view(-1))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+        logger.info("exit heads | epoch: {0} | loss: {1:.4f}".format(epoch, total_loss / max(len(loader), 1)))
+    return exit_heads
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    model = executor.model
+    for param in model.parameters():
+        param.requires_grad = False
+
+    exit_heads = train_exit_heads(executor, args.num_epochs, args.learning_rate)
+    output_path = get_exit_heads_path(executor.additional_args)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    torch.save(exit_heads.state_dict(), output_path)
+    logger.info("exit heads saved in: {0}".format(output_path))
+
+    # accuracy/latency trade-off on dev
+    dataset = executor.dev_dataset
+    full_f1, full_time = evaluate_dataset(executor, dataset)
+    curve = [("full", full_f1, full_time, float(model.config.num_hidden_layers))]
+    for threshold in [float(t) for t in args.thresholds.split(",")]:
+        executor.model = EarlyExitModel(model, exit_heads.eval(), threshold, args.mode)
+        f1, elapsed = evaluate_dataset(executor, dataset)
+        curve.append((str(threshold), f1, elapsed, executor.model.average_layers()))
+    executor.model = model
+
+    logger.info("early exit ({0} mode) on dev:".format(args.mode))
+    for threshold, f1, elapsed, avg_layers in curve:
+        logger.info("threshold: {0:>5} | F1: {1:.4f} | time: {2:.2f}s | avg layers: {3:.2f}"
+                    .format(threshold, 100.0 * f1, elapsed, avg_layers))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Early Exit Heads Training and Evaluation")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--num_epochs", type=int, default=3, help="exit heads training epochs")
+    ap.add_argument("--learning_rate", type=float, default=1e-3, help="exit heads learning rate")
+    ap.add_argument("--mode", type=str, default="sample", help="exit decision per sample or per batch (sample|batch)")
+    ap.add_argument("--thresholds", type=str, default="0.5,0.7,0.8,0.9,0.95,0.99",
+                    help="comma separated confidence thresholds evaluated on dev")
+    ap = ap.parse_args()
+    main(ap)
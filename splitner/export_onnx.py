@@ -0,0 +1,115 @@
+import argparse
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+from splitner.inference import TraceWrapper, check_parity, evaluate_dataset, get_artifact_dir, iter_eval_batches, \
+    load_executor
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_NAME = "model.onnx"
+ONNX_OPSET = 14
+
+
+class OnnxModel(nn.Module):
+    # runs the exported graph with ONNX Runtime (CPU) behind the same forward interface as the PyTorch models
+    def __init__(self, model_path, config):
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+
+        self.config = config
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        # inputs unused by the model config (eg. head_mask) are pruned from the graph during export
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+
+    def forward(self, labels=None, **kwargs):
+        feed = {name: kwargs[name].cpu().numpy() for name in self.input_names}
+        predictions = self.session.run(["predictions"], feed)[0]
+        return (torch.from_numpy(predictions),)
+
+
+def get_onnx_path(additional_args):
+    return os.path.join(get_artifact_dir(additional_args), "onnx", ONNX_MODEL_NAME)
+
+
+def load_onnx_model(config, additional_args):
+    model_path = get_onnx_path(additional_args)
+    logger.info("loading ONNX model from: {0}".format(model_path))
+    return OnnxModel(model_path, config)
+
+
+def get_dynamic_axes(name, tensor):
+    # batch and sequence (and word length, for char/pattern ids) dimensions vary from batch to batch
+    axes = {0: "batch"}
+    if tensor.dim() > 1:
+        axes[1] = "sequence"
+    if tensor.dim() > 2:
+        axes[2] = "{0}_word_len".format(name)
+    return axes
+
+
+def export_onnx(model, example_batch, output_path):
+    input_names = list(example_batch.keys())
+    wrapper = TraceWrapper(model, input_names).eval()
+    with torch.no_grad():
+        example_outputs = wrapper(*example_batch.values())
+
+    dynamic_axes = {name: get_dynamic_axes(name, tensor) for name, tensor in example_batch.items()}
+    dynamic_axes["predictions"] = get_dynamic_axes("predictions", example_outputs[0])
+    dynamic_axes["logits"] = get_dynamic_axes("logits", example_outputs[1])
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    torch.onnx.export(wrapper,
+                      tuple(example_batch.values()),
+                      output_path,
+                      input_names=input_names,
+                      output_names=["predictions", "logits"],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=ONNX_OPSET,
+                      do_constant_folding=True)
+    wrapper.hook.remove()
+
+
+def main(args):
+    setup_logging()
+    # ONNX Runtime backend runs on CPU, the reference PyTorch model is run on CPU as well
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    dataset = executor.test_dataset
+    model = executor.model.to("cpu").eval()
+
+    output_path = get_onnx_path(executor.additional_args)
+    export_onnx(model, next(iter_eval_batches(executor, dataset)), output_path)
+    logger.info("ONNX model saved in: {0}".format(output_path))
+
+    onnx_model = load_onnx_model(model.config, executor.additional_args)
+    max_diff, mismatches, total = check_parity(executor, model, lambda batch: onnx_model.session.run(
+        ["predictions", "logits"], {name: batch[name].cpu().numpy() for name in onnx_model.input_names}), dataset)
+    logger.info("parity | max abs logit diff: {0:.2e} | prediction mismatches: {1}/{2}"
+                .format(max_diff, mismatches, total))
+
+    # predict_iter runs batches on the executor's device
+    executor.model = model.to(executor.train_args.device)
+    torch_f1, torch_time = evaluate_dataset(executor, dataset)
+    executor.model = onnx_model
+    onnx_f1, onnx_time = evaluate_dataset(executor, dataset)
+    logger.info("torch ({0}) | F1: {1:.4f} | time: {2:.2f}s".format(executor.train_args.device, 100.0 * torch_f1,
+                                                                   torch_time))
+    logger.info("onnx  | F1: {0:.4f} | time: {1:.2f}s".format(100.0 * onnx_f1, onnx_time))
+
+    if max_diff > args.atol or mismatches > 0:
+        raise ValueError("ONNX parity check failed (max abs logit diff: {0:.2e}, prediction mismatches: {1})"
+                         .format(max_diff, mismatches))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="ONNX Export")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--atol", type=float, default=1e-4, help="max abs logit difference allowed by the parity check")
+    ap = ap.parse_args()
+    main(ap)
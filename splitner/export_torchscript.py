@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from splitner.inference import TraceWrapper, check_parity, get_artifact_dir, iter_eval_batches, load_executor, \
+    predict_batch
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+TORCHSCRIPT_MODEL_NAME = "model.pt"
+WARMUP_INPUTS_NAME = "warmup_inputs.pt"
+# the profiling executor optimizes the graph for the shapes seen on the first calls
+WARMUP_RUNS = 3
+
+
+class TorchScriptModel(nn.Module):
+    # traced model (branches on additional_args are resolved at trace time, so only the ones enabled in the training
+    # config remain in the graph) behind the same forward interface as the PyTorch models
+    def __init__(self, module, input_names, config, device="cpu"):
+        super(TorchScriptModel, self).__init__()
+        self.module = module
+        self.input_names = input_names
+        self.config = config
+        # device the model was traced on (the trace is specialised to it)
+        self.device = torch.device(device)
+
+    def forward(self, labels=None, **kwargs):
+        return self.module(*[kwargs[name] for name in self.input_names])[:1]
+
+    def warm_up(self, inputs):
+        # full example batch and a single sentence, so both batched and single requests hit an optimized graph
+        inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+        with torch.no_grad():
+            for i in range(WARMUP_RUNS):
+                self(**inputs)
+                self(**{name: tensor[:1] for name, tensor in inputs.items()})
+
+
+def get_torchscript_dir(additional_args):
+    return os.path.join(get_artifact_dir(additional_args), "torchscript")
+
+
+def load_torchscript_model(config, additional_args, warm_up=True):
+    model_dir = get_torchscript_dir(additional_args)
+    logger.info("loading TorchScript model from: {0}".format(model_dir))
+    extra_files = {"input_names.json": "", "device.json": ""}
+    module = torch.jit.load(os.path.join(model_dir, TORCHSCRIPT_MODEL_NAME), _extra_files=extra_files)
+    # models traced before the device was recorded: cpu
+    device = json.loads(extra_files["device.json"]) if extra_files["device.json"] else "cpu"
+    model = TorchScriptModel(module, json.loads(extra_files["input_names.json"]), config, device)
+    if warm_up:
+        start = time.time()
+        # saved on the export device, loaded on the CPU first (serving hosts may have no GPU)
+        model.warm_up(torch.load(os.path.join(model_dir, WARMUP_INPUTS_NAME), map_location="cpu"))
+        logger.info("warm-up time: {0:.2f}s".format(time.time() - start))
+    return model
+
+
+def trace_model(model, example_batch, output_dir):
+    # the trace is specialised to the device it is made on as well, export on the device used for inference
+    input_names = list(example_batch.keys())
+    wrapper = TraceWrapper(model, input_names).eval()
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(wrapper, tuple(example_batch.values())).eval())
+    wrapper.hook.remove()
+
+    os.makedirs(output_dir, exist_ok=True)
+    device = str(next(iter(example_batch.values())).device)
+    torch.jit.save(module, os.path.join(output_dir, TORCHSCRIPT_MODEL_NAME),
+                   _extra_files={"input_names.json": json.dumps(input_names), "device.json": json.dumps(device)})
+    torch.save(example_batch, os.path.join(output_dir, WARMUP_INPUTS_NAME))
+
+
+def time_first_call(model, batch):
+    start = time.time()
+    with torch.no_grad():
+        model(**batch)
+    return time.time() - start
+
+
+def time_per_sentence(executor, model, dataset, num_sentences):
+    # small-batch latency: one sentence per forward pass
+    if hasattr(dataset, "sentence_spans"):
+        chunk = dataset.make_chunk(dataset.sentences[:num_sentences], dataset.sentence_spans[:num_sentences])
+    else:
+        chunk = dataset.make_chunk(dataset.sentences[:num_sentences])
+    model.eval()
+    start = time.time()
+    for i in range(len(chunk)):
+        predict_batch(model, [chunk[i]], executor.trainer.data_collator, executor.train_args.device)
+    return 1000.0 * (time.time() - start) / max(len(chunk), 1)
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    dataset = executor.test_dataset
+    model = executor.model.eval()
+
+    example_batch = {k: v.to(executor.train_args.device) for k, v in next(iter_eval_batches(executor, dataset)).items()}
+    output_dir = get_torchscript_dir(executor.additional_args)
+    trace_model(model, example_batch, output_dir)
+    logger.info("TorchScript model saved in: {0}".format(output_dir))
+
+    traced = torch.jit.load(os.path.join(output_dir, TORCHSCRIPT_MODEL_NAME))
+    max_diff, mismatches, total = check_parity(
+        executor, model, lambda batch: tuple(output.cpu().numpy() for output in traced(*batch.values())), dataset)
+    logger.info("parity | max abs logit diff: {0:.2e} | prediction mismatches: {1}/{2}"
+                .format(max_diff, mismatches, total))
+
+    cold = load_torchscript_model(model.config, executor.additional_args, warm_up=False)
+    warm = load_torchscript_model(model.config, executor.additional_args)
+    logger.info("first call | without warm-up: {0:.1f}ms | with warm-up: {1:.1f}ms"
+                .format(1000.0 * time_first_call(cold, example_batch), 1000.0 * time_first_call(warm, example_batch)))
+    logger.info("latency per sentence (batch size 1) | eager: {0:.1f}ms | torchscript: {1:.1f}ms"
+                .format(time_per_sentence(executor, model, dataset, args.num_sentences),
+                        time_per_sentence(executor, warm, dataset, args.num_sentences)))
+
+    if max_diff > args.atol or mismatches > 0:
+        raise ValueError("TorchScript parity check failed (max abs logit diff: {0:.2e}, prediction mismatches: {1})"
+                         .format(max_diff, mismatches))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="TorchScript Export")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--atol", type=float, default=1e-4, help="max abs logit difference allowed by the parity check")
+    ap.add_argument("--num_sentences", type=int, default=100, help="test sentences used for the latency comparison")
+    ap = ap.parse_args()
+    main(ap)
@@ -0,0 +1,172 @@
+import argparse
+import glob
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+from splitner.dataset import NerDataset
+from splitner.utils.general import parse_config, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# mention text -> type table, saved in the model dir of the span classifier (and in deployment bundles)
+GAZETTEER_NAME = "gazetteer.json"
+
+
+def get_mention_text(sentence, span):
+    return " ".join(tok.text for tok in sentence.tokens[span.start:span.end + 1])
+
+
+class Gazetteer:
+    # mention text -> type table of the unambiguous mentions of a training set: those seen at least min_count times,
+    # with one type in at least a purity share of them. Mentions it resolves skip the span classifier
+    def __init__(self, table, purity, min_count):
+        self.table = table
+        self.purity = purity
+        self.min_count = min_count
+        self.mentions = 0
+        self.resolved = 0
+
+    @staticmethod
+    def from_sentences(sentences, purity, min_count):
+        type_counts = defaultdict(Counter)
+        for sentence in sentences:
+            for tag, spans in NerDataset.get_spans(sentence).items():
+                for span in spans:
+                    type_counts[get_mention_text(sentence, span)][tag] += 1
+        table = dict()
+        for text, counts in type_counts.items():
+            tag, count = counts.most_common(1)[0]
+            total = sum(counts.values())
+            if total >= min_count and count / total >= purity:
+                table[text] = tag
+        logger.info("gazetteer: {0} of {1} distinct training mentions (purity >= {2}, count >= {3})"
+                    .format(len(table), len(type_counts), purity, min_count))
+        return Gazetteer(table, purity, min_count)
+
+    def lookup(self, sentence, span):
+        # type of the mention, None if it is left to the model
+        span_type = self.table.get(get_mention_text(sentence, span))
+        self.mentions += 1
+        self.resolved += int(span_type is not None)
+        return span_type
+
+    def skip_rate(self):
+        # share of the mentions which did not go through the model
+        return self.resolved / max(self.mentions, 1)
+
+    def __str__(self):
+        return "mentions: {0} | resolved: {1} | skip rate: {2:.3f}".format(self.mentions, self.resolved,
+                                                                          self.skip_rate())
+
+
+def get_gazetteer_path(model_path):
+    return os.path.join(model_path, GAZETTEER_NAME)
+
+
+def save_gazetteer(gazetteer, model_path):
+    output_path = get_gazetteer_path(model_path)
+    # written next to the final file and renamed, so that concurrent loaders never read a partial file
+    tmp_path = "{0}.tmp-{1}".format(output_path, os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"purity": gazetteer.purity, "min_count": gazetteer.min_count, "table": gazetteer.table}, f)
+    os.replace(tmp_path, output_path)
+
+
+def read_gazetteer(path):
+    with open(path, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    return Gazetteer(saved["table"], saved["purity"], saved["min_count"])
+
+
+def build_gazetteer(additional_args, model_path):
+    # table from the training set with the config's settings, saved in the model dir
+    if not os.path.isdir(model_path):
+        raise ValueError("gazetteer needs a local model dir, got: {0}".format(model_path))
+    if not os.path.isfile(additional_args.train_path):
+        raise ValueError("no {0} with the gazetteer settings in {1}, and no training set to build it from: {2}"
+                         .format(GAZETTEER_NAME, model_path, additional_args.train_path))
+    gazetteer = Gazetteer.from_sentences(NerDataset.read_dataset(additional_args.train_path, additional_args),
+                                         additional_args.gazetteer_purity, additional_args.gazetteer_min_count)
+    save_gazetteer(gazetteer, model_path)
+    logger.info("gazetteer saved in: {0}".format(get_gazetteer_path(model_path)))
+    return gazetteer
+
+
+def save_checkpoint_gazetteers(additional_args, sentences, output_dir):
+    # after training: the gazetteer (gazetteer_purity) of the run's training set, saved in each checkpoint of the run
+    if additional_args.gazetteer_purity <= 0:
+        return
+    gazetteer = Gazetteer.from_sentences(sentences, additional_args.gazetteer_purity,
+                                         additional_args.gazetteer_min_count)
+    checkpoint_dirs = sorted(path for path in glob.glob(os.path.join(output_dir, "{0}-*".format(PREFIX_CHECKPOINT_DIR)))
+                             if os.path.isdir(path))
+    for checkpoint_dir in checkpoint_dirs:
+        save_gazetteer(gazetteer, checkpoint_dir)
+    logger.info("gazetteer saved in {0} checkpoints of: {1}".format(len(checkpoint_dirs), output_dir))
+
+
+def load_gazetteer(additional_args, model_path):
+    # gazetteer of the span classifier (gazetteer_purity) saved in its model dir, None without one. It is built from
+    # the training set when missing or saved with other settings, so serving only needs the model dir (or bundle)
+    if additional_args.gazetteer_purity <= 0:
+        return None
+    if not os.path.isdir(model_path):
+        logger.warning("gazetteer needs a local model dir, classifying every mention with the model: {0}"
+                       .format(model_path))
+        return None
+    path = get_gazetteer_path(model_path)
+    if os.path.isfile(path):
+        gazetteer = read_gazetteer(path)
+        if gazetteer.purity == additional_args.gazetteer_purity and \
+                gazetteer.min_count == additional_args.gazetteer_min_count:
+            logger.info("gazetteer: {0} mention texts from: {1}".format(len(gazetteer.table), path))
+            return gazetteer
+        logger.warning("gazetteer settings changed, rebuilding: {0}".format(path))
+    return build_gazetteer(additional_args, model_path)
+
+
+def main(args):
+    from transformers import HfArgumentParser
+    from transformers.trainer import TrainingArguments
+    from splitner.additional_args import AdditionalArguments
+    from splitner.inference import evaluate_dataset, load_executor
+
+    setup_logging()
+    if args.save:
+        # table with the config's settings, saved next to the model for inference (and bundle.py)
+        _, additional_args = parse_config(HfArgumentParser([TrainingArguments, AdditionalArguments]), args.config)
+        build_gazetteer(additional_args, additional_args.resume or additional_args.base_model)
+        return
+
+    executor = load_executor(args.config, "span", inference_only=False)
+    dataset = executor.test_dataset
+    train_sentences = executor.train_dataset.sentences
+
+    # the model alone first, then each gazetteer setting in front of it
+    settings = [(0.0, 0)] + [(float(purity), int(min_count)) for purity in args.purity.split(",")
+                             for min_count in args.min_count.split(",")]
+    base_f1 = None
+    for purity, min_count in settings:
+        executor.gazetteer = Gazetteer.from_sentences(train_sentences, purity, min_count) if purity > 0 else None
+        f1, elapsed = evaluate_dataset(executor, dataset)
+        base_f1 = f1 if base_f1 is None else base_f1
+        logger.info("purity: {0} | min count: {1} | skip rate: {2:.3f} | micro F1: {3:.4f} ({4:+.4f}) | time: {5:.2f}s"
+                    .format(purity or "-", min_count or "-",
+                            executor.gazetteer.skip_rate() if executor.gazetteer else 0.0, f1, f1 - base_f1, elapsed))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Span Classification Gazetteer Sweep")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained span classifier")
+    ap.add_argument("--purity", type=str, default="0.9,0.95,1.0",
+                    help="comma separated gazetteer_purity values (share of the most frequent type of a mention)")
+    ap.add_argument("--min_count", type=str, default="1,2,3",
+                    help="comma separated gazetteer_min_count values (training occurrences of a mention)")
+    ap.add_argument("--save", dest="save", action="store_true",
+                    help="set this flag to build the gazetteer with the config's settings and save it in the model dir")
+    ap = ap.parse_args()
+    main(ap)
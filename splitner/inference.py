@@ -0,0 +1,417 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from splitner.utils.general import Sentence, Token, PairSpan
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(model_class, model_path, config, additional_args):
+    from splitner.cpu_plan import configure_cpu
+    configure_cpu(additional_args)
+    if additional_args.inference_backend == "int8":
+        from splitner.quantize import load_quantized_model
+        return load_quantized_model(model_class, config, additional_args)
+    if additional_args.inference_backend == "onnx":
+        from splitner.export_onnx import load_onnx_model
+        return load_onnx_model(config, additional_args)
+    if additional_args.inference_backend == "torchscript":
+        from splitner.export_torchscript import load_torchscript_model
+        return load_torchscript_model(config, additional_args)
+    if additional_args.inference_backend == "early_exit":
+        from splitner.early_exit import load_early_exit_model
+        return load_early_exit_model(model_class, model_path, config, additional_args)
+    if additional_args.inference_backend == "bundle":
+        from splitner.bundle import load_bundle_model
+        return load_bundle_model(model_class, config, additional_args)
+    if additional_args.inference_backend == "mmap":
+        from splitner.mmap_checkpoint import load_mmap_model
+        return load_mmap_model(model_class, model_path, config, additional_args)
+    return model_class.from_pretrained(model_path, config=config, additional_args=additional_args)
+
+
+def get_artifact_dir(additional_args):
+    # exported inference artifacts are kept next to the checkpoint they come from (run dir for pretrained models)
+    return additional_args.resume if additional_args.resume else additional_args.run_root
+
+
+# overrides: additional arguments to replace after parsing the config (eg. base_model of an exported model)
+def load_executor(config_path, executor_type, inference_only=True, inference_backend=None, **overrides):
+    from transformers import HfArgumentParser
+    from transformers.trainer import TrainingArguments
+    from splitner.additional_args import AdditionalArguments
+    from splitner.utils.general import parse_config
+
+    parser = HfArgumentParser([TrainingArguments, AdditionalArguments])
+    train_args, additional_args = parse_config(parser, config_path)
+    train_args.do_train = False
+    additional_args.inference_only = inference_only
+    if inference_backend:
+        additional_args.inference_backend = inference_backend
+    for key, value in overrides.items():
+        setattr(additional_args, key, value)
+    return get_executor_class(executor_type)(train_args, additional_args)
+
+
+def get_executor_class(executor_type):
+    if executor_type == "qa":
+        from splitner.main_qa import NerQAExecutor
+        return NerQAExecutor
+    if executor_type == "seqtag":
+        from splitner.main import NerExecutor
+        return NerExecutor
+    if executor_type == "span":
+        from splitner.main_span import NerSpanExecutor
+        return NerSpanExecutor
+    if executor_type == "dual":
+        from splitner.main_dual import NerDualExecutor
+        return NerDualExecutor
+    raise NotImplementedError
+
+
+def predict_dataset(executor, dataset):
+    # span classification datasets come with the mention spans to classify for each sentence
+    if hasattr(dataset, "sentence_spans"):
+        return executor.predict_iter(zip(dataset.sentences, dataset.sentence_spans))
+    return executor.predict_iter(dataset.sentences)
+
+
+def evaluate_dataset(executor, dataset):
+    # mention-level micro F1 (see analysis.py) of the executor's predictions on a dataset and the prediction time
+    from splitner.analysis import calc_micro_f1, convert_to_span_based
+
+    start = time.time()
+    data = [[(tok.text, tok.tags[0], tag) for tok, tag in zip(sentence.tokens, tags)]
+            for sentence, tags in zip(dataset.sentences, predict_dataset(executor, dataset))]
+    elapsed = time.time() - start
+    if executor.additional_args.detect_spans:
+        data = convert_to_span_based(data)
+    return calc_micro_f1(data)[3], elapsed
+
+
+def make_sentence(tokens, none_tag):
+    # accepts already parsed sentences (with gold tags) as well as plain lists of token texts
+    if isinstance(tokens, Sentence):
+        return tokens
+    return Sentence([Token(text=text, tags=[none_tag], offset=index) for index, text in enumerate(tokens)])
+
+
+def make_span(span):
+    if isinstance(span, PairSpan):
+        return span
+    return PairSpan(span[0], span[1])
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def predict_batch(model, dataset, data_collator, device):
+    if len(dataset) == 0:
+        return []
+    return predict_features(model, [dataset[i] for i in range(len(dataset))], data_collator, device)
+
+
+def predict_features(model, features, data_collator, device):
+    batch = data_collator(features)
+    # labels are only needed for the loss, predictions are decoded from the model outputs directly
+    batch.pop("labels", None)
+    batch = {k: v.to(device) for k, v in batch.items()}
+    with torch.no_grad():
+        model_predictions = model(**batch)[0]
+    return model_predictions.cpu().numpy()
+
+
+def make_length_batches(lengths, token_budget):
+    # indices sorted by length (longest first) and cut into batches whose padded size (batch size x longest length)
+    # stays within token_budget. A context longer than the budget forms a batch of its own
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        # the first index of a batch is its longest
+        if len(batch) > 0 and (len(batch) + 1) * lengths[batch[0]] > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def predict_length_sorted(model, dataset, data_collator, device, token_budget):
+    # predict_batch over length-sorted batches under a token budget (contexts of similar length are padded together).
+    # The predictions are returned in dataset order, token level ones padded to the length of their batch
+    features = [dataset[i] for i in range(len(dataset))]
+    predictions = [None] * len(features)
+    for batch in make_length_batches([len(entry["input_ids"]) for entry in features], token_budget):
+        batch_predictions = predict_features(model, [features[i] for i in batch], data_collator, device)
+        for index, prediction in zip(batch, batch_predictions):
+            predictions[index] = prediction
+    return predictions
+
+
+def predict_packed(model, dataset, data_collator, device, max_len, batch_size):
+    # predict_batch over rows of packed contexts (packing.py), batch_size rows of up to max_len sub-tokens at a time.
+    # The row predictions are split back into the contexts, returned in dataset order
+    from splitner.packing import PackedDataCollator, pack_features, pack_lengths
+
+    features = [dataset[i] for i in range(len(dataset))]
+    lengths = [len(entry["input_ids"]) for entry in features]
+    rows = pack_lengths(lengths, max_len)
+    packed_collator = PackedDataCollator(data_collator)
+    predictions = [None] * len(features)
+    for batch in batched(rows, batch_size):
+        row_predictions = predict_features(model, [pack_features(features, members) for members in batch],
+                                           packed_collator, device)
+        for members, row_prediction in zip(batch, row_predictions):
+            offset = 0
+            for index in members:
+                predictions[index] = row_prediction[offset:offset + lengths[index]]
+                offset += lengths[index]
+    return predictions
+
+
+def predict_chunk(executor, dataset):
+    # model predictions for the contexts of a chunk (see make_chunk). With a window_stride, token level ones (datasets
+    # with get_num_prefix_tokens) are predicted in windows of up to max_seq_len sub-tokens, merged back per context
+    additional_args = executor.additional_args
+    if additional_args.window_stride > 0 and hasattr(dataset, "get_num_prefix_tokens"):
+        from splitner.windows import predict_windows
+        return predict_windows(dataset, additional_args.max_seq_len, additional_args.window_stride,
+                               lambda windows: predict_contexts(executor, windows))
+    return predict_contexts(executor, dataset)
+
+
+def predict_contexts(executor, dataset):
+    # with dedup_inputs, each distinct model input is predicted once (see dedup.py)
+    if executor.additional_args.dedup_inputs:
+        return executor.deduplicator.predict([dataset[i] for i in range(len(dataset))],
+                                             lambda features: predict_batches(executor, features))
+    return predict_batches(executor, dataset)
+
+
+def predict_batches(executor, dataset):
+    # in one batch, packed into rows of max_seq_len sub-tokens (pack_sequences) or length-sorted under the
+    # inference_token_budget
+    additional_args = executor.additional_args
+    if additional_args.pack_sequences:
+        from splitner.packing import check_packing
+        check_packing(additional_args)
+        return predict_packed(executor.model, dataset, executor.trainer.data_collator, executor.train_args.device,
+                              additional_args.max_seq_len, executor.train_args.per_device_eval_batch_size)
+    token_budget = additional_args.inference_token_budget
+    if token_budget > 0:
+        return predict_length_sorted(executor.model, dataset, executor.trainer.data_collator,
+                                     executor.train_args.device, token_budget)
+    return predict_batch(executor.model, dataset, executor.trainer.data_collator, executor.train_args.device)
+
+
+def get_sentence_key(sentence):
+    return [tok.text for tok in sentence.tokens]
+
+
+def get_mention_key(mention):
+    sentence, span = mention
+    return [get_sentence_key(sentence), span.start, span.end]
+
+
+def predict_cached(executor, items, get_key, predict_fn):
+    # decoded predictions of the items (sentences, or sentence and mention span pairs). With a prediction cache
+    # (prediction_cache_path), only the distinct items not found in it go to predict_fn, and their predictions are added
+    cache = executor.prediction_cache
+    if cache is None:
+        return predict_fn(items)
+    keys = [cache.make_key(get_key(item)) for item in items]
+    found = cache.get_many(keys)
+    missing = dict()
+    for key, item in zip(keys, items):
+        if key not in found and key not in missing:
+            missing[key] = item
+    if len(missing) > 0:
+        predicted = dict(zip(missing.keys(), predict_fn(list(missing.values()))))
+        cache.put_many(predicted)
+        found.update(predicted)
+    return [found[key] for key in keys]
+
+
+def get_span_tags(num_tokens, spans, span_types, none_tag):
+    # BIO tags of a sentence with the typed mention spans
+    tags = [none_tag] * num_tokens
+    for span, span_type in zip(spans, span_types):
+        tags[span.start] = "B-{0}".format(span_type)
+        for index in range(span.start + 1, span.end + 1):
+            tags[index] = "I-{0}".format(span_type)
+    return tags
+
+
+def get_window_size(executor, batch_size=None):
+    # sentences per chunk in predict_iter. With a token budget or packing, the model batches are formed within the
+    # chunk, so a larger window of sentences is sorted by length (or packed)
+    if executor.additional_args.inference_token_budget > 0 or executor.additional_args.pack_sequences:
+        return max(executor.additional_args.length_sort_window, batch_size or 0)
+    return batch_size or executor.train_args.per_device_eval_batch_size
+
+
+def iter_eval_batches(executor, dataset):
+    # collated model inputs (without labels) of a dataset in eval batch size
+    batch_size = executor.train_args.per_device_eval_batch_size
+    for start in range(0, len(dataset), batch_size):
+        batch = executor.trainer.data_collator([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])
+        batch.pop("labels", None)
+        yield batch
+
+
+class TraceWrapper(nn.Module):
+    # positional inputs (as needed for tracing) in front of NerModel / NerSpanModel. Outputs the predictions and the
+    # classifier logits, which are only used for checking numerical parity
+    def __init__(self, model, input_names):
+        super(TraceWrapper, self).__init__()
+        self.model = model
+        self.input_names = input_names
+        self.logits = None
+        self.hook = model.classifier.register_forward_hook(self.save_logits)
+
+    def save_logits(self, module, inputs, output):
+        self.logits = output
+
+    def forward(self, *inputs):
+        predictions = self.model(**dict(zip(self.input_names, inputs)))[0]
+        return predictions, self.logits
+
+
+def check_parity(executor, model, compiled_fn, dataset):
+    # compares the logits and predictions of the PyTorch model with a compiled/exported one over all batches of a
+    # dataset (batch and sequence sizes vary). compiled_fn: batch -> (predictions, logits) as numpy arrays
+    wrapper = TraceWrapper(model, None).eval()
+    # batches go where the model is (the exporters may have moved it off the executor's device)
+    device = next(model.parameters()).device
+    max_diff = 0.0
+    mismatches = 0
+    total = 0
+    for batch in iter_eval_batches(executor, dataset):
+        batch = {k: v.to(device) for k, v in batch.items()}
+        wrapper.input_names = list(batch.keys())
+        with torch.no_grad():
+            predictions, logits = wrapper(*batch.values())
+        compiled_predictions, compiled_logits = compiled_fn(batch)
+        max_diff = max(max_diff, float(np.abs(logits.cpu().numpy() - compiled_logits).max()))
+        mismatches += int((predictions.cpu().numpy() != compiled_predictions).sum())
+        total += predictions.numel()
+    wrapper.hook.remove()
+    return max_diff, mismatches, total
+
+
+def write_predictions(file_path, sentences, predictions):
+    with open(file_path, "w", encoding="utf-8") as f:
+        # f.write("Token\tGold\tPredicted\n")
+        write_prediction_lines(f, sentences, predictions)
+
+
+def write_prediction_lines(f, sentences, predictions):
+    for sentence, tags in zip(sentences, predictions):
+        for tok, tag in zip(sentence.tokens, tags):
+            # considering only the first gold tag associated with the token
+            f.write("{0}\t{1}\t{2}\n".format(tok.text, tok.tags[0], tag))
+        f.write("\n")
+
+
+def get_model_fingerprint(additional_args):
+    return [additional_args.resume or additional_args.base_model, additional_args.inference_backend]
+
+
+def get_corpus_key(sentences):
+    # content hash of the sentences (token texts and gold tags, as written to the output)
+    content = hashlib.sha1()
+    for sentence in sentences:
+        content.update(json.dumps([[tok.text, tok.tags[0]] for tok in sentence.tokens]).encode("utf-8"))
+    return content.hexdigest()
+
+
+def read_journal(journal_path, file_path, header):
+    # (first sentence to predict, output size up to the last completed chunk). Starts over if the journal belongs to
+    # another run (corpus content, chunk size or model) or the output is shorter than journaled
+    if not os.path.isfile(journal_path) or not os.path.isfile(file_path):
+        return 0, 0
+    with open(journal_path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    try:
+        if json.loads(lines[0]) != header:
+            logger.info("prediction journal does not match this run, starting over: {0}".format(journal_path))
+            return 0, 0
+    except (ValueError, IndexError):
+        return 0, 0
+    start, offset = 0, 0
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # torn last entry of an interrupted write
+            break
+        start, offset = entry["end"], entry["offset"]
+    if os.path.getsize(file_path) < offset:
+        return 0, 0
+    return start, offset
+
+
+def write_predictions_resumable(file_path, sentences, inputs, predict_fn, chunk_size, fingerprint=None):
+    # write_predictions in chunks of sentences: each completed chunk is synced to the output and recorded in a journal
+    # (<file>.journal: completed sentence ranges and output sizes). An interrupted run restarted with the same corpus
+    # and model continues with the first unfinished chunk. inputs: model inputs per sentence (eg. with the mention
+    # spans), predict_fn: inputs -> tags. The journal is removed once the output is complete
+    if chunk_size <= 0:
+        write_predictions(file_path, sentences, predict_fn(inputs))
+        return
+    journal_path = file_path + ".journal"
+    header = {"num_sentences": len(sentences), "corpus": get_corpus_key(sentences), "chunk_size": chunk_size,
+              "fingerprint": fingerprint}
+    start, offset = read_journal(journal_path, file_path, header)
+    if start > 0:
+        logger.info("resuming predictions at sentence {0}/{1} (chunk {2})"
+                    .format(start, len(sentences), start // chunk_size + 1))
+    # the journal is rewritten with the completed range as a single entry (drops a torn entry of the interrupted run)
+    with open(journal_path, "w", encoding="utf-8") as journal, \
+            open(file_path, "a" if start > 0 else "w", encoding="utf-8") as f:
+        journal.write(json.dumps(header) + "\n")
+        if start > 0:
+            # drops the output of a chunk which was not journaled (writes in append mode go to the new end)
+            f.truncate(offset)
+            journal.write(json.dumps({"start": 0, "end": start, "offset": offset}) + "\n")
+        for chunk_start in range(start, len(sentences), chunk_size):
+            chunk_end = min(chunk_start + chunk_size, len(sentences))
+            write_prediction_lines(f, sentences[chunk_start:chunk_end], predict_fn(inputs[chunk_start:chunk_end]))
+            f.flush()
+            os.fsync(f.fileno())
+            entry = {"start": chunk_start, "end": chunk_end, "offset": os.fstat(f.fileno()).st_size}
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+    os.remove(journal_path)
+
+
+def spans_from_tags(tags):
+    # [start, end, type] word-level spans from BIO tags (dangling I- tags are skipped, as in NerInferSpanDataset)
+    spans = []
+    continue_span = False
+    for index, tag in enumerate(tags):
+        if tag.startswith("B-"):
+            spans.append([index, index, tag[2:]])
+            continue_span = True
+        elif tag.startswith("I-") and continue_span:
+            spans[-1][1] = index
+        else:
+            continue_span = False
+    return spans
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import time
+
+from splitner.inference import load_executor
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class PaddingCounter:
+    # data collator wrapper counting the real (attention mask) and padded tokens of the collated batches
+    def __init__(self, data_collator):
+        self.data_collator = data_collator
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features):
+        batch = self.data_collator(features)
+        self.batches += 1
+        self.tokens += int(batch["attention_mask"].sum())
+        self.padded_tokens += batch["attention_mask"].numel()
+        return batch
+
+    def padding_ratio(self):
+        # share of the model inputs which are padding
+        return 1.0 - self.tokens / max(self.padded_tokens, 1)
+
+
+def run(executor, inputs, batch_size, counter):
+    counter.reset()
+    start = time.time()
+    predictions = list(executor.predict_iter(inputs, batch_size))
+    return predictions, time.time() - start
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    dataset = executor.test_dataset
+    inputs = dataset.sentences
+    if args.executor == "span":
+        inputs = list(zip(dataset.sentences, dataset.sentence_spans))
+    counter = PaddingCounter(executor.trainer.data_collator)
+    executor.trainer.data_collator = counter
+
+    results = dict()
+    modes = args.modes.split(",")
+    for mode in modes:
+        executor.additional_args.inference_token_budget = args.token_budget if mode == "sorted" else 0
+        executor.additional_args.pack_sequences = mode == "packed"
+        executor.additional_args.length_sort_window = args.window
+        # warm-up (first forward passes allocate and initialize the thread pools)
+        run(executor, inputs[:args.batch_size], args.batch_size, counter)
+        predictions, elapsed = run(executor, inputs, args.batch_size, counter)
+        results[mode] = (predictions, elapsed)
+        logger.info("{0} | batches: {1} | tokens: {2} | padded tokens: {3} | padding ratio: {4:.3f} | time: {5:.2f}s "
+                    "({6:.1f} sentences/s, {7:.0f} tokens/s)"
+                    .format(mode, counter.batches, counter.tokens, counter.padded_tokens, counter.padding_ratio(),
+                            elapsed, len(inputs) / elapsed, counter.tokens / elapsed))
+
+    # compared with the first mode
+    for mode in modes[1:]:
+        mismatches = sum(int(a != b) for a, b in zip(results[modes[0]][0], results[mode][0]))
+        logger.info("{0} vs {1} | speedup: {2:.2f}x | sentences with different predictions: {3}/{4}"
+                    .format(mode, modes[0], results[modes[0]][1] / results[mode][1], mismatches, len(inputs)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Inference Batching Benchmark")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--modes", type=str, default="fixed,sorted,packed",
+                    help="comma separated batching modes to compare (fixed|sorted|packed), the first is the reference")
+    ap.add_argument("--batch_size", type=int, default=16, help="fixed: sentences per batch, in input order")
+    ap.add_argument("--token_budget", type=int, default=4096, help="sorted: (padded) sub-tokens per batch")
+    ap.add_argument("--window", type=int, default=1024, help="sorted: sentences sorted by length at a time")
+    ap = ap.parse_args()
+    main(ap)
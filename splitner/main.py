@@ -11,7 +11,11 @@ from transformers import HfArgumentParser
 from transformers.trainer import TrainingArguments
 
 from splitner.additional_args import AdditionalArguments
+from splitner.dedup import Deduplicator
 from splitner.evaluator import Evaluator
+from splitner.inference import batched, load_model, make_sentence, \
+    get_model_fingerprint, get_sentence_key, get_window_size, predict_cached, predict_chunk, write_predictions_resumable
+from splitner.prediction_cache import open_prediction_cache
 from splitner.trainer import NerTrainer
 from splitner.utils.general import set_all_seeds, set_wandb, parse_config, setup_logging
 
@@ -30,9 +34,13 @@ class NerExecutor:
         self.additional_args = additional_args
 
         dataset_class = self.get_dataset_class()
-        self.train_dataset = dataset_class(additional_args, "train")
-        self.dev_dataset = dataset_class(additional_args, "dev")
-        self.test_dataset = dataset_class(additional_args, "test")
+        if additional_args.inference_only:
+            # corpora are not needed for serving, an empty dataset still provides the tokenizer and vocabularies
+            self.train_dataset = self.dev_dataset = self.test_dataset = dataset_class(additional_args, "infer")
+        else:
+            self.train_dataset = dataset_class(additional_args, "train")
+            self.dev_dataset = dataset_class(additional_args, "dev")
+            self.test_dataset = dataset_class(additional_args, "test")
 
         self.num_labels = len(self.train_dataset.tag_vocab)
         model_path = additional_args.resume if additional_args.resume else additional_args.base_model
@@ -40,7 +48,12 @@ class NerExecutor:
 
         model_class = self.get_model_class()
         # load best model in end fails as additional_args is not passed in Trainer (but training successfully completes)
-        self.model = model_class.from_pretrained(model_path, config=bert_config, additional_args=additional_args)
+        self.model = load_model(model_class, model_path, bert_config, additional_args)
+        # predictions of repeated inputs (dedup_inputs)
+        self.deduplicator = Deduplicator(additional_args.dedup_cache_size)
+        # decoded predictions of earlier runs (prediction_cache_path). Not for training runs: the fingerprint is taken
+        # from the model before training
+        self.prediction_cache = None if train_args.do_train else open_prediction_cache(additional_args)
 
         trainable_params = filter(lambda p: p.requires_grad, self.model.parameters())
         logger.info("# trainable params: {0}".format(sum([np.prod(p.size()) for p in trainable_params])))
@@ -64,7 +77,8 @@ class NerExecutor:
         os.makedirs(self.additional_args.predictions_dir, exist_ok=True)
         timer_file_path = os.path.join(self.additional_args.predictions_dir, "{0}-timer.log".format(dataset.corpus_type))
         timer_file = open(timer_file_path, "a")
-        
+        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+
         total_elapsed = 0
         n = 1   # manually set to 10 for prod experiments
         for i in range(0, n):
@@ -72,13 +86,11 @@ class NerExecutor:
             logger.info("start time: {0}".format(str(datetime.now())))
             start = time.time()
 
-            model_predictions: np.ndarray = self.trainer.predict(dataset).predictions
-            if self.additional_args.prediction_mapping == "type1":
-                data = self.bert_to_orig_token_mapping1(dataset, model_predictions)
-            elif self.additional_args.prediction_mapping == "type2":
-                data = self.bert_to_orig_token_mapping2(dataset, model_predictions)
-            else:
-                raise NotImplementedError
+            # predictions are decoded and written batch by batch, so memory does not grow with the corpus size
+            # in journaled chunks, an interrupted run continues with the first unfinished chunk
+            write_predictions_resumable(predictions_file, dataset.sentences, dataset.sentences, self.predict_iter,
+                                        self.additional_args.predict_chunk_size,
+                                        get_model_fingerprint(self.additional_args))
 
             elapsed = time.time() - start
             logger.info("elapsed time: {0} seconds: {1}".format(str(elapsed), str(timedelta(seconds=elapsed))))
@@ -89,15 +101,34 @@ class NerExecutor:
         avg_elapsed = total_elapsed / n
         timer_file.write(f"Avg: {str(avg_elapsed)}\n")
         timer_file.close()
-
-        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+        if self.additional_args.dedup_inputs:
+            logger.info("deduplication: {0}".format(self.deduplicator))
+        if self.prediction_cache is not None:
+            logger.info("prediction cache: {0}".format(self.prediction_cache))
         logger.info("Outputs published in file: {0}".format(predictions_file))
-        with open(predictions_file, "w", encoding="utf-8") as f:
-            # f.write("Token\tGold\tPredicted\n")
-            for sent in data:
-                for word in sent:
-                    f.write("{0}\t{1}\t{2}\n".format(word[0], word[1], word[2]))
-                f.write("\n")
+
+    # yields the predicted tags for each sentence (list of token texts or Sentence) in input order. Sentences are
+    # consumed lazily in micro-batches (default: eval batch size) and each batch is decoded as soon as it finishes.
+    # With an inference_token_budget, windows of length_sort_window sentences are predicted in length-sorted batches
+    def predict_iter(self, sentences, batch_size=None):
+        none_tag = self.additional_args.none_tag
+        self.model.eval()
+        for batch in batched(sentences, get_window_size(self, batch_size)):
+            # sentences in the prediction cache are not predicted again
+            yield from predict_cached(self, [make_sentence(sent, none_tag) for sent in batch], get_sentence_key,
+                                      self.predict_sentences)
+
+    def predict_sentences(self, sentences):
+        chunk = self.test_dataset.make_chunk(sentences)
+        model_predictions = predict_chunk(self, chunk)
+        return [[word[2] for word in sent] for sent in self.map_predictions(chunk, model_predictions)]
+
+    def map_predictions(self, dataset, model_predictions):
+        if self.additional_args.prediction_mapping == "type1":
+            return self.bert_to_orig_token_mapping1(dataset, model_predictions)
+        if self.additional_args.prediction_mapping == "type2":
+            return self.bert_to_orig_token_mapping2(dataset, model_predictions)
+        raise NotImplementedError
 
     # take the tag output for the first bert token as the tag for the original token
     # slightly more: "true positives", slightly less: "false positives", "false negatives"
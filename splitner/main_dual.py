@@ -0,0 +1,119 @@
+import logging
+import sys
+
+import torch
+from transformers import HfArgumentParser
+from transformers.trainer import TrainingArguments
+
+from splitner.additional_args import AdditionalArguments
+from splitner.dataset_dual import NerDualDataCollator, NerDualDataset
+from splitner.inference import batched, get_sentence_key, get_span_tags, make_sentence, predict_cached, spans_from_tags
+from splitner.main_qa import NerQAExecutor
+from splitner.model_dual import NerDualModel
+from splitner.trainer import NerTrainer
+from splitner.utils.general import PairSpan, parse_config, setup_logging
+
+logger = logging.getLogger(__name__)
+
+SPAN_KEYS = ["span_index", "span_start", "span_end", "span_labels"]
+
+
+class NerDualTrainer(NerTrainer):
+    # "alternate" schedule: the detection and span classification objectives take turns per optimization step.
+    # "mixed": both losses on every batch (see NerDualModel)
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if self.model.additional_args.dual_schedule == "alternate":
+            inputs = dict(inputs)
+            inputs.pop("span_labels" if self.state.global_step % 2 == 0 else "labels", None)
+        return super(NerDualTrainer, self).compute_loss(model, inputs, *args, **kwargs)
+
+
+class NerDualExecutor(NerQAExecutor):
+    # span detector and span classifier as one model with a shared encoder (NerDualModel). Evaluation during training
+    # reports the span detection metrics, predictions are the final typed tags (as of SplitNerPipeline)
+    def __init__(self, train_args: TrainingArguments, additional_args: AdditionalArguments):
+        if not additional_args.detect_spans:
+            raise ValueError("shared-encoder model works on span detection contexts, set detect_spans")
+        if additional_args.window_stride > 0:
+            # span positions and span labels are per context, not per sub-token
+            raise ValueError("shared-encoder model does not support window_stride")
+        # evaluation compares the detection predictions with the detection labels (span labels are for the loss only)
+        train_args.label_names = train_args.label_names or ["labels"]
+        super(NerDualExecutor, self).__init__(train_args, additional_args)
+
+    def get_dataset_class(self):
+        return NerDualDataset
+
+    def get_data_collator(self):
+        return NerDualDataCollator(args=self.additional_args, pattern_vocab=self.train_dataset.pattern_vocab)
+
+    def get_trainer_class(self):
+        return NerDualTrainer
+
+    def get_model_class(self):
+        return NerDualModel
+
+    # yields the final BIO tags for each sentence. The encoder runs once per batch: the detected mentions are
+    # classified from the same encoder outputs
+    def predict_iter(self, sentences, batch_size=None):
+        batch_size = batch_size or self.train_args.per_device_eval_batch_size
+        none_tag = self.additional_args.none_tag
+        self.model.eval()
+        for batch in batched(sentences, batch_size):
+            # sentences in the prediction cache are not predicted again
+            yield from predict_cached(self, [make_sentence(sent, none_tag) for sent in batch], get_sentence_key,
+                                      self.predict_sentences)
+
+    def predict_sentences(self, sentences):
+        none_tag = self.additional_args.none_tag
+        span_tags = self.test_dataset.span_tag_vocab
+        device = self.train_args.device
+        chunk = self.test_dataset.make_chunk(sentences)
+        inputs = self.trainer.data_collator([chunk[i] for i in range(len(chunk))])
+        for key in ["labels"] + SPAN_KEYS:
+            inputs.pop(key, None)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with torch.no_grad():
+            encoder_outputs = self.model.bert(inputs["input_ids"],
+                                              attention_mask=inputs["attention_mask"],
+                                              token_type_ids=inputs.get("token_type_ids"))
+            detections = self.model(**inputs, encoder_outputs=encoder_outputs)[0].cpu().numpy()
+
+            # one context per sentence in span detection
+            sentence_spans = [[PairSpan(sp[0], sp[1]) for sp in spans_from_tags([word[2] for word in sent])]
+                              for sent in self.bert_to_orig_token_mapping1(chunk, detections)]
+            span_index, span_start, span_end = [], [], []
+            for i, (context, spans) in enumerate(zip(chunk.contexts, sentence_spans)):
+                for start, end in NerDualDataset.get_span_positions(context, spans):
+                    span_index.append(i)
+                    span_start.append(start)
+                    span_end.append(end)
+            span_types = []
+            if len(span_index) > 0:
+                logits = self.model.classify_spans(encoder_outputs[0],
+                                                   torch.tensor(span_index, device=device),
+                                                   torch.tensor(span_start, device=device),
+                                                   torch.tensor(span_end, device=device))
+                span_types = [span_tags[k] for k in torch.argmax(logits, dim=1).tolist()]
+
+        span_types = iter(span_types)
+        return [get_span_tags(len(sentence.tokens), spans, [next(span_types) for _ in spans], none_tag)
+                for sentence, spans in zip(chunk.sentences, sentence_spans)]
+
+
+def main():
+    setup_logging()
+    parser = HfArgumentParser([TrainingArguments, AdditionalArguments])
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        # when a config json file is provided, parse it to get our arguments.
+        train_args, additional_args = parse_config(parser, sys.argv[1])
+    else:
+        train_args, additional_args = parser.parse_args_into_dataclasses()
+
+    executor = NerDualExecutor(train_args, additional_args)
+    executor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 import traceback
 
 import numpy as np
+from torch.utils.data import ConcatDataset
 from transformers import AutoConfig, AutoTokenizer
 from transformers import HfArgumentParser
 from transformers.trainer import TrainingArguments
@@ -13,7 +14,12 @@ from transformers.trainer import TrainingArguments
 from splitner.additional_args import AdditionalArguments
 from splitner.dataset import NerDataCollator
 from splitner.dataset_qa import NerQADataset
+from splitner.dedup import Deduplicator
+from splitner.distill import DistillationTrainer, UnlabeledDataset, keep_encoder_layers, read_unlabeled_sentences
 from splitner.evaluator_qa import EvaluatorQA
+from splitner.inference import batched, load_model, make_sentence, \
+    get_model_fingerprint, get_sentence_key, get_window_size, predict_cached, predict_chunk, write_predictions_resumable
+from splitner.prediction_cache import open_prediction_cache
 from splitner.trainer import NerTrainer
 from splitner.utils.general import set_all_seeds, set_wandb, parse_config, setup_logging
 
@@ -31,9 +37,14 @@ class NerQAExecutor:
         self.train_args = train_args
         self.additional_args = additional_args
 
-        self.train_dataset = NerQADataset(additional_args, "train")
-        self.dev_dataset = NerQADataset(additional_args, "dev")
-        self.test_dataset = NerQADataset(additional_args, "test")
+        dataset_class = self.get_dataset_class()
+        if additional_args.inference_only:
+            # corpora are not needed for serving, an empty dataset still provides the tokenizer and vocabularies
+            self.train_dataset = self.dev_dataset = self.test_dataset = dataset_class(additional_args, "infer")
+        else:
+            self.train_dataset = dataset_class(additional_args, "train")
+            self.dev_dataset = dataset_class(additional_args, "dev")
+            self.test_dataset = dataset_class(additional_args, "test")
 
         # num_labels = 3 (for BIO tagging scheme), num_labels = 4 (for BIOE tagging scheme) etc.
         self.num_labels = self.additional_args.num_labels
@@ -42,20 +53,30 @@ class NerQAExecutor:
         bert_config = AutoConfig.from_pretrained(model_path, num_labels=self.num_labels)
 
         model_class = self.get_model_class()
-        self.model = model_class.from_pretrained(model_path, config=bert_config, additional_args=additional_args)
+        self.model = load_model(model_class, model_path, bert_config, additional_args)
+        # predictions of repeated inputs (dedup_inputs)
+        self.deduplicator = Deduplicator(additional_args.dedup_cache_size)
+        # decoded predictions of earlier runs (prediction_cache_path). Not for training runs: the fingerprint is taken
+        # from the model before training
+        self.prediction_cache = None if train_args.do_train else open_prediction_cache(additional_args)
+        if train_args.do_train and additional_args.distill_teacher:
+            self.model = keep_encoder_layers(self.model, additional_args.student_num_layers)
 
         trainable_params = filter(lambda p: p.requires_grad, self.model.parameters())
         logger.info("# trainable params: {0}".format(sum([np.prod(p.size()) for p in trainable_params])))
 
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        data_collator = NerDataCollator(args=additional_args, pattern_vocab=self.train_dataset.pattern_vocab)
-        self.trainer = NerTrainer(model=self.model,
-                                  args=train_args,
-                                  tokenizer=tokenizer,
-                                  data_collator=data_collator,
-                                  train_dataset=self.train_dataset,
-                                  eval_dataset=self.dev_dataset,
-                                  compute_metrics=self.compute_metrics)
+        data_collator = self.get_data_collator()
+        if train_args.do_train and additional_args.distill_teacher:
+            self.trainer = self.get_distillation_trainer(model_class, tokenizer, data_collator)
+        else:
+            self.trainer = self.get_trainer_class()(model=self.model,
+                                                    args=train_args,
+                                                    tokenizer=tokenizer,
+                                                    data_collator=data_collator,
+                                                    train_dataset=self.train_dataset,
+                                                    eval_dataset=self.dev_dataset,
+                                                    compute_metrics=self.compute_metrics)
 
         ''' 
         for i in range(0, 4):
@@ -67,6 +88,33 @@ class NerQAExecutor:
        ''' 
 
 
+    # the model being trained is the student. The teacher (trained span detector with the same tokenizer and input
+    # features) labels the train set and the optional unlabeled text with soft labels
+    def get_distillation_trainer(self, model_class, tokenizer, data_collator):
+        teacher_path = self.additional_args.distill_teacher
+        logger.info("distilling teacher: {0}".format(teacher_path))
+        teacher_config = AutoConfig.from_pretrained(teacher_path, num_labels=self.num_labels)
+        teacher = model_class.from_pretrained(teacher_path, config=teacher_config, additional_args=self.additional_args)
+
+        train_dataset = self.train_dataset
+        if self.additional_args.distill_unlabeled_path:
+            none_tag = self.additional_args.none_tag
+            sentences = read_unlabeled_sentences(self.additional_args.distill_unlabeled_path)
+            unlabeled = self.train_dataset.make_chunk([make_sentence(sent, none_tag) for sent in sentences])
+            logger.info("unlabeled contexts for distillation: {0}".format(len(unlabeled)))
+            train_dataset = ConcatDataset([self.train_dataset, UnlabeledDataset(unlabeled)])
+
+        return DistillationTrainer(teacher=teacher,
+                                   alpha=self.additional_args.distill_alpha,
+                                   temperature=self.additional_args.distill_temperature,
+                                   model=self.model,
+                                   args=self.train_args,
+                                   tokenizer=tokenizer,
+                                   data_collator=data_collator,
+                                   train_dataset=train_dataset,
+                                   eval_dataset=self.dev_dataset,
+                                   compute_metrics=self.compute_metrics)
+
     def compute_metrics(self, eval_prediction):
         evaluator = EvaluatorQA(gold=eval_prediction.label_ids, predicted=eval_prediction.predictions,
                                 num_labels=self.num_labels, none_tag=self.additional_args.none_tag)
@@ -77,7 +125,8 @@ class NerQAExecutor:
         os.makedirs(self.additional_args.predictions_dir, exist_ok=True)
         timer_file_path = os.path.join(self.additional_args.predictions_dir, "{0}-timer.log".format(dataset.corpus_type))
         timer_file = open(timer_file_path, "a")
-        
+        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+
         total_elapsed = 0
         n = 1   # manually set to 10 for prod experiments
         for i in range(0, n):
@@ -85,9 +134,11 @@ class NerQAExecutor:
             logger.info("start time: {0}".format(str(datetime.now())))
             start = time.time()
 
-            model_predictions: np.ndarray = self.trainer.predict(dataset).predictions
-            data = self.bert_to_orig_token_mapping1(dataset, model_predictions)
-            # data = self.bert_to_orig_token_mapping2(dataset, model_predictions)
+            # predictions are decoded and written batch by batch, so memory does not grow with the corpus size
+            # in journaled chunks, an interrupted run continues with the first unfinished chunk
+            write_predictions_resumable(predictions_file, dataset.sentences, dataset.sentences, self.predict_iter,
+                                        self.additional_args.predict_chunk_size,
+                                        get_model_fingerprint(self.additional_args))
 
             elapsed = time.time() - start
             logger.info("elapsed time: {0} seconds: {1}".format(str(elapsed), str(timedelta(seconds=elapsed))))
@@ -97,34 +148,48 @@ class NerQAExecutor:
         avg_elapsed = total_elapsed / n
         timer_file.write(f"Avg: {str(avg_elapsed)}\n")
         timer_file.close()
-
-        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+        if self.additional_args.dedup_inputs:
+            logger.info("deduplication: {0}".format(self.deduplicator))
+        if self.prediction_cache is not None:
+            logger.info("prediction cache: {0}".format(self.prediction_cache))
         logger.info("Outputs published in file: {0}".format(predictions_file))
-        with open(predictions_file, "w", encoding="utf-8") as f:
-            # f.write("Token\tGold\tPredicted\n")
-            for sent in data:
-                for word in sent:
-                    f.write("{0}\t{1}\t{2}\n".format(word[0], word[1], word[2]))
-                f.write("\n")
+
+    # yields the predicted tags for each sentence (list of token texts or Sentence) in input order. Sentences are
+    # consumed lazily in micro-batches (default: eval batch size) and each batch is decoded as soon as it finishes.
+    # With an inference_token_budget, windows of length_sort_window sentences are predicted in length-sorted batches
+    def predict_iter(self, sentences, batch_size=None):
+        none_tag = self.additional_args.none_tag
+        self.model.eval()
+        for batch in batched(sentences, get_window_size(self, batch_size)):
+            # sentences in the prediction cache are not predicted again
+            yield from predict_cached(self, [make_sentence(sent, none_tag) for sent in batch], get_sentence_key,
+                                      self.predict_sentences)
+
+    def predict_sentences(self, sentences):
+        chunk = self.test_dataset.make_chunk(sentences)
+        model_predictions = predict_chunk(self, chunk)
+        # data = self.bert_to_orig_token_mapping2(chunk, model_predictions)
+        return [[word[2] for word in sent] for sent in self.bert_to_orig_token_mapping1(chunk, model_predictions)]
 
     # take the tag output for the first bert token as the tag for the original token
     # slightly more: "true positives", slightly less: "false positives", "false negatives"
     def bert_to_orig_token_mapping1(self, dataset, model_predictions):
-        data_dict = {}
         pad_tag = self.additional_args.pad_tag
         none_tag = self.additional_args.none_tag
+        # contexts (one per entity type, or one in span detection) are grouped by the sentence they come from
+        data_dict = {}
+        for sentence in dataset.sentences:
+            entry = []
+            for tok in sentence.tokens:
+                # considering only the first gold tag associated with the token
+                # gold_tag = "ENTITY" if self.additional_args.detect_spans else tok.tags[0]
+                gold_tag = tok.tags[0]
+                entry.append([tok.text, gold_tag, pad_tag])
+            data_dict[id(sentence)] = entry
         for i in range(len(dataset)):
             context = dataset.contexts[i]
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
+            sent_key = id(context.sentence)
             prediction = model_predictions[i]
-            if text_sentence not in data_dict:
-                entry = []
-                for tok in context.sentence.tokens:
-                    # considering only the first gold tag associated with the token
-                    # gold_tag = "ENTITY" if self.additional_args.detect_spans else tok.tags[0]
-                    gold_tag = tok.tags[0]
-                    entry.append([tok.text, gold_tag, pad_tag])
-                data_dict[text_sentence] = entry
             ptr = 0
             r = min(prediction.shape[0], len(context.bert_tokens))
             for j in range(r):
@@ -134,7 +199,7 @@ class NerQAExecutor:
                 if context.bert_tokens[j].token.offset != ptr:
                     continue
 
-                if data_dict[text_sentence][ptr][2] not in [pad_tag, none_tag]:
+                if data_dict[sent_key][ptr][2] not in [pad_tag, none_tag]:
                     ptr += 1
                     continue
 
@@ -147,39 +212,31 @@ class NerQAExecutor:
                 else:
                     tag_assignment = none_tag
 
-                data_dict[text_sentence][ptr][2] = tag_assignment
+                data_dict[sent_key][ptr][2] = tag_assignment
                 ptr += 1
 
-        data = []
-        for context in dataset.contexts:
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
-            if text_sentence in data_dict:
-                data.append(data_dict[text_sentence])
-                del data_dict[text_sentence]
-
-        return data
+        return [data_dict[id(sentence)] for sentence in dataset.sentences]
 
     # for each original token, if the output for bert sub-tokens is inconsistent, then map to NONE_TAG else take the tag
     # slightly more: "true positives", slightly less: "false negatives", considerably less: "false positives"
     # TODO: needs proof-reading
     def bert_to_orig_token_mapping2(self, dataset, model_predictions):
-        data_dict = {}
         pad_tag = self.additional_args.pad_tag
         none_tag = self.additional_args.none_tag
+        # considering only the first gold tag associated with the token
+        data_dict = {id(sentence): [[tok.text, tok.tags[0], pad_tag] for tok in sentence.tokens]
+                     for sentence in dataset.sentences}
         for i in range(len(dataset)):
             context = dataset.contexts[i]
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
+            sent_key = id(context.sentence)
             prediction = model_predictions[i]
-            if text_sentence not in data_dict:
-                # considering only the first gold tag associated with the token
-                data_dict[text_sentence] = [[tok.text, tok.tags[0], pad_tag] for tok in context.sentence.tokens]
             ptr = -1
             r = min(prediction.shape[0], len(context.bert_tokens))
             for j in range(1, r - 1):
                 if context.bert_tokens[j].token_type == 0:
                     continue
 
-                curr_assigned_tag = data_dict[text_sentence][ptr][2]
+                curr_assigned_tag = data_dict[sent_key][ptr][2]
                 if curr_assigned_tag not in [pad_tag, none_tag] and curr_assigned_tag[2:] != context.entity:
                     ptr += 1
                     continue
@@ -195,23 +252,16 @@ class NerQAExecutor:
                         tag_assignment = "I-" + context.entity
                     else:
                         tag_assignment = none_tag
-                    if data_dict[text_sentence][ptr][2] in [none_tag, pad_tag]:
-                        data_dict[text_sentence][ptr][2] = tag_assignment
+                    if data_dict[sent_key][ptr][2] in [none_tag, pad_tag]:
+                        data_dict[sent_key][ptr][2] = tag_assignment
 
                 # TODO: need to make this condition stricter (last tag should be "E", all intermediate ones "I"
                 elif (prediction[j] != NerQADataset.get_tag_index("I", none_tag) or
                       prediction[j] != NerQADataset.get_tag_index("E", none_tag)) \
-                        and data_dict[text_sentence][ptr][2][2:] == context.entity:
-                    data_dict[text_sentence][ptr][2] = none_tag
+                        and data_dict[sent_key][ptr][2][2:] == context.entity:
+                    data_dict[sent_key][ptr][2] = none_tag
 
-        data = []
-        for context in dataset.contexts:
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
-            if text_sentence in data_dict:
-                data.append(data_dict[text_sentence])
-                del data_dict[text_sentence]
-
-        return data
+        return [data_dict[id(sentence)] for sentence in dataset.sentences]
 
     def run(self):
         if self.train_args.do_train:
@@ -235,6 +285,15 @@ class NerQAExecutor:
             self.dump_predictions(self.test_dataset)
             # throws some threading related tqdm/wandb exception in the end (but code fully works)
 
+    def get_dataset_class(self):
+        return NerQADataset
+
+    def get_data_collator(self):
+        return NerDataCollator(args=self.additional_args, pattern_vocab=self.train_dataset.pattern_vocab)
+
+    def get_trainer_class(self):
+        return NerTrainer
+
     def get_model_class(self):
         if self.additional_args.model_mode == "std":
             from splitner.model import NerModel
@@ -12,7 +12,12 @@ from transformers.trainer import TrainingArguments
 
 from splitner.additional_args import AdditionalArguments
 from splitner.dataset_span import NerSpanDataCollator, NerSpanDataset
+from splitner.dedup import Deduplicator
 from splitner.evaluator_span import EvaluatorSpan
+from splitner.gazetteer import load_gazetteer, save_checkpoint_gazetteers
+from splitner.inference import batched, load_model, make_sentence, make_span, get_mention_key, get_span_tags, \
+    get_model_fingerprint, get_window_size, predict_cached, predict_chunk, write_predictions_resumable
+from splitner.prediction_cache import open_prediction_cache
 from splitner.trainer import NerTrainer
 from splitner.utils.general import set_all_seeds, set_wandb, parse_config, setup_logging
 
@@ -31,9 +36,13 @@ class NerSpanExecutor:
         self.train_args = train_args
         self.additional_args = additional_args
 
-        self.train_dataset = NerSpanDataset(additional_args, "train")
-        self.dev_dataset = NerSpanDataset(additional_args, "dev")
-        self.test_dataset = NerSpanDataset(additional_args, "test")
+        if additional_args.inference_only:
+            # corpora are not needed for serving, an empty dataset still provides the tokenizer and vocabularies
+            self.train_dataset = self.dev_dataset = self.test_dataset = NerSpanDataset(additional_args, "infer")
+        else:
+            self.train_dataset = NerSpanDataset(additional_args, "train")
+            self.dev_dataset = NerSpanDataset(additional_args, "dev")
+            self.test_dataset = NerSpanDataset(additional_args, "test")
 
         self.num_labels = len(self.train_dataset.tag_vocab)
 
@@ -41,7 +50,14 @@ class NerSpanExecutor:
         bert_config = AutoConfig.from_pretrained(model_path, num_labels=self.num_labels)
 
         model_class = self.get_model_class()
-        self.model = model_class.from_pretrained(model_path, config=bert_config, additional_args=additional_args)
+        self.model = load_model(model_class, model_path, bert_config, additional_args)
+        # predictions of repeated inputs (dedup_inputs)
+        self.deduplicator = Deduplicator(additional_args.dedup_cache_size)
+        # decoded predictions of earlier runs (prediction_cache_path). Not for training runs: the fingerprint is taken
+        # from the model before training
+        self.prediction_cache = None if train_args.do_train else open_prediction_cache(additional_args)
+        # mention types known from the training set (gazetteer_purity). A training run saves it in its checkpoints
+        self.gazetteer = None if train_args.do_train else load_gazetteer(additional_args, model_path)
 
         trainable_params = filter(lambda p: p.requires_grad, self.model.parameters())
         logger.info("# trainable params: {0}".format(sum([np.prod(p.size()) for p in trainable_params])))
@@ -66,15 +82,20 @@ class NerSpanExecutor:
         os.makedirs(self.additional_args.predictions_dir, exist_ok=True)
         timer_file_path = os.path.join(self.additional_args.predictions_dir, "{0}-timer.log".format(dataset.corpus_type))
         timer_file = open(timer_file_path, "a")
-        
+        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+
         total_elapsed = 0
         n = 1   # manually set to 10 for prod experiments
         for i in range(0, n):
             logger.info("{0}-th prediction".format(str(i)))
             start = time.time()
 
-            model_predictions: np.ndarray = self.trainer.predict(dataset).predictions
-            data = self.map_predictions_to_sentences(dataset, model_predictions)
+            # predictions are decoded and written batch by batch, so memory does not grow with the corpus size
+            # in journaled chunks, an interrupted run continues with the first unfinished chunk
+            inputs = list(zip(dataset.sentences, dataset.sentence_spans))
+            write_predictions_resumable(predictions_file, dataset.sentences, inputs, self.predict_iter,
+                                        self.additional_args.predict_chunk_size,
+                                        get_model_fingerprint(self.additional_args))
 
             elapsed = time.time() - start
             logger.info("elapsed time: {0} seconds: {1}".format(str(elapsed), str(timedelta(seconds=elapsed))))
@@ -85,38 +106,39 @@ class NerSpanExecutor:
         avg_elapsed = total_elapsed / n
         timer_file.write(f"Avg: {str(avg_elapsed)}\n")
         timer_file.close()
-
-        predictions_file = os.path.join(self.additional_args.predictions_dir, "{0}.tsv".format(dataset.corpus_type))
+        if self.additional_args.dedup_inputs:
+            logger.info("deduplication: {0}".format(self.deduplicator))
+        if self.prediction_cache is not None:
+            logger.info("prediction cache: {0}".format(self.prediction_cache))
+        if self.gazetteer is not None:
+            logger.info("gazetteer: {0}".format(self.gazetteer))
         logger.info("Outputs published in file: {0}".format(predictions_file))
-        with open(predictions_file, "w", encoding="utf-8") as f:
-            # f.write("Token\tGold\tPredicted\n")
-            for sent in data:
-                for word in sent:
-                    f.write("{0}\t{1}\t{2}\n".format(word[0], word[1], word[2]))
-                f.write("\n")
-
-    def map_predictions_to_sentences(self, dataset, model_predictions):
-        data_dict = {}
+
+    # yields the predicted tags for each (sentence, mention spans) pair in input order. Sentences are lists of token
+    # texts or Sentence objects and spans are PairSpan or (start, end) word offsets. Inputs are consumed lazily in
+    # micro-batches of sentences (default: eval batch size) and each batch is decoded as soon as it finishes. With an
+    # inference_token_budget, windows of length_sort_window sentences are predicted in length-sorted batches
+    def predict_iter(self, sentences, batch_size=None):
         none_tag = self.additional_args.none_tag
-        for i in range(len(dataset)):
-            context = dataset.contexts[i]
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
-            predicted_entity = self.dev_dataset.tag_vocab[model_predictions[i]]
-            if text_sentence not in data_dict:
-                # considering only the first gold tag associated with the token
-                data_dict[text_sentence] = [[tok.text, tok.tags[0], none_tag] for tok in context.sentence.tokens]
-            data_dict[text_sentence][context.mention_span.start][2] = "B-{0}".format(predicted_entity)
-            for index in range(context.mention_span.start + 1, context.mention_span.end + 1):
-                data_dict[text_sentence][index][2] = "I-{0}".format(predicted_entity)
-
-        data = []
-        for context in dataset.contexts:
-            text_sentence = " ".join([tok.text for tok in context.sentence.tokens])
-            if text_sentence in data_dict:
-                data.append(data_dict[text_sentence])
-                del data_dict[text_sentence]
-
-        return data
+        self.model.eval()
+        for batch in batched(sentences, get_window_size(self, batch_size)):
+            batch = [(make_sentence(sent, none_tag), [make_span(sp) for sp in spans]) for sent, spans in batch]
+            mentions = [(sentence, span) for sentence, spans in batch for span in spans]
+            # mentions resolved by the gazetteer, or in the prediction cache, are not classified by the model
+            span_types = [None] * len(mentions)
+            if self.gazetteer is not None:
+                span_types = [self.gazetteer.lookup(sentence, span) for sentence, span in mentions]
+            unresolved = [mention for mention, span_type in zip(mentions, span_types) if span_type is None]
+            predicted = iter(predict_cached(self, unresolved, get_mention_key, self.predict_mention_types))
+            span_types = iter([span_type or next(predicted) for span_type in span_types])
+            for sentence, spans in batch:
+                yield get_span_tags(len(sentence.tokens), spans, [next(span_types) for _ in spans], none_tag)
+
+    def predict_mention_types(self, mentions):
+        # one context per (sentence, mention span)
+        chunk = self.test_dataset.make_chunk([sentence for sentence, _ in mentions], [[span] for _, span in mentions])
+        model_predictions = predict_chunk(self, chunk)
+        return [chunk.tag_vocab[model_predictions[i]] for i in range(len(chunk))]
 
     def get_model_class(self):
         if self.additional_args.model_mode == "std":
@@ -134,6 +156,8 @@ class NerSpanExecutor:
 
             try:
                 self.trainer.train(self.additional_args.resume)
+                save_checkpoint_gazetteers(self.additional_args, self.train_dataset.sentences,
+                                           self.train_args.output_dir)
             except:
                 traceback.print_exc()
 
@@ -0,0 +1,137 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from splitner.bundle import BUNDLE_VERSION, load_mapped_model, map_data, pack_tensors, read_header, write_container
+from splitner.inference import load_executor
+from splitner.utils.general import read_memory_stats, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# raw tensor data in the bundle container layout (see bundle.py), kept in the checkpoint dir next to the weights
+MMAP_WEIGHTS_NAME = "pytorch_model.mmap"
+# saved weights the memory-mappable file is converted from
+SOURCE_WEIGHTS_NAMES = ["pytorch_model.bin", "model.safetensors"]
+PROBE_PREFIX = "probe: "
+
+
+def get_mmap_path(model_path):
+    return os.path.join(model_path, MMAP_WEIGHTS_NAME)
+
+
+def get_source_weights(model_path):
+    # [name, size, mtime] of the saved weights, kept in the header: a checkpoint retrained or overwritten at the same
+    # path gets its memory-mappable file rebuilt
+    source = []
+    for name in SOURCE_WEIGHTS_NAMES:
+        path = os.path.join(model_path, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            source.append([name, stat.st_size, stat.st_mtime_ns])
+    return source
+
+
+def save_mmap_checkpoint(model, model_path):
+    blobs = []
+    tensors, _ = pack_tensors(model.state_dict(), blobs, 0)
+    output_path = get_mmap_path(model_path)
+    # written next to the final file and renamed, so that concurrent loaders never map a partial file
+    tmp_path = "{0}.tmp-{1}".format(output_path, os.getpid())
+    header = {"version": BUNDLE_VERSION, "tensors": tensors, "source": get_source_weights(model_path)}
+    size = write_container(tmp_path, header, blobs)
+    os.replace(tmp_path, output_path)
+    return size
+
+
+def load_mmap_model(model_class, model_path, config, additional_args):
+    # weights are memory-mapped from the checkpoint instead of read into the process heap: processes loading the same
+    # checkpoint share the (page cache) pages, and pages are only read when first used
+    mmap_path = get_mmap_path(model_path)
+    header = None
+    if os.path.isfile(mmap_path):
+        header, data_offset = read_header(mmap_path)
+        if header.get("source") != get_source_weights(model_path):
+            logger.warning("saved weights changed since the memory-mappable file was built, rebuilding: {0}"
+                           .format(mmap_path))
+            header = None
+    if header is None:
+        if not os.path.isdir(model_path):
+            raise ValueError("mmap backend needs a local checkpoint dir, got: {0}".format(model_path))
+        # conversion of the saved weights (from_pretrained handles the checkpoint formats and key prefixes)
+        logger.info("converting checkpoint to memory-mappable format: {0}".format(mmap_path))
+        model = model_class.from_pretrained(model_path, config=config, additional_args=additional_args)
+        save_mmap_checkpoint(model, model_path)
+        del model
+        header, data_offset = read_header(mmap_path)
+    logger.info("loading memory-mapped model from: {0}".format(mmap_path))
+    return load_mapped_model(model_class, config, additional_args, header["tensors"], map_data(mmap_path, data_offset))
+
+
+def probe(args):
+    # run in a fresh process by the benchmark: load time and memory of one executor after a first prediction (which
+    # reads the weights in). Blocks until stdin is closed, so that several probes hold their models at the same time
+    start = time.time()
+    executor = load_executor(args.config, args.executor, inference_backend=args.probe)
+    load_time = time.time() - start
+    tokens = ["The", "quick", "brown", "fox", "jumps"]
+    list(executor.predict_iter([(tokens, [(1, 3)])] if args.executor == "span" else [tokens]))
+    stats = dict(read_memory_stats(), load_time=load_time)
+    print(PROBE_PREFIX + json.dumps(stats), flush=True)
+    sys.stdin.read()
+
+
+def run_probes(args, backend):
+    command = [sys.executable, "-m", "splitner.mmap_checkpoint", "--config", args.config, "--executor", args.executor,
+               "--probe", backend]
+    processes = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+                 for _ in range(args.processes)]
+    results = []
+    for process in processes:
+        line = ""
+        for line in process.stdout:
+            if line.startswith(PROBE_PREFIX):
+                break
+        if not line.startswith(PROBE_PREFIX):
+            raise RuntimeError("probe failed for backend: {0}".format(backend))
+        results.append(json.loads(line[len(PROBE_PREFIX):]))
+    # PSS once all processes hold their model (shared pages are split between them)
+    total_pss = sum(read_memory_stats(process.pid)["pss"] for process in processes)
+    for process in processes:
+        process.stdin.close()
+        process.wait()
+    mean = lambda key: sum(r[key] for r in results) / len(results)
+    logger.info("{0} | load: {1:.2f}s | RSS: {2:.0f}MB | peak RSS: {3:.0f}MB | total PSS ({4} processes): {5:.0f}MB"
+                .format(backend, mean("load_time"), mean("rss"), mean("peak_rss"), len(results), total_pss))
+
+
+def main(args):
+    setup_logging()
+    if args.probe:
+        probe(args)
+        return
+
+    executor = load_executor(args.config, args.executor, inference_backend="torch")
+    model_path = executor.additional_args.resume or executor.additional_args.base_model
+    size = save_mmap_checkpoint(executor.model, model_path)
+    logger.info("memory-mappable weights saved in: {0} ({1:.1f}MB)".format(get_mmap_path(model_path),
+                                                                         size / (1024 * 1024)))
+    if args.benchmark:
+        del executor
+        for backend in ["torch", "mmap"]:
+            run_probes(args, backend)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Memory-Mapped Checkpoint")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (qa|seqtag|span|dual)")
+    ap.add_argument("--benchmark", dest="benchmark", action="store_true",
+                    help="set this flag to compare the load time and memory of from_pretrained and mmap loading")
+    ap.add_argument("--processes", type=int, default=4, help="benchmark: processes loading the model at the same time")
+    ap.add_argument("--probe", type=str, default=None, help=argparse.SUPPRESS)
+    ap = ap.parse_args()
+    main(ap)
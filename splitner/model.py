@@ -6,6 +6,7 @@ from transformers.models.bert import BertModel, BertPreTrainedModel
 from splitner.additional_args import AdditionalArguments
 from splitner.cnn import CharCNN
 from splitner.dataset import NerDataset
+from splitner.packing import get_packed_attention_mask, run_per_segment
 
 
 class NerModel(BertPreTrainedModel):
@@ -164,13 +165,21 @@ class NerModel(BertPreTrainedModel):
             pos_tag=None,
             dep_tag=None,
             labels=None,
+            encoder_outputs=None,
+            position_ids=None,
+            segment_ids=None,
+            return_logits=False,
             **kwargs):
 
         batch_size, seq_len = input_ids.shape
-        outputs = self.bert(
+        # encoder_outputs: BERT outputs computed outside (by the early exit model), only the heads are run then.
+        # segment_ids: rows of packed sequences (see packing.py), which only attend within their own segment
+        outputs = encoder_outputs if encoder_outputs is not None else self.bert(
             input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids
+            attention_mask=attention_mask if segment_ids is None else get_packed_attention_mask(attention_mask,
+                                                                                                 segment_ids),
+            token_type_ids=token_type_ids,
+            position_ids=position_ids
         )
         sequence_output = outputs[0]
 
@@ -202,16 +211,7 @@ class NerModel(BertPreTrainedModel):
                 pos_tag_vec = self.pos_emb(pos_tag)
        
                 # LSTM
-                lengths = torch.as_tensor(attention_mask.sum(1).int(), dtype=torch.int64, device=torch.device("cpu"))
-                packed_inp = nn.utils.rnn.pack_padded_sequence(input=pos_tag_vec,
-                                                           lengths=lengths,
-                                                           batch_first=True,
-                                                           enforce_sorted=False)
-                self.pos_lstm.flatten_parameters()
-                packed_out, _ = self.pos_lstm(packed_inp)
-                pos_tag_vec, _ = nn.utils.rnn.pad_packed_sequence(sequence=packed_out,
-                                                              batch_first=True,
-                                                              total_length=seq_len)
+                pos_tag_vec = self.run_lstm(self.pos_lstm, pos_tag_vec, attention_mask, segment_ids)
                 if self.additional_args.lstm_dropout:
                     pos_tag_vec = self.dropout(pos_tag_vec)
 
@@ -250,16 +250,7 @@ class NerModel(BertPreTrainedModel):
             pattern_ids = self.compress_with_head_mask(head_mask, pattern_ids, 0)
             pattern_vec = self.pattern_emb(pattern_ids)
 
-            lengths = torch.as_tensor(attention_mask.sum(1).int(), dtype=torch.int64, device=torch.device("cpu"))
-            packed_inp = nn.utils.rnn.pack_padded_sequence(input=pattern_vec,
-                                                           lengths=lengths,
-                                                           batch_first=True,
-                                                           enforce_sorted=False)
-            self.pattern_lstm.flatten_parameters()
-            packed_out, _ = self.pattern_lstm(packed_inp)
-            pattern_vec, _ = nn.utils.rnn.pad_packed_sequence(sequence=packed_out,
-                                                              batch_first=True,
-                                                              total_length=seq_len)
+            pattern_vec = self.run_lstm(self.pattern_lstm, pattern_vec, attention_mask, segment_ids)
             if self.additional_args.lstm_dropout:
                 pattern_vec = self.dropout(pattern_vec)
             sequence_output = torch.cat([sequence_output, pattern_vec], dim=2)
@@ -269,16 +260,7 @@ class NerModel(BertPreTrainedModel):
             sequence_output = sequence_output.permute(0, 2, 1, 3).reshape(batch_size, seq_len, -1)
 
         if self.additional_args.use_main_lstm:
-            lengths = torch.as_tensor(attention_mask.sum(1).int(), dtype=torch.int64, device=torch.device("cpu"))
-            packed_inp = nn.utils.rnn.pack_padded_sequence(input=sequence_output,
-                                                           lengths=lengths,
-                                                           batch_first=True,
-                                                           enforce_sorted=False)
-            self.main_lstm.flatten_parameters()
-            packed_out, _ = self.main_lstm(packed_inp)
-            sequence_output, _ = nn.utils.rnn.pad_packed_sequence(sequence=packed_out,
-                                                                  batch_first=True,
-                                                                  total_length=seq_len)
+            sequence_output = self.run_lstm(self.main_lstm, sequence_output, attention_mask, segment_ids)
 
         sequence_output = self.dropout(sequence_output)
 
@@ -290,6 +272,9 @@ class NerModel(BertPreTrainedModel):
 
         predictions = torch.argmax(logits, dim=2)
         outputs = (predictions,) + outputs[2:]  # add hidden states and attention if they are here
+        # return_logits: logits as the last output (distillation), gathered like the other outputs under DataParallel
+        if return_logits:
+            outputs = outputs + (logits,)
 
         if labels is not None:
             labels = self.compress_with_head_mask(head_mask, labels, self.ignore_label)
@@ -320,17 +305,35 @@ class NerModel(BertPreTrainedModel):
 
         return outputs  # (loss), scores, (hidden_states), (attentions)
 
+    # bi-LSTM over the unpadded sequences of x. Packed rows are split into their segments first
+    def run_lstm(self, lstm, x, attention_mask, segment_ids=None):
+        if segment_ids is not None:
+            return run_per_segment(lambda segment_x, segment_mask: self.run_lstm(lstm, segment_x, segment_mask), x,
+                                   segment_ids)
+        lengths = torch.as_tensor(attention_mask.sum(1).int(), dtype=torch.int64, device=torch.device("cpu"))
+        packed_inp = nn.utils.rnn.pack_padded_sequence(input=x,
+                                                       lengths=lengths,
+                                                       batch_first=True,
+                                                       enforce_sorted=False)
+        lstm.flatten_parameters()
+        packed_out, _ = lstm(packed_inp)
+        out, _ = nn.utils.rnn.pad_packed_sequence(sequence=packed_out,
+                                                  batch_first=True,
+                                                  total_length=x.shape[1])
+        return out
+
     def compress_with_head_mask(self, head_mask, x, pad_value):
         if not self.additional_args.use_head_mask:
             return x
-        new_x = torch.full(x.shape, fill_value=pad_value, dtype=x.dtype, device=x.device)
-        for i in range(head_mask.shape[0]):
-            k = 0
-            for j in range(head_mask.shape[1]):
-                if head_mask[i, j] == 1:
-                    new_x[i, k] = x[i, j]
-                    k += 1
-        return new_x
+        # moves the head sub-token positions to the front (in order) and pads the rest. Written without python loops
+        # over the batch so that it stays data-dependent when traced for ONNX/TorchScript export
+        seq_len = head_mask.shape[1]
+        positions = torch.arange(seq_len, device=x.device).unsqueeze(0)
+        order = torch.argsort(torch.where(head_mask == 1, positions, positions + seq_len), dim=1)
+        keep = positions < (head_mask == 1).sum(dim=1, keepdim=True)
+        trailing_dims = (1,) * (x.dim() - 2)
+        new_x = torch.gather(x, 1, order.view(order.shape + trailing_dims).expand_as(x))
+        return torch.where(keep.view(keep.shape + trailing_dims), new_x, torch.full_like(new_x, pad_value))
 
     def expand_with_head_mask(self, head_mask, x, pad_value):
         if not self.additional_args.use_head_mask:
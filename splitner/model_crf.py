@@ -89,6 +89,7 @@ class NerModelWithCrf(BertPreTrainedModel):
             pos_tag=None,
             dep_tag=None,
             labels=None,
+            return_logits=False,
             **kwargs):
 
         batch_size, seq_len = input_ids.shape
@@ -148,13 +149,16 @@ class NerModelWithCrf(BertPreTrainedModel):
             sequence_output = sequence_output.permute(0, 2, 1, 3).reshape(batch_size, seq_len, -1)
 
         sequence_output = self.dropout(sequence_output)
-        emissions = log_softmax(self.classifier(sequence_output), dim=-1)
+        logits = self.classifier(sequence_output)
+        emissions = log_softmax(logits, dim=-1)
         crf_attention_mask = attention_mask.type(torch.uint8) if torch.is_tensor(attention_mask) else None
         predictions = self.crf.decode(emissions, crf_attention_mask)
         padded_predictions = [p + [-100] * (input_ids.shape[1] - len(p)) for p in predictions]
         tag_seq = torch.Tensor(padded_predictions).to(dtype=torch.int64, device=input_ids.device)
 
         outputs = (tag_seq,) + outputs[2:]  # add hidden states and attention if they are here
+        if return_logits:
+            outputs = outputs + (logits,)
         if labels is not None:
             crf_labels = labels.clone()
             # since negative indices is not supported by the CRF library
@@ -0,0 +1,99 @@
+import torch
+import torch.nn as nn
+from transformers import BertConfig
+
+from splitner.additional_args import AdditionalArguments
+from splitner.dataset_span import NerSpanDataset
+from splitner.model import NerModel
+
+
+class NerDualModel(NerModel):
+    # span detection (NerModel over the detect_spans QA context) and span classification with one shared BERT encoder.
+    # A mention is represented by the mean of its sub-token states in the detection pass, which goes through the BERT
+    # pooler (like the [CLS] state in NerSpanModel) and the span classifier. So the detected mentions are classified
+    # from the cached encoder outputs of the detection pass, without encoding the sentence again per mention
+
+    def __init__(self, config: BertConfig, additional_args: AdditionalArguments):
+        super(NerDualModel, self).__init__(config, additional_args)
+        self.num_span_labels = len(NerSpanDataset.parse_tag_vocab(additional_args.tag_vocab_path))
+        span_classifier_inp_dim = config.hidden_size
+        if self.additional_args.second_classifier_hidden_sz > 0:
+            self.span_hidden_classifier = nn.Linear(span_classifier_inp_dim,
+                                                    self.additional_args.second_classifier_hidden_sz)
+            self.span_hidden_classifier.apply(self._init_weights)
+            span_classifier_inp_dim = self.additional_args.second_classifier_hidden_sz
+        self.span_classifier = nn.Linear(span_classifier_inp_dim, self.num_span_labels)
+        self.span_classifier.apply(self._init_weights)
+
+    def forward(
+            self,
+            input_ids=None,
+            attention_mask=None,
+            token_type_ids=None,
+            head_mask=None,
+            char_ids=None,
+            pattern_ids=None,
+            flair_ids=None,
+            flair_attention_mask=None,
+            flair_boundary=None,
+            punctuation_vec=None,
+            gold_span_inp=None,
+            word_type_ids=None,
+            pos_tag=None,
+            dep_tag=None,
+            labels=None,
+            span_index=None,
+            span_start=None,
+            span_end=None,
+            span_labels=None,
+            encoder_outputs=None,
+            **kwargs):
+
+        encoder_outputs = encoder_outputs if encoder_outputs is not None else self.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids
+        )
+        outputs = super(NerDualModel, self).forward(input_ids=input_ids,
+                                                    attention_mask=attention_mask,
+                                                    token_type_ids=token_type_ids,
+                                                    head_mask=head_mask,
+                                                    char_ids=char_ids,
+                                                    pattern_ids=pattern_ids,
+                                                    flair_ids=flair_ids,
+                                                    flair_attention_mask=flair_attention_mask,
+                                                    flair_boundary=flair_boundary,
+                                                    punctuation_vec=punctuation_vec,
+                                                    gold_span_inp=gold_span_inp,
+                                                    word_type_ids=word_type_ids,
+                                                    pos_tag=pos_tag,
+                                                    dep_tag=dep_tag,
+                                                    labels=labels,
+                                                    encoder_outputs=encoder_outputs,
+                                                    **kwargs)
+        if span_labels is None:
+            return outputs  # (loss), predictions
+
+        # the span loss is added to the detection loss if labels are given, else it is the only loss
+        logits = self.classify_spans(encoder_outputs[0], span_index, span_start, span_end)
+        if (span_labels != self.ignore_label).any():
+            span_loss = nn.CrossEntropyLoss()(logits, span_labels)
+        else:
+            span_loss = logits.sum() * 0.0
+        if labels is None:
+            return (span_loss,) + outputs
+        return (outputs[0] + self.additional_args.dual_span_weight * span_loss,) + outputs[1:]
+
+    def classify_spans(self, sequence_output, span_index, span_start, span_end):
+        # sequence_output: (batch, seq_len, hidden) BERT outputs. Spans: row, first and last sub-token of each mention
+        positions = torch.arange(sequence_output.shape[1], device=sequence_output.device).unsqueeze(0)
+        mask = ((positions >= span_start.unsqueeze(1)) & (positions <= span_end.unsqueeze(1))).unsqueeze(-1)
+        span_states = (sequence_output[span_index] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        pooled_output = self.bert.pooler(span_states.unsqueeze(1))
+
+        if self.additional_args.second_classifier_hidden_sz > 0:
+            pooled_output = self.dropout(pooled_output)
+            pooled_output = self.span_hidden_classifier(pooled_output)
+
+        pooled_output = self.dropout(pooled_output)
+        return self.span_classifier(pooled_output)
@@ -116,6 +116,7 @@ class NerRobertaModel(RobertaPreTrainedModel):
             pos_tag=None,
             dep_tag=None,
             labels=None,
+            return_logits=False,
             **kwargs):
 
         batch_size, seq_len = input_ids.shape
@@ -219,6 +220,8 @@ class NerRobertaModel(RobertaPreTrainedModel):
 
         predictions = torch.argmax(logits, dim=2)
         outputs = (predictions,) + outputs[2:]  # add hidden states and attention if they are here
+        if return_logits:
+            outputs = outputs + (logits,)
 
         if labels is not None:
             labels = self.compress_with_head_mask(head_mask, labels, self.ignore_label)
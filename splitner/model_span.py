@@ -39,9 +39,11 @@ class NerSpanModel(BertPreTrainedModel):
             attention_mask=None,
             token_type_ids=None,
             labels=None,
+            encoder_outputs=None,
             **kwargs):
 
-        outputs = self.bert(
+        # encoder_outputs: BERT outputs computed outside (by the early exit model), only the heads are run then
+        outputs = encoder_outputs if encoder_outputs is not None else self.bert(
             input_ids,
             attention_mask=attention_mask,
             token_type_ids=token_type_ids
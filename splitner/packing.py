@@ -0,0 +1,105 @@
+import torch
+from torch.utils.data import Dataset
+
+# inference backends running NerModel.forward itself (the others trace it without the packing inputs, or run the
+# encoder outside of it)
+PACKING_BACKENDS = ["torch", "int8", "mmap", "bundle"]
+
+
+def check_packing(additional_args):
+    # packed rows are only equivalent to separate sequences if no layer mixes information along a row other than the
+    # (block-diagonal) encoder attention and the segment-wise LSTMs of NerModel
+    if additional_args.model_mode != "std":
+        raise ValueError("sequence packing is supported for model_mode std only")
+    if additional_args.use_head_mask or additional_args.use_end_cnn or \
+            additional_args.use_char_cnn in ["flair", "both-flair"]:
+        raise ValueError("sequence packing does not support use_head_mask, use_end_cnn or flair embeddings")
+    if additional_args.inference_backend not in PACKING_BACKENDS:
+        raise ValueError("sequence packing needs one of the inference backends: {0}".format(PACKING_BACKENDS))
+
+
+def pack_lengths(lengths, max_len):
+    # first-fit decreasing: rows of indices whose lengths add up to at most max_len (a longer one gets its own row)
+    rows = []
+    space = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        for k in range(len(rows)):
+            if space[k] >= lengths[index]:
+                rows[k].append(index)
+                space[k] -= lengths[index]
+                break
+        else:
+            rows.append([index])
+            space.append(max_len - lengths[index])
+    return rows
+
+
+def pack_features(features, members):
+    # one feature of the given members (indices into features): their per sub-token lists concatenated, with position
+    # ids restarting at 0 and segment ids 1, 2, .. for each member
+    packed = {key: [] for key in features[members[0]].keys()}
+    packed["position_ids"] = []
+    packed["segment_ids"] = []
+    for segment, index in enumerate(members, 1):
+        feature = features[index]
+        num_tokens = len(feature["input_ids"])
+        for key, value in feature.items():
+            if not isinstance(value, list) or len(value) not in [0, num_tokens]:
+                raise ValueError("sequence packing needs per sub-token features, got: {0}".format(key))
+            packed[key].extend(value)
+        packed["position_ids"].extend(range(num_tokens))
+        packed["segment_ids"].extend([segment] * num_tokens)
+    return packed
+
+
+class PackedDataCollator:
+    # collates packed features with a data collator of the unpacked ones, and adds the (padded) position and segment ids
+    def __init__(self, data_collator):
+        self.data_collator = data_collator
+
+    def __call__(self, features):
+        batch = self.data_collator(features)
+        max_len = batch["attention_mask"].shape[1]
+        for key in ["position_ids", "segment_ids"]:
+            batch[key] = torch.tensor([feature[key] + [0] * (max_len - len(feature[key])) for feature in features])
+        return batch
+
+
+class PackedDataset(Dataset):
+    # rows of packed samples of a dataset, with up to max_len sub-tokens each (packed once, over all samples)
+    def __init__(self, dataset, max_len):
+        self.dataset = dataset
+        self.rows = pack_lengths([len(dataset[i]["input_ids"]) for i in range(len(dataset))], max_len)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        members = self.rows[index]
+        return pack_features({i: self.dataset[i] for i in members}, members)
+
+
+def get_packed_attention_mask(attention_mask, segment_ids):
+    # [batch, seq_len, seq_len] encoder attention mask of packed rows: block diagonal, every sub-token attends to the
+    # sub-tokens of its own segment only
+    same_segment = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+    return (same_segment & attention_mask.unsqueeze(1).bool()).long()
+
+
+def run_per_segment(fn, x, segment_ids):
+    # runs a sequence layer fn(x, attention_mask) -> [batch, seq_len, dim] on each segment of the packed rows x
+    # separately (as a batch of the segments), so that no state flows from one packed sequence into the next
+    rows, cols = torch.nonzero(segment_ids > 0, as_tuple=True)
+    keys = rows * (int(segment_ids.max()) + 1) + segment_ids[rows, cols]
+    segments, segment_index = torch.unique(keys, return_inverse=True)
+    starts = torch.full((len(segments),), x.shape[1], dtype=cols.dtype, device=cols.device)
+    starts = starts.scatter_reduce(0, segment_index, cols, reduce="amin")
+    positions = cols - starts[segment_index]
+    segment_x = x.new_zeros((len(segments), int(positions.max()) + 1) + x.shape[2:])
+    segment_x[segment_index, positions] = x[rows, cols]
+    segment_mask = torch.zeros(segment_x.shape[:2], dtype=torch.long, device=x.device)
+    segment_mask[segment_index, positions] = 1
+    segment_out = fn(segment_x, segment_mask)
+    out = segment_out.new_zeros(x.shape[:2] + segment_out.shape[2:])
+    out[rows, cols] = segment_out[segment_index, positions]
+    return out
@@ -0,0 +1,144 @@
+import argparse
+import logging
+import time
+from datetime import timedelta
+
+from splitner.dataset import NerDataset
+from splitner.inference import batched, get_model_fingerprint, get_window_size, load_executor, make_sentence, \
+    spans_from_tags, write_predictions_resumable
+from splitner.prediction_cache import open_prediction_cache
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class SplitNerPipeline:
+    # span detector (QA or sequence tagging executor) followed by the span classifier (NerSpanExecutor). Without a
+    # classifier, the detector is the shared-encoder executor (NerDualExecutor) which predicts the typed tags itself
+    def __init__(self, detector, classifier=None):
+        self.detector = detector
+        self.classifier = classifier
+
+    @staticmethod
+    def from_configs(detector_config, classifier_config, detector_type="qa", inference_backend=None):
+        # inference_backend (torch|int8|onnx|torchscript|early_exit) overrides the backend set in both configs
+        detector = load_executor(detector_config, detector_type, inference_backend=inference_backend)
+        if detector_type == "dual":
+            return SplitNerPipeline(detector)
+        classifier = load_executor(classifier_config, "span", inference_backend=inference_backend)
+        return SplitNerPipeline(detector, classifier)
+
+    @staticmethod
+    def from_bundle(bundle_path):
+        # single-file bundle written by bundle.py (memory-mapped weights, no checkpoints/configs/corpora needed)
+        from splitner.bundle import load_bundle
+        return load_bundle(bundle_path)
+
+    @staticmethod
+    def from_args(args):
+        if args.bundle:
+            pipeline = SplitNerPipeline.from_bundle(args.bundle)
+        elif not args.detector_config or (not args.classifier_config and args.detector_type != "dual"):
+            raise ValueError("either --bundle or both --detector_config and --classifier_config are required")
+        else:
+            pipeline = SplitNerPipeline.from_configs(args.detector_config, args.classifier_config, args.detector_type,
+                                                     getattr(args, "inference_backend", None))
+        if getattr(args, "dedup", False):
+            pipeline.set_dedup(True)
+        if getattr(args, "prediction_cache", None):
+            pipeline.set_prediction_cache(args.prediction_cache)
+        return pipeline
+
+    def get_executors(self):
+        return [executor for executor in [self.detector, self.classifier] if executor is not None]
+
+    def set_dedup(self, dedup_inputs):
+        # repeated sentences (detector) and sentence and mention pairs (classifier) are predicted once
+        for executor in self.get_executors():
+            executor.additional_args.dedup_inputs = dedup_inputs
+
+    def set_prediction_cache(self, path):
+        # one cache file for both stages, the entries are keyed by the model fingerprint
+        for executor in self.get_executors():
+            executor.additional_args.prediction_cache_path = path
+            executor.prediction_cache = open_prediction_cache(executor.additional_args)
+
+    # yields the typed [start, end, type] mention spans for each sentence (list of token texts or Sentence)
+    def predict_spans_iter(self, sentences, batch_size=None):
+        for tags in self.predict_iter(sentences, batch_size):
+            yield spans_from_tags(tags)
+
+    # yields the final BIO tags for each sentence, both stages run batch by batch over the input
+    def predict_iter(self, sentences, batch_size=None):
+        # with an inference_token_budget, larger windows of sentences are batched by length in both stages
+        batch_size = get_window_size(self.detector, batch_size)
+        if self.classifier is None:
+            yield from self.detector.predict_iter(sentences, batch_size)
+            return
+        none_tag = self.classifier.additional_args.none_tag
+        for batch in batched(sentences, batch_size):
+            batch = [make_sentence(sent, none_tag) for sent in batch]
+            detected = [[sp[:2] for sp in spans_from_tags(tags)]
+                        for tags in self.detector.predict_iter(batch, batch_size)]
+            for tags in self.classifier.predict_iter(zip(batch, detected), batch_size):
+                yield tags
+
+
+def main(args):
+    setup_logging()
+    pool = None
+    if args.workers > 0:
+        # forked CPU inference workers sharing the weights loaded here (see worker_pool.py)
+        from splitner.worker_pool import WorkerPool
+        pool = WorkerPool(lambda: SplitNerPipeline.from_args(args), args.workers, args.threads_per_worker,
+                          affinity=args.affinity)
+        pipeline = pool.pipeline
+    else:
+        pipeline = SplitNerPipeline.from_args(args)
+    sentences = NerDataset.read_dataset(args.input, pipeline.detector.additional_args)
+
+    start = time.time()
+    predictor = pool if pool is not None else pipeline
+    batch_size = args.batch_size or pipeline.detector.train_args.per_device_eval_batch_size
+    fingerprint = [get_model_fingerprint(executor.additional_args) for executor in pipeline.get_executors()]
+    write_predictions_resumable(args.output, sentences, sentences,
+                                lambda batch: predictor.predict_iter(batch, batch_size), args.chunk_size, fingerprint)
+    if pool is not None:
+        pool.close()
+    else:
+        for executor in pipeline.get_executors():
+            if args.dedup:
+                logger.info("{0} deduplication: {1}".format(type(executor).__name__, executor.deduplicator))
+            if executor.prediction_cache is not None:
+                logger.info("{0} prediction cache: {1}".format(type(executor).__name__, executor.prediction_cache))
+        if pipeline.classifier is not None and pipeline.classifier.gazetteer is not None:
+            logger.info("gazetteer: {0}".format(pipeline.classifier.gazetteer))
+    elapsed = time.time() - start
+    logger.info("elapsed time: {0} seconds: {1}".format(str(elapsed), str(timedelta(seconds=elapsed))))
+    logger.info("Outputs published in file: {0}".format(args.output))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Pipeline (span detection + span classification)")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--inference_backend", type=str, default=None,
+                    help="inference backend for both models (torch|int8|onnx|torchscript|early_exit), overrides the configs")
+    ap.add_argument("--input", type=str, required=True, help="input file in dataset (TSV) format")
+    ap.add_argument("--output", type=str, required=True, help="output predictions file (token, gold, predicted)")
+    ap.add_argument("--batch_size", type=int, default=None, help="sentences per batch (default: eval batch size)")
+    ap.add_argument("--chunk_size", type=int, default=1000,
+                    help="sentences per journaled chunk, an interrupted run continues with the first unfinished chunk "
+                         "(0: single pass without journal)")
+    ap.add_argument("--dedup", dest="dedup", action="store_true",
+                    help="predict repeated sentences and sentence and mention pairs once (dedup_inputs)")
+    ap.add_argument("--prediction_cache", type=str, default=None,
+                    help="SQLite file caching the predictions of both models across runs (prediction_cache_path)")
+    ap.add_argument("--workers", type=int, default=0, help="forked CPU inference workers sharing the model weights")
+    ap.add_argument("--threads_per_worker", type=int, default=1,
+                    help="workers: intra-op (torch) threads of each worker (0: auto, cores split between workers)")
+    ap.add_argument("--affinity", dest="affinity", action="store_true", help="workers: pin each worker to its cores")
+    ap = ap.parse_args()
+    main(ap)
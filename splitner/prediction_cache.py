@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# settings (besides the model weights) which change the decoded predictions of a model
+FINGERPRINT_FIELDS = ["tagging", "none_tag", "max_seq_len", "punctuation_handling", "word_type_handling", "model_mode",
+                      "token_type", "prediction_mapping", "pattern_type", "add_qa_helper_sentence", "query_type",
+                      "detect_spans", "use_pos_tag", "use_dep_tag", "window_stride", "span_context_words",
+                      "inference_backend", "bundle_stage", "early_exit_threshold", "early_exit_mode"]
+
+# files of a model dir which change its predictions: config, weights and tokenizer vocabulary. Artifacts derived and
+# written into the dir later (pytorch_model.mmap, gazetteer.json, exports) are left out
+MODEL_FILE_NAMES = ["config.json", "pytorch_model.bin", "model.safetensors", "vocab.txt", "vocab.json", "merges.txt",
+                    "tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "added_tokens.json"]
+
+# host parameters per SQLite statement (the default limit of older versions is 999)
+MAX_PARAMS = 500
+
+
+def get_model_files(path):
+    # [name, size, mtime] of a model file or the model files of a model directory, so that a checkpoint retrained at the
+    # same path gets another fingerprint
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [[os.path.basename(path), stat.st_size, stat.st_mtime_ns]]
+    if os.path.isdir(path):
+        return sorted([entry.name, entry.stat().st_size, entry.stat().st_mtime_ns] for entry in os.scandir(path)
+                      if entry.is_file() and entry.name in MODEL_FILE_NAMES)
+    return []
+
+
+def get_cache_fingerprint(additional_args):
+    model_path = additional_args.bundle_path if additional_args.inference_backend == "bundle" else \
+        additional_args.resume or additional_args.base_model
+    fingerprint = [model_path, get_model_files(model_path)]
+    fingerprint.extend(getattr(additional_args, name) for name in FINGERPRINT_FIELDS)
+    # the entity types and their queries (QA contexts)
+    if additional_args.tag_names_path and os.path.isfile(additional_args.tag_names_path):
+        with open(additional_args.tag_names_path, "r", encoding="utf-8") as f:
+            fingerprint.append(f.read())
+    return hashlib.sha1(json.dumps(fingerprint).encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    # persistent (SQLite) cache of decoded predictions of a model (fingerprint), shared by runs and processes. Entries
+    # are keyed by a content hash, values are stored as JSON. Beyond max_entries, the least recently used tenth of the
+    # entries is evicted
+    def __init__(self, path, max_entries, fingerprint):
+        self.path = path
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+        self.connection = None
+        self.pid = None
+        # entries as of the last count plus those inserted since
+        self.num_entries = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def connect(self):
+        # one connection per process, a connection does not survive a fork
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                                        "(key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+            self.num_entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            self.pid = os.getpid()
+        return self.connection
+
+    def make_key(self, content):
+        return hashlib.sha1(json.dumps([self.fingerprint, content]).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        # {key: value} of the keys found, which are marked as used
+        connection = self.connect()
+        found = dict()
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), MAX_PARAMS):
+            part = unique_keys[start:start + MAX_PARAMS]
+            rows = connection.execute("SELECT key, value FROM predictions WHERE key IN ({0})"
+                                      .format(",".join(["?"] * len(part))), part).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        if len(found) > 0:
+            now = time.time()
+            with connection:
+                connection.executemany("UPDATE predictions SET used = ? WHERE key = ?", [(now, key) for key in found])
+        self.lookups += len(keys)
+        self.hits += sum(int(key in found) for key in keys)
+        return found
+
+    def put_many(self, items):
+        connection = self.connect()
+        now = time.time()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO predictions (key, value, used) VALUES (?, ?, ?)",
+                                   [(key, json.dumps(value), now) for key, value in items.items()])
+            self.num_entries += len(items)
+            if self.num_entries > self.max_entries:
+                self.num_entries = connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+                if self.num_entries > self.max_entries:
+                    excess = self.num_entries - self.max_entries * 9 // 10
+                    connection.execute("DELETE FROM predictions WHERE key IN "
+                                       "(SELECT key FROM predictions ORDER BY used LIMIT ?)", (excess,))
+                    self.num_entries -= excess
+
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
+
+    def __str__(self):
+        return "lookups: {0} | hits: {1} | hit rate: {2:.3f}".format(self.lookups, self.hits, self.hit_rate())
+
+
+def open_prediction_cache(additional_args):
+    # prediction cache of a model (prediction_cache_path), None without one
+    if not additional_args.prediction_cache_path:
+        return None
+    return PredictionCache(additional_args.prediction_cache_path, additional_args.prediction_cache_size,
+                           get_cache_fingerprint(additional_args))
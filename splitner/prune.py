@@ -0,0 +1,169 @@
+import argparse
+import dataclasses
+import io
+import logging
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+from splitner.distill import select_encoder_layers
+from splitner.inference import evaluate_dataset, get_artifact_dir, load_executor
+from splitner.trainer import NerTrainer
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def dev_batches(executor):
+    dataset = executor.dev_dataset
+    loader = DataLoader(dataset, batch_size=executor.train_args.per_device_eval_batch_size,
+                        collate_fn=executor.trainer.data_collator)
+    for batch in loader:
+        yield {k: v.to(executor.train_args.device) for k, v in batch.items()}
+
+
+def dev_loss(executor, model):
+    total_loss = 0.0
+    num_batches = 0
+    with torch.no_grad():
+        for batch in dev_batches(executor):
+            total_loss += model(**batch)[0].item()
+            num_batches += 1
+    return total_loss / max(num_batches, 1)
+
+
+def score_layers(executor, model):
+    # importance of a layer: increase of the dev loss when the layer is removed
+    layers = model.base_model.encoder.layer
+    base_loss = dev_loss(executor, model)
+    scores = []
+    for i in range(len(layers)):
+        model.base_model.encoder.layer = torch.nn.ModuleList([layer for j, layer in enumerate(layers) if j != i])
+        scores.append(dev_loss(executor, model) - base_loss)
+    model.base_model.encoder.layer = layers
+    return scores
+
+
+def score_heads(executor, model):
+    # importance of a head (Michel et al., 2019): |d dev loss / d gate| of a gate multiplying the head's output
+    gates = []
+    handles = []
+    for layer in model.base_model.encoder.layer:
+        attention = layer.attention.self
+        gate = torch.ones(attention.num_attention_heads, device=executor.train_args.device, requires_grad=True)
+        gates.append(gate)
+        handles.append(attention.register_forward_hook(
+            lambda module, inp, out, gate=gate: (out[0] * gate.repeat_interleave(module.attention_head_size),)
+                                                + tuple(out[1:])))
+
+    requires_grad = [param.requires_grad for param in model.parameters()]
+    for param in model.parameters():
+        param.requires_grad = False
+    scores = [torch.zeros_like(gate) for gate in gates]
+    for batch in dev_batches(executor):
+        loss = model(**batch)[0]
+        grads = torch.autograd.grad(loss, gates)
+        for score, grad in zip(scores, grads):
+            score += grad.abs()
+
+    for param, flag in zip(model.parameters(), requires_grad):
+        param.requires_grad = flag
+    for handle in handles:
+        handle.remove()
+    # normalized per layer, so that scores are comparable across layers
+    return [(score / (score.norm() + 1e-20)).tolist() for score in scores]
+
+
+def select_heads_to_prune(head_scores, prune_ratio):
+    # least important heads over all layers, keeping at least one head in every layer
+    candidates = sorted((score, layer, head) for layer, scores in enumerate(head_scores)
+                        for head, score in enumerate(scores))
+    num_prune = int(prune_ratio * len(candidates))
+    remaining = [len(scores) for scores in head_scores]
+    heads_to_prune = dict()
+    for score, layer, head in candidates:
+        if num_prune == 0:
+            break
+        if remaining[layer] > 1:
+            heads_to_prune.setdefault(layer, []).append(head)
+            remaining[layer] -= 1
+            num_prune -= 1
+    return heads_to_prune
+
+
+def recovery_fine_tune(executor, model, output_dir, num_epochs):
+    train_args = dataclasses.replace(executor.train_args,
+                                     output_dir=os.path.join(output_dir, "recovery"),
+                                     num_train_epochs=num_epochs,
+                                     evaluation_strategy="no",
+                                     load_best_model_at_end=False,
+                                     do_train=True)
+    trainer = NerTrainer(model=model,
+                         args=train_args,
+                         tokenizer=executor.trainer.tokenizer,
+                         data_collator=executor.trainer.data_collator,
+                         train_dataset=executor.train_dataset,
+                         eval_dataset=executor.dev_dataset,
+                         compute_metrics=executor.compute_metrics)
+    trainer.train()
+    return model.eval()
+
+
+def get_model_size(model):
+    # no. of parameters, serialized size in MB
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return sum(param.numel() for param in model.parameters()), buffer.tell() / (1024 * 1024)
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    model = executor.model.eval()
+
+    orig_params, orig_size = get_model_size(model)
+    orig_f1, orig_time = evaluate_dataset(executor, executor.test_dataset)
+
+    if args.num_drop_layers > 0:
+        layer_scores = score_layers(executor, model)
+        logger.info("layer importance (dev loss increase): {0}".format(["{0:.4f}".format(s) for s in layer_scores]))
+        drop = sorted(range(len(layer_scores)), key=lambda i: layer_scores[i])[:args.num_drop_layers]
+        keep = [i for i in range(len(layer_scores)) if i not in drop]
+        logger.info("dropping layers: {0}".format(sorted(drop)))
+        select_encoder_layers(model, keep)
+
+    if args.head_prune_ratio > 0:
+        # scored after dropping layers, so that the scores reflect the remaining network
+        heads_to_prune = select_heads_to_prune(score_heads(executor, model), args.head_prune_ratio)
+        logger.info("pruning heads: {0}".format(heads_to_prune))
+        model.prune_heads(heads_to_prune)
+
+    output_dir = os.path.join(get_artifact_dir(executor.additional_args), "pruned")
+    if args.recovery_epochs > 0:
+        model = recovery_fine_tune(executor, model, output_dir, args.recovery_epochs)
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir)
+    executor.trainer.tokenizer.save_pretrained(output_dir)
+    logger.info("pruned model saved in: {0}".format(output_dir))
+
+    executor.model = model
+    pruned_params, pruned_size = get_model_size(model)
+    pruned_f1, pruned_time = evaluate_dataset(executor, executor.test_dataset)
+    logger.info("original | params: {0} | size: {1:.1f}MB | test F1: {2:.4f} | time: {3:.2f}s"
+                .format(orig_params, orig_size, 100.0 * orig_f1, orig_time))
+    logger.info("pruned   | params: {0} | size: {1:.1f}MB | test F1: {2:.4f} | time: {3:.2f}s"
+                .format(pruned_params, pruned_size, 100.0 * pruned_f1, pruned_time))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Layer Dropping and Attention Head Pruning")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--num_drop_layers", type=int, default=0, help="no. of least important encoder layers to drop")
+    ap.add_argument("--head_prune_ratio", type=float, default=0.0, help="fraction of least important heads to prune")
+    ap.add_argument("--recovery_epochs", type=float, default=0, help="recovery fine-tuning epochs (0: none)")
+    ap = ap.parse_args()
+    main(ap)
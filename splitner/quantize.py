@@ -0,0 +1,83 @@
+import argparse
+import io
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+from splitner.inference import evaluate_dataset, get_artifact_dir, load_executor
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_WEIGHTS_NAME = "pytorch_model.int8.bin"
+
+
+def quantize_model(model):
+    # post-training dynamic quantization: int8 weights, activations quantized on the fly. Covers all BERT/RoBERTa
+    # linear layers, classifier heads and the LSTMs (embeddings and char/pattern CNN convolutions stay in fp32)
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def get_quantized_dir(additional_args):
+    return os.path.join(get_artifact_dir(additional_args), "int8")
+
+
+def save_quantized_model(model, additional_args):
+    output_dir = get_quantized_dir(additional_args)
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    torch.save(model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+    return output_dir
+
+
+def load_quantized_model(model_class, config, additional_args):
+    # quantized modules have a different structure, so the (randomly initialized) fp32 model is quantized first and
+    # then receives the saved int8 weights
+    weights_path = os.path.join(get_quantized_dir(additional_args), QUANTIZED_WEIGHTS_NAME)
+    logger.info("loading int8 model from: {0}".format(weights_path))
+    model = quantize_model(model_class(config, additional_args))
+    model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    return model
+
+
+def get_model_size(model):
+    # size of the serialized weights in MB
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+def main(args):
+    setup_logging()
+    # dynamically quantized kernels run on CPU only (use "no_cuda": true in the config or CUDA_VISIBLE_DEVICES=)
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    dataset = executor.test_dataset
+
+    fp32_model = executor.model
+    fp32_f1, fp32_time = evaluate_dataset(executor, dataset)
+    fp32_size = get_model_size(fp32_model)
+
+    output_dir = save_quantized_model(quantize_model(fp32_model), executor.additional_args)
+    logger.info("int8 model saved in: {0}".format(output_dir))
+
+    # evaluate the saved artifact (exactly what "inference_backend": "int8" loads)
+    executor.model = load_quantized_model(type(fp32_model), fp32_model.config, executor.additional_args)
+    int8_f1, int8_time = evaluate_dataset(executor, dataset)
+    int8_size = get_model_size(executor.model)
+
+    logger.info("fp32 | F1: {0:.4f} | time: {1:.2f}s | size: {2:.1f}MB".format(100.0 * fp32_f1, fp32_time, fp32_size))
+    logger.info("int8 | F1: {0:.4f} | time: {1:.2f}s | size: {2:.1f}MB".format(100.0 * int8_f1, int8_time, int8_size))
+    logger.info("F1 delta: {0:+.4f} | speedup: {1:.2f}x | size reduction: {2:.2f}x"
+                .format(100.0 * (int8_f1 - fp32_f1), fp32_time / int8_time, fp32_size / int8_size))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Dynamic int8 Quantization")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap = ap.parse_args()
+    main(ap)
@@ -0,0 +1,135 @@
+import gc
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from splitner.pipeline import SplitNerPipeline
+from splitner.utils.general import read_memory_stats
+
+logger = logging.getLogger(__name__)
+
+# a model entry: configs of the two stages (as for SplitNerPipeline.from_configs) or a bundle (bundle.py)
+SPEC_KEYS = ["detector_config", "classifier_config", "detector_type", "inference_backend", "bundle"]
+
+
+def load_specs(registry_path):
+    # registry file: {"<name>": {"detector_config": ..., "classifier_config": ...}, "<name>": {"bundle": ...}, ...}
+    with open(registry_path, "r", encoding="utf-8") as f:
+        specs = json.load(f)
+    for name, spec in specs.items():
+        unknown = set(spec.keys()) - set(SPEC_KEYS)
+        if unknown:
+            raise ValueError("model {0}: unknown keys {1} (expected: {2})".format(name, sorted(unknown), SPEC_KEYS))
+        if not spec.get("bundle") and not spec.get("detector_config"):
+            raise ValueError("model {0}: either bundle or detector_config is required".format(name))
+    return specs
+
+
+def load_pipeline(spec):
+    if spec.get("bundle"):
+        return SplitNerPipeline.from_bundle(spec["bundle"])
+    return SplitNerPipeline.from_configs(spec["detector_config"], spec.get("classifier_config"),
+                                         spec.get("detector_type", "qa"), spec.get("inference_backend"))
+
+
+def get_weights_size(pipeline):
+    # parameters and buffers of both stages in MB (0 for the ONNX backend, whose weights live in the ORT session)
+    num_bytes = 0
+    for executor in [pipeline.detector, pipeline.classifier]:
+        if executor is not None:
+            num_bytes += sum(t.numel() * t.element_size() for t in executor.model.state_dict().values())
+    return num_bytes / (1024 * 1024)
+
+
+class ModelRegistry:
+    # pipelines of several models (eg. one per dataset), loaded on first use. At most max_resident pipelines are kept in
+    # memory, the least recently used one is evicted to make room. An evicted pipeline which is still predicting is
+    # freed once its last prediction returns
+    def __init__(self, specs, max_resident=2):
+        if max_resident < 1:
+            raise ValueError("max_resident should be at least 1")
+        self.specs = specs
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+        self.lock = threading.Lock()
+        # loads are serialized (a load can be followed by an eviction), lookups of resident models never wait on them
+        self.load_lock = threading.Lock()
+        self.stats = {name: {"loads": 0, "evictions": 0, "hits": 0, "load_time": 0.0, "weights_mb": None,
+                             "load_rss_mb": None} for name in specs}
+
+    @staticmethod
+    def from_file(registry_path, max_resident=2):
+        return ModelRegistry(load_specs(registry_path), max_resident)
+
+    def names(self):
+        return list(self.specs.keys())
+
+    def lookup(self, name):
+        with self.lock:
+            pipeline = self.resident.get(name)
+            if pipeline is not None:
+                self.resident.move_to_end(name)
+                self.stats[name]["hits"] += 1
+            return pipeline
+
+    def get(self, name):
+        if name not in self.specs:
+            raise KeyError("unknown model: {0}".format(name))
+        pipeline = self.lookup(name)
+        if pipeline is not None:
+            return pipeline
+        with self.load_lock:
+            # loaded by another thread meanwhile
+            pipeline = self.lookup(name)
+            if pipeline is not None:
+                return pipeline
+            self.evict(self.max_resident - 1)
+            rss = read_memory_stats()["rss"]
+            start = time.time()
+            pipeline = load_pipeline(self.specs[name])
+            elapsed = time.time() - start
+            with self.lock:
+                self.resident[name] = pipeline
+                stats = self.stats[name]
+                stats["loads"] += 1
+                stats["load_time"] += elapsed
+                stats["weights_mb"] = get_weights_size(pipeline)
+                # process growth while loading: weights plus everything else the model needs (tokenizer, vocabularies).
+                # Memory-mapped weights (mmap/bundle backends) are only counted once they are used
+                stats["load_rss_mb"] = read_memory_stats()["rss"] - rss
+            logger.info("loaded model {0} in {1:.2f}s ({2:.1f}MB weights, {3:.1f}MB RSS)"
+                        .format(name, elapsed, stats["weights_mb"], stats["load_rss_mb"]))
+            return pipeline
+
+    def evict(self, keep):
+        # evicts least recently used pipelines until at most keep are resident
+        evicted = []
+        with self.lock:
+            while len(self.resident) > keep:
+                # the pipeline is not bound to a local name, so that it is collected below
+                name = self.resident.popitem(last=False)[0]
+                self.stats[name]["evictions"] += 1
+                evicted.append(name)
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logger.info("evicted models: {0}".format(evicted))
+
+    def get_stats(self):
+        with self.lock:
+            models = {name: dict(stats, resident=name in self.resident) for name, stats in self.stats.items()}
+            resident = list(self.resident.keys())
+        return {"max_resident": self.max_resident,
+                # least recently used first
+                "resident": resident,
+                "resident_weights_mb": sum(models[name]["weights_mb"] for name in resident),
+                "rss_mb": read_memory_stats()["rss"],
+                "loads": sum(stats["loads"] for stats in models.values()),
+                "evictions": sum(stats["evictions"] for stats in models.values()),
+                "hits": sum(stats["hits"] for stats in models.values()),
+                "models": models}
@@ -0,0 +1,225 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from splitner.pipeline import SplitNerPipeline
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class PendingRequest:
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.num_tokens = sum(len(sent) for sent in sentences)
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    # coalesces concurrent requests into one model batch. A batch is closed when adding the next request would exceed
+    # max_batch_tokens (word tokens) or when max_wait_ms have passed since its first request arrived
+    def __init__(self, predict_fn, max_wait_ms=10, max_batch_tokens=2048):
+        self.predict_fn = predict_fn
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = queue.Queue()
+        self.carry = None
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "sentences": 0, "tokens": 0, "batches": 0, "errors": 0}
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, sentences):
+        request = PendingRequest(sentences)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        first = self.carry if self.carry is not None else self.queue.get()
+        self.carry = None
+        batch = [first]
+        num_tokens = first.num_tokens
+        deadline = time.time() + self.max_wait
+        while num_tokens < self.max_batch_tokens:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if num_tokens + request.num_tokens > self.max_batch_tokens:
+                # does not fit anymore, opens the next batch
+                self.carry = request
+                break
+            batch.append(request)
+            num_tokens += request.num_tokens
+        return batch, num_tokens
+
+    def loop(self):
+        while True:
+            batch, num_tokens = self.next_batch()
+            sentences = [sent for request in batch for sent in request.sentences]
+            try:
+                outputs = list(self.predict_fn(sentences))
+                k = 0
+                for request in batch:
+                    request.result = outputs[k:k + len(request.sentences)]
+                    k += len(request.sentences)
+            except Exception as e:
+                logger.exception("batch prediction failed")
+                for request in batch:
+                    request.error = e
+                with self.stats_lock:
+                    self.stats["errors"] += 1
+            for request in batch:
+                request.done.set()
+            with self.stats_lock:
+                self.stats["requests"] += len(batch)
+                self.stats["sentences"] += len(sentences)
+                self.stats["tokens"] += num_tokens
+                self.stats["batches"] += 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["avg_requests_per_batch"] = stats["requests"] / max(stats["batches"], 1)
+        stats["avg_tokens_per_batch"] = stats["tokens"] / max(stats["batches"], 1)
+        return stats
+
+    def for_model(self, name):
+        # a single pipeline serves all requests
+        return self
+
+
+class RegistryBatcher:
+    # multi-model serving: one MicroBatcher per model of the registry (a batch never mixes models), created on the
+    # first request for the model. The pipeline is looked up per batch, so the registry loads and evicts it as needed
+    def __init__(self, registry, **batcher_args):
+        self.registry = registry
+        self.batcher_args = batcher_args
+        self.batchers = dict()
+        self.lock = threading.Lock()
+
+    def for_model(self, name):
+        if name not in self.registry.specs:
+            raise ValueError("unknown model: {0} (available: {1})".format(name, self.registry.names()))
+        with self.lock:
+            if name not in self.batchers:
+                predict_fn = lambda sentences: self.registry.get(name).predict_spans_iter(sentences,
+                                                                                          batch_size=len(sentences))
+                self.batchers[name] = MicroBatcher(predict_fn, **self.batcher_args)
+            return self.batchers[name]
+
+    def get_stats(self):
+        with self.lock:
+            batchers = dict(self.batchers)
+        return {"registry": self.registry.get_stats(),
+                "batching": {name: batcher.get_stats() for name, batcher in batchers.items()}}
+
+
+class NerHTTPServer(ThreadingHTTPServer):
+    # default listen backlog (5) resets connections under concurrent load
+    request_queue_size = 128
+
+
+class NerRequestHandler(BaseHTTPRequestHandler):
+    # set on the server class before starting (MicroBatcher or RegistryBatcher)
+    batcher: MicroBatcher = None
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self.send_json(200, self.batcher.get_stats())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    # request: {"sentences": [["token", ...], ...]} (a sentence may also be a whitespace separated string). With a
+    # model registry, the request also names the model: {"model": "<name>", "sentences": ...}
+    # response: {"spans": [[{"start": 0, "end": 1, "type": "person", "mention": "..."}, ...], ...]}
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            sentences = [sent.split() if isinstance(sent, str) else list(sent) for sent in payload["sentences"]]
+            batcher = self.batcher.for_model(payload.get("model"))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "bad request: {0}".format(e)})
+            return
+        if len(sentences) == 0:
+            self.send_json(200, {"spans": []})
+            return
+        try:
+            outputs = batcher.submit(sentences)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        spans = [[{"start": start, "end": end, "type": tag, "mention": " ".join(sent[start:end + 1])}
+                  for start, end, tag in sent_spans] for sent, sent_spans in zip(sentences, outputs)]
+        self.send_json(200, {"spans": spans})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main(args):
+    setup_logging()
+    if args.registry:
+        from splitner.registry import ModelRegistry
+        registry = ModelRegistry.from_file(args.registry, args.max_resident)
+        batcher = RegistryBatcher(registry, max_wait_ms=args.max_wait_ms, max_batch_tokens=args.max_batch_tokens)
+        logger.info("serving models: {0} (at most {1} resident)".format(registry.names(), args.max_resident))
+    else:
+        pipeline = SplitNerPipeline.from_args(args)
+        # the whole coalesced batch goes through each model stage as a single forward pass
+        batcher = MicroBatcher(lambda sentences: pipeline.predict_spans_iter(sentences, batch_size=len(sentences)),
+                               max_wait_ms=args.max_wait_ms,
+                               max_batch_tokens=args.max_batch_tokens)
+    NerRequestHandler.batcher = batcher
+    server = NerHTTPServer((args.host, args.port), NerRequestHandler)
+    logger.info("serving on http://{0}:{1} (POST /predict, GET /stats, GET /health)".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("batching stats: {0}".format(batcher.get_stats()))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Inference Server")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--registry", type=str, default=None,
+                    help="model registry json file (registry.py) to serve several models, replaces the configs")
+    ap.add_argument("--max_resident", type=int, default=2, help="registry: max models kept in memory (LRU eviction)")
+    ap.add_argument("--host", type=str, default="127.0.0.1", help="host to bind")
+    ap.add_argument("--port", type=int, default=8000, help="port to bind")
+    ap.add_argument("--max_wait_ms", type=float, default=10, help="max time a request waits for others to batch with")
+    ap.add_argument("--max_batch_tokens", type=int, default=2048, help="max word tokens per coalesced batch")
+    ap = ap.parse_args()
+    main(ap)
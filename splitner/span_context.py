@@ -0,0 +1,36 @@
+import argparse
+import logging
+
+from splitner.inference import evaluate_dataset, load_executor
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, "span", inference_only=False)
+    dataset = executor.test_dataset
+    num_mentions = len(dataset)
+
+    for context_words in [int(n) for n in args.context_words.split(",")]:
+        # predict_iter prepares the contexts with the current setting
+        executor.additional_args.span_context_words = context_words
+        chunk = dataset.make_chunk(dataset.sentences, dataset.sentence_spans)
+        num_tokens = sum(len(context.bert_tokens) for context in chunk.contexts)
+        # warm-up (first forward passes allocate and initialize the thread pools)
+        list(executor.predict_iter(list(zip(dataset.sentences, dataset.sentence_spans))[:args.warmup]))
+        f1, elapsed = evaluate_dataset(executor, dataset)
+        logger.info("context words: {0} | sub-tokens per mention: {1:.1f} | micro F1: {2:.4f} | time: {3:.2f}s "
+                    "({4:.1f} mentions/s)".format(context_words or "all", num_tokens / max(num_mentions, 1), f1,
+                                                  elapsed, num_mentions / elapsed))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Span Classification Context Window Sweep")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained span classifier")
+    ap.add_argument("--context_words", type=str, default="0,8,16,32",
+                    help="comma separated span_context_words to compare (0: whole sentence)")
+    ap.add_argument("--warmup", type=int, default=16, help="sentences predicted before each timed run")
+    ap = ap.parse_args()
+    main(ap)
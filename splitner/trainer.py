@@ -1,14 +1,167 @@
+import logging
 import os
+import random
 import re
 from pathlib import Path
+import torch
+from torch.utils.data import DataLoader, RandomSampler, Sampler
 from transformers.trainer import Trainer, PREFIX_CHECKPOINT_DIR
+from transformers.trainer_utils import EvalPrediction
 # from transformers import Trainer, PREFIX_CHECKPOINT_DIR
 from typing import List
 
+from splitner.packing import PackedDataCollator, PackedDataset, check_packing
+from splitner.windows import WindowedDataset
+
+logger = logging.getLogger(__name__)
+
+
+def get_padding_efficiency(lengths, batches):
+    # share of real tokens in the padded batches (batch size x longest sample, as padded by the data collators)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return sum(lengths[i] for batch in batches for i in batch) / max(padded, 1)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    # batches of sample indices with up to max_tokens padded tokens each. Every epoch, the shuffled samples are cut into
+    # buckets of bucket_size samples, each bucket is sorted by length and cut into batches, and the batches of all
+    # buckets are shuffled. The no. of batches is rounded up to a multiple of the gradient accumulation steps (by
+    # splitting the largest batches), so that every epoch ends with a full optimizer step. It is also kept at least at
+    # the first epoch's count, which the trainer's step schedule is computed from
+    def __init__(self, lengths, max_tokens, bucket_size=1024, accumulation_steps=1, seed=42, batch_size=None):
+        super(TokenBudgetBatchSampler, self).__init__(None)
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.accumulation_steps = accumulation_steps
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+        self.min_batches = 0
+        # padding efficiency of random batches of batch_size samples (the default sampler), for comparison
+        self.baseline_efficiency = None
+        if batch_size:
+            order = list(range(len(lengths)))
+            random.Random(seed).shuffle(order)
+            batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+            self.baseline_efficiency = get_padding_efficiency(lengths, batches)
+
+    def make_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        order = list(range(len(self.lengths)))
+        rng.shuffle(order)
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            # stable sort: random order among equal lengths
+            bucket = sorted(order[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            batch = []
+            for index in bucket:
+                # sorted ascending: the current sample is the longest of the batch
+                if len(batch) > 0 and (len(batch) + 1) * self.lengths[index] > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if len(batch) > 0:
+                batches.append(batch)
+        while (len(batches) % self.accumulation_steps != 0 or len(batches) < self.min_batches) and \
+                max(len(batch) for batch in batches) > 1:
+            batch = batches.pop(max(range(len(batches)), key=lambda k: len(batches[k])))
+            batches.extend([batch[:len(batch) // 2], batch[len(batch) // 2:]])
+        self.min_batches = max(self.min_batches, len(batches))
+        rng.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        # batches of the coming epoch (the trainer asks for the epoch length before iterating)
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        batches = self.batches
+        logger.info("token budget batches: epoch {0} | batches: {1} | samples per batch: {2:.1f} | padding "
+                    "efficiency: {3:.3f} (random batches: {4})"
+                    .format(self.epoch, len(batches), len(self.lengths) / max(len(batches), 1),
+                            get_padding_efficiency(self.lengths, batches),
+                            "{0:.3f}".format(self.baseline_efficiency) if self.baseline_efficiency else "-"))
+        self.batches = None
+        self.epoch += 1
+        return iter(batches)
+
 
 class NerTrainer(Trainer):
     def __init__(self, **kwargs):
         super(NerTrainer, self).__init__(**kwargs)
+        # windows of the dataset being evaluated (window_stride), their predictions are merged before the metrics
+        self.eval_windows = None
+        self.sample_metrics = self.compute_metrics
+        if self.compute_metrics is not None:
+            self.compute_metrics = self.compute_window_metrics
+
+    # windows of long samples (window_stride, datasets with get_num_prefix_tokens, see windows.py)
+    def get_windowed_dataset(self, dataset):
+        additional_args = getattr(self.model, "additional_args", None)
+        if additional_args is None or additional_args.window_stride <= 0 or \
+                not hasattr(dataset, "get_num_prefix_tokens"):
+            return dataset
+        windowed = WindowedDataset(dataset, additional_args.max_seq_len, additional_args.window_stride)
+        logger.info("split {0} samples into {1} windows".format(len(dataset), len(windowed)))
+        return windowed
+
+    # windows of long training samples, packed rows of training samples (see packing.py) and/or batches under a token
+    # budget from length buckets (see TokenBudgetBatchSampler), when set up in the model's additional args. Otherwise
+    # the default random batches of train batch size
+    def get_train_dataloader(self) -> DataLoader:
+        additional_args = getattr(self.model, "additional_args", None)
+        if additional_args is None or (additional_args.train_token_budget <= 0 and not additional_args.pack_sequences
+                                       and additional_args.window_stride <= 0):
+            return super(NerTrainer, self).get_train_dataloader()
+        if self.args.local_rank != -1:
+            raise ValueError("train_token_budget, pack_sequences and window_stride are not supported in distributed "
+                             "training")
+        train_dataset = self.get_windowed_dataset(self.train_dataset)
+        data_collator = self.data_collator
+        if additional_args.pack_sequences:
+            check_packing(additional_args)
+            num_samples = len(train_dataset)
+            train_dataset = PackedDataset(train_dataset, additional_args.max_seq_len)
+            data_collator = PackedDataCollator(data_collator)
+            logger.info("packed {0} training samples into {1} rows".format(num_samples, len(train_dataset)))
+        if additional_args.train_token_budget <= 0:
+            generator = torch.Generator()
+            generator.manual_seed(self.args.seed)
+            return DataLoader(train_dataset,
+                              batch_size=self.args.train_batch_size,
+                              sampler=RandomSampler(train_dataset, generator=generator),
+                              collate_fn=data_collator,
+                              drop_last=self.args.dataloader_drop_last,
+                              num_workers=self.args.dataloader_num_workers)
+        lengths = [len(train_dataset[i]["input_ids"]) for i in range(len(train_dataset))]
+        batch_sampler = TokenBudgetBatchSampler(lengths, additional_args.train_token_budget,
+                                                additional_args.train_bucket_size,
+                                                self.args.gradient_accumulation_steps, self.args.seed,
+                                                self.args.train_batch_size)
+        return DataLoader(train_dataset,
+                          batch_sampler=batch_sampler,
+                          collate_fn=data_collator,
+                          num_workers=self.args.dataloader_num_workers)
+
+    # evaluation over the windows of long samples with a window_stride
+    def get_eval_dataloader(self, eval_dataset=None) -> DataLoader:
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        windowed = self.get_windowed_dataset(eval_dataset)
+        self.eval_windows = windowed if windowed is not eval_dataset else None
+        return super(NerTrainer, self).get_eval_dataloader(windowed)
+
+    # metrics of the whole samples: window predictions are merged like at inference (see predict_windows), so that
+    # entities in window overlaps count once and entities cut at a window edge are not scored as partial
+    def compute_window_metrics(self, eval_prediction):
+        if self.eval_windows is not None:
+            eval_prediction = EvalPrediction(predictions=self.eval_windows.merge(eval_prediction.predictions),
+                                             label_ids=self.eval_windows.merge(eval_prediction.label_ids))
+        return self.sample_metrics(eval_prediction)
 
     # don't swap best and last models. Instead maintain ordering and make best model least likely to be removed
     def _sorted_checkpoints(
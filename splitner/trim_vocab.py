@@ -0,0 +1,125 @@
+import argparse
+import copy
+import io
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+from transformers import AutoConfig
+
+from splitner.dataset import NerDataset
+from splitner.inference import get_artifact_dir, load_executor, predict_dataset
+from splitner.utils.general import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def collect_token_ids(executor, tokenizer, corpus_paths):
+    # sub-word ids of all model inputs (incl. queries and special tokens) of the train/dev/test sets, plus the ids of
+    # all words of the additional reference corpora
+    token_ids = set(tokenizer.all_special_ids)
+    for dataset in [executor.train_dataset, executor.dev_dataset, executor.test_dataset]:
+        for i in range(len(dataset)):
+            token_ids.update(dataset[i]["input_ids"])
+    for corpus_path in corpus_paths:
+        for sentence in NerDataset.read_dataset(corpus_path, executor.additional_args):
+            for tok in sentence.tokens:
+                token_ids.update(tokenizer(tok.text, add_special_tokens=False)["input_ids"])
+    return token_ids
+
+
+def get_char_token_ids(tokenizer):
+    # safety margin: single characters (and their "##" continuations) keep uncovered words splittable instead of [UNK]
+    return set(index for token, index in tokenizer.get_vocab().items()
+               if len(token) == 1 or (token.startswith("##") and len(token) == 3))
+
+
+def trim_embeddings(model, kept_ids):
+    old_embeddings = model.get_input_embeddings()
+    pad_token_id = model.config.pad_token_id
+    new_pad_token_id = kept_ids.index(pad_token_id) if pad_token_id in kept_ids else None
+    new_embeddings = nn.Embedding(len(kept_ids), old_embeddings.embedding_dim, padding_idx=new_pad_token_id)
+    new_embeddings.weight.data = old_embeddings.weight.data[kept_ids].clone()
+    model.set_input_embeddings(new_embeddings)
+    model.config.vocab_size = len(kept_ids)
+    model.config.pad_token_id = new_pad_token_id
+    return model
+
+
+def save_trimmed_tokenizer(tokenizer, kept_ids, output_dir):
+    # WordPiece keeps greedy longest-match, so words whose pieces are all kept are split exactly as before
+    tokenizer.save_pretrained(output_dir)
+    tokens = tokenizer.convert_ids_to_tokens(kept_ids)
+    with open(os.path.join(output_dir, "vocab.txt"), "w", encoding="utf-8") as f:
+        for token in tokens:
+            f.write(token + "\n")
+    # the fast tokenizer is rebuilt from vocab.txt on load
+    tokenizer_file = os.path.join(output_dir, "tokenizer.json")
+    if os.path.exists(tokenizer_file):
+        os.remove(tokenizer_file)
+
+
+def get_model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+def time_load(model_class, model_path, additional_args):
+    start = time.time()
+    config = AutoConfig.from_pretrained(model_path)
+    model_class.from_pretrained(model_path, config=config, additional_args=additional_args)
+    return time.time() - start
+
+
+def main(args):
+    setup_logging()
+    executor = load_executor(args.config, args.executor, inference_only=False)
+    executor.additional_args.inference_backend = "torch"
+    tokenizer = executor.trainer.tokenizer
+    if tokenizer.vocab_files_names.get("vocab_file") != "vocab.txt":
+        raise NotImplementedError("vocabulary trimming supports WordPiece (vocab.txt) tokenizers only")
+
+    model = executor.model
+    vocab_size = model.config.vocab_size
+    orig_size = get_model_size(model)
+    token_ids = collect_token_ids(executor, tokenizer, args.corpus.split(",") if args.corpus else [])
+    logger.info("sub-word ids in reference corpus: {0}".format(len(token_ids)))
+    if not args.no_char_margin:
+        token_ids |= get_char_token_ids(tokenizer)
+    kept_ids = sorted(token_ids)
+
+    output_dir = os.path.join(get_artifact_dir(executor.additional_args), "trimmed")
+    os.makedirs(output_dir, exist_ok=True)
+    trim_embeddings(copy.deepcopy(model), kept_ids).save_pretrained(output_dir)
+    save_trimmed_tokenizer(tokenizer, kept_ids, output_dir)
+    logger.info("trimmed model and tokenizer saved in: {0}".format(output_dir))
+
+    # the trimmed model has to produce the same outputs on the (covered) test set
+    model_path = executor.additional_args.resume or executor.additional_args.base_model
+    trimmed = load_executor(args.config, args.executor, inference_only=False, base_model=output_dir, resume=None)
+    mismatches = sum(int(orig != new) for orig, new in zip(predict_dataset(executor, executor.test_dataset),
+                                                            predict_dataset(trimmed, trimmed.test_dataset)))
+
+    model_class = type(trimmed.model)
+    logger.info("vocab size: {0} -> {1} | model size: {2:.1f}MB -> {3:.1f}MB"
+                .format(vocab_size, len(kept_ids), orig_size, get_model_size(trimmed.model)))
+    logger.info("load time: {0:.2f}s -> {1:.2f}s"
+                .format(time_load(model_class, model_path, executor.additional_args),
+                        time_load(model_class, output_dir, trimmed.additional_args)))
+    logger.info("test sentences with different predictions: {0}/{1}"
+                .format(mismatches, len(executor.test_dataset.sentences)))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Vocabulary Trimming")
+    ap.add_argument("--config", type=str, required=True, help="config json file of the trained model")
+    ap.add_argument("--executor", type=str, default="qa", help="executor of the model (seqtag|qa|span)")
+    ap.add_argument("--corpus", type=str, default=None,
+                    help="comma separated reference corpora (dataset format) in addition to train/dev/test")
+    ap.add_argument("--no_char_margin", dest="no_char_margin", action="store_true",
+                    help="set this flag to not keep all single character sub-words as safety margin")
+    ap = ap.parse_args()
+    main(ap)
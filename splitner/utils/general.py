@@ -80,12 +80,15 @@ class PairSpan:
 
 
 class Context:
-    def __init__(self, sentence=None, entity=None, entity_text=None, bert_tokens=None, mention_span: PairSpan = None):
+    def __init__(self, sentence=None, entity=None, entity_text=None, bert_tokens=None, mention_span: PairSpan = None,
+                 num_prefix_tokens=1):
         self.sentence = sentence
         self.entity = entity
         self.entity_text = entity_text
         self.bert_tokens = bert_tokens
         self.mention_span = mention_span
+        # sub-tokens before the sentence part
+        self.num_prefix_tokens = num_prefix_tokens
 
 
 def set_all_seeds(seed=42):
@@ -108,6 +111,21 @@ def setup_logging():
         level=logging.INFO)
 
 
+def read_memory_stats(pid="self"):
+    # resident and proportional set size in MB (PSS splits shared pages between the processes mapping them), private
+    # memory (pages mapped by this process only) and the peak RSS. ru_maxrss is not used as it is kept across exec,
+    # i.e. it includes the parent's memory before spawning
+    stats = dict()
+    smaps_keys = {"Rss": "rss", "Pss": "pss", "Private_Clean": "private", "Private_Dirty": "private"}
+    for file_name, keys in [("smaps_rollup", smaps_keys), ("status", {"VmHWM": "peak_rss"})]:
+        with open("/proc/{0}/{1}".format(pid, file_name)) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in keys:
+                    stats[keys[key]] = stats.get(keys[key], 0) + int(value.split()[0]) / 1024
+    return stats
+
+
 def set_wandb(wandb_dir):
     import wandb
     os.environ["WANDB_WATCH"] = "all"
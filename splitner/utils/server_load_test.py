@@ -0,0 +1,67 @@
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def read_sentences(file_path):
+    sentences = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        tokens = []
+        for line in f:
+            line = line.strip()
+            if line:
+                tokens.append(line.split("\t")[0])
+            elif tokens:
+                sentences.append(tokens)
+                tokens = []
+    if tokens:
+        sentences.append(tokens)
+    return sentences
+
+
+def post(url, sentences):
+    data = json.dumps({"sentences": sentences}).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    start = time.time()
+    with urllib.request.urlopen(request) as response:
+        json.loads(response.read().decode("utf-8"))
+    return time.time() - start
+
+
+def main(args):
+    sentences = read_sentences(args.input)
+    requests = [sentences[(i * args.sentences_per_request + k) % len(sentences)]
+                for i in range(args.num_requests) for k in range(args.sentences_per_request)]
+    requests = [requests[i:i + args.sentences_per_request] for i in range(0, len(requests), args.sentences_per_request)]
+    url = "http://{0}:{1}/predict".format(args.host, args.port)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = list(pool.map(lambda r: post(url, r), requests))
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies) * 1000.0
+    print("requests: {0} | concurrency: {1} | elapsed: {2:.2f}s".format(len(requests), args.concurrency, elapsed))
+    print("throughput: {0:.2f} requests/s | {1:.2f} sentences/s"
+          .format(len(requests) / elapsed, len(requests) * args.sentences_per_request / elapsed))
+    print("latency (ms): p50: {0:.1f} | p90: {1:.1f} | p99: {2:.1f} | max: {3:.1f}"
+          .format(np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99),
+                  latencies.max()))
+    with urllib.request.urlopen("http://{0}:{1}/stats".format(args.host, args.port)) as response:
+        print("server stats: {0}".format(response.read().decode("utf-8")))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Server Load Test")
+    ap.add_argument("--input", type=str, default="../../data/dummy/test.tsv", help="sentences to send (dataset TSV)")
+    ap.add_argument("--host", type=str, default="127.0.0.1", help="server host")
+    ap.add_argument("--port", type=int, default=8000, help="server port")
+    ap.add_argument("--num_requests", type=int, default=200, help="total requests to send")
+    ap.add_argument("--sentences_per_request", type=int, default=1, help="sentences per request")
+    ap.add_argument("--concurrency", type=int, default=8, help="concurrent client threads")
+    ap = ap.parse_args()
+    main(ap)
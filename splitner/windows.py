@@ -0,0 +1,115 @@
+import numpy as np
+from torch.utils.data import Dataset
+
+# sliding windows over the sentence part of long contexts (window_stride). A context is laid out as prefix ([CLS], and
+# the query with its [SEP]s for QA contexts), sentence part and the final [SEP]. Each window repeats the prefix and the
+# final [SEP] around a slice of the sentence part, so that it has up to max_len sub-tokens
+
+
+def get_window_starts(body_len, window_len, stride):
+    # offsets into the sentence part of windows of window_len sub-tokens, every stride sub-tokens. The last window ends
+    # with the sentence part, a sentence part which fits is a single window
+    if body_len <= window_len:
+        return [0]
+    starts = list(range(0, body_len - window_len, min(stride, window_len)))
+    starts.append(body_len - window_len)
+    return starts
+
+
+def get_window_len(num_prefix_tokens, max_len):
+    window_len = max_len - num_prefix_tokens - 1
+    if window_len <= 0:
+        raise ValueError("max seq len {0} leaves no room for the sentence after {1} prefix sub-tokens"
+                         .format(max_len, num_prefix_tokens))
+    return window_len
+
+
+def split_feature(feature, num_prefix_tokens, max_len, stride):
+    # window starts and window features of a (dataset) feature with per sub-token lists
+    num_tokens = len(feature["input_ids"])
+    window_len = get_window_len(num_prefix_tokens, max_len)
+    starts = get_window_starts(num_tokens - num_prefix_tokens - 1, window_len, stride)
+    windows = [dict() for _ in starts]
+    for key, value in feature.items():
+        if not isinstance(value, list) or len(value) not in [0, num_tokens]:
+            raise ValueError("sliding windows need per sub-token features, got: {0}".format(key))
+        for window, start in zip(windows, starts):
+            body_start = num_prefix_tokens + start
+            window[key] = value[:num_prefix_tokens] + value[body_start:body_start + window_len] + value[num_tokens - 1:]
+    return starts, windows
+
+
+def merge_windows(window_predictions, starts, num_prefix_tokens, num_tokens, max_len):
+    # predictions of the whole context from the (padded) predictions of its windows. A sub-token of the sentence part
+    # is taken from the window whose centre is nearest (where it has the most context on both sides), the prefix from
+    # the first window and the final [SEP] from the last
+    if len(starts) == 1:
+        return window_predictions[0][:num_tokens]
+    window_len = get_window_len(num_prefix_tokens, max_len)
+    stacked = np.stack([prediction[:num_prefix_tokens + window_len + 1] for prediction in window_predictions])
+    positions = np.arange(num_tokens - num_prefix_tokens - 1)
+    starts = np.array(starts)
+    nearest = np.abs(positions[:, None] - (starts[None, :] + (window_len - 1) / 2)).argmin(axis=1)
+    return np.concatenate([stacked[0, :num_prefix_tokens],
+                           stacked[nearest, num_prefix_tokens + positions - starts[nearest]],
+                           stacked[-1, -1:]])
+
+
+def predict_windows(dataset, max_len, stride, predict_fn):
+    # token level predictions of the contexts of a dataset (with get_num_prefix_tokens), longer ones predicted in
+    # windows: predict_fn gets the window features of all contexts at once and returns their predictions
+    features = []
+    layouts = []
+    for index in range(len(dataset)):
+        feature = dataset[index]
+        num_prefix_tokens = dataset.get_num_prefix_tokens(index)
+        starts, windows = split_feature(feature, num_prefix_tokens, max_len, stride)
+        layouts.append((len(features), starts, num_prefix_tokens, len(feature["input_ids"])))
+        features.extend(windows)
+    window_predictions = predict_fn(features) if len(features) > 0 else []
+    return [merge_windows(window_predictions[offset:offset + len(starts)], starts, num_prefix_tokens, num_tokens,
+                          max_len)
+            for offset, starts, num_prefix_tokens, num_tokens in layouts]
+
+
+class WindowedDataset(Dataset):
+    # windows of the samples of a dataset (with get_num_prefix_tokens), for training and evaluation. Every sub-token
+    # of a long sentence is labelled in (at least) one window
+    def __init__(self, dataset, max_len, stride):
+        self.dataset = dataset
+        self.max_len = max_len
+        self.stride = stride
+        self.windows = []
+        # window starts, prefix sub-tokens and sub-tokens of each sample
+        self.layouts = []
+        for index in range(len(dataset)):
+            num_prefix_tokens = dataset.get_num_prefix_tokens(index)
+            num_tokens = len(dataset[index]["input_ids"])
+            starts = get_window_starts(num_tokens - num_prefix_tokens - 1, get_window_len(num_prefix_tokens, max_len),
+                                       stride)
+            self.windows.extend((index, k) for k in range(len(starts)))
+            self.layouts.append((starts, num_prefix_tokens, num_tokens))
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, index):
+        sample_index, k = self.windows[index]
+        _, windows = split_feature(self.dataset[sample_index], self.dataset.get_num_prefix_tokens(sample_index),
+                                   self.max_len, self.stride)
+        return windows[k]
+
+    def merge(self, window_predictions, pad_value=-100):
+        # per sample predictions (or labels) from those of the windows in order, padded to the longest sample (as the
+        # trainer pads across batches)
+        merged = []
+        offset = 0
+        for starts, num_prefix_tokens, num_tokens in self.layouts:
+            merged.append(merge_windows(window_predictions[offset:offset + len(starts)], starts, num_prefix_tokens,
+                                        num_tokens, self.max_len))
+            offset += len(starts)
+        padded = np.full((len(merged), max(len(row) for row in merged)) + window_predictions.shape[2:], pad_value,
+                         dtype=window_predictions.dtype)
+        for index, row in enumerate(merged):
+            padded[index, :len(row)] = row
+        return padded
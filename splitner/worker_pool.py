@@ -0,0 +1,171 @@
+import argparse
+import logging
+import multiprocessing
+import queue
+import time
+
+from splitner.cpu_plan import apply_plan, plan_threads
+from splitner.dataset import NerDataset
+from splitner.inference import batched, write_predictions
+from splitner.pipeline import SplitNerPipeline
+from splitner.registry import get_weights_size
+from splitner.utils.general import read_memory_stats, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def share_weights(pipeline):
+    # moves the parameters and buffers of both models into shared memory, so that all forked workers map the same
+    # physical pages. With copy-on-write alone, any write to a page holding weights (eg. by the allocator) copies it.
+    # Memory-mapped weights (mmap/bundle backends) are already shared through the page cache
+    for executor in [pipeline.detector, pipeline.classifier]:
+        if executor is not None and executor.additional_args.inference_backend not in ["mmap", "bundle"]:
+            executor.model.share_memory()
+
+
+def worker_loop(pipeline_fn, pipeline, plan, tasks, results):
+    apply_plan(plan)
+    if pipeline is None:
+        pipeline = pipeline_fn()
+    for index, sentences in iter(tasks.get, None):
+        try:
+            results.put((index, list(pipeline.predict_iter(sentences, len(sentences))), None))
+        except Exception as e:
+            logger.exception("worker prediction failed")
+            results.put((index, None, repr(e)))
+
+
+class WorkerPool:
+    # forked inference workers for CPU inference. shared: the pipeline is loaded once in this process, its weights are
+    # placed in shared memory and inherited by the workers. Else every worker loads its own copy (for comparison).
+    # The parent never runs inference itself: forking after OpenMP parallel regions ran is not safe.
+    # threads_per_worker: intra-op threads of each worker (0: auto, see cpu_plan.py). affinity: pin the workers to
+    # separate cores
+    def __init__(self, pipeline_fn, num_workers, threads_per_worker=1, shared=True, affinity=False):
+        context = multiprocessing.get_context("fork")
+        self.pipeline = None
+        if shared:
+            self.pipeline = pipeline_fn()
+            share_weights(self.pipeline)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        # batches in flight, bounds the memory held by pending inputs and results
+        self.max_pending = 2 * num_workers
+        self.workers = [context.Process(target=worker_loop,
+                                        args=(pipeline_fn, self.pipeline,
+                                              plan_threads(num_workers, index, threads_per_worker, affinity=affinity),
+                                              self.tasks, self.results),
+                                        daemon=True) for index in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def check_workers(self):
+        # a worker killed by the OS (eg. out of memory) never returns its batch
+        for worker in self.workers:
+            if not worker.is_alive():
+                raise RuntimeError("inference worker {0} exited with code {1}".format(worker.pid, worker.exitcode))
+
+    def collect(self, received, index):
+        while index not in received:
+            try:
+                result_index, tags, error = self.results.get(timeout=1.0)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            received[result_index] = (tags, error)
+        return received.pop(index)
+
+    # yields the final BIO tags for each sentence, in input order
+    def predict_iter(self, sentences, batch_size=16):
+        received = dict()
+        submitted = 0
+        next_index = 0
+        try:
+            for batch in batched(sentences, batch_size):
+                self.tasks.put((submitted, batch))
+                submitted += 1
+                while submitted - next_index >= self.max_pending:
+                    tags, error = self.collect(received, next_index)
+                    next_index += 1
+                    if error is not None:
+                        raise RuntimeError("worker prediction failed: {0}".format(error))
+                    yield from tags
+            while next_index < submitted:
+                tags, error = self.collect(received, next_index)
+                next_index += 1
+                if error is not None:
+                    raise RuntimeError("worker prediction failed: {0}".format(error))
+                yield from tags
+        finally:
+            # results of batches still in flight (on error or when the caller stops early) are not left in the queue
+            if all(worker.is_alive() for worker in self.workers):
+                for index in range(next_index, submitted):
+                    self.collect(received, index)
+
+    def get_memory_stats(self):
+        parent = read_memory_stats()
+        workers = [read_memory_stats(worker.pid) for worker in self.workers]
+        return {"parent": parent,
+                "workers": workers,
+                "total_pss": parent["pss"] + sum(stats["pss"] for stats in workers)}
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def main(args):
+    setup_logging()
+    pipeline_fn = lambda: SplitNerPipeline.from_args(args)
+    sentences = None
+    predictions = dict()
+    for mode in ["shared", "copy"] if args.benchmark else ["shared"]:
+        pool = WorkerPool(pipeline_fn, args.workers, args.threads_per_worker, shared=mode == "shared",
+                          affinity=args.affinity)
+        if sentences is None:
+            sentences = NerDataset.read_dataset(args.input, pool.pipeline.detector.additional_args)
+            logger.info("model weights: {0:.1f}MB".format(get_weights_size(pool.pipeline)))
+        start = time.time()
+        predictions[mode] = list(pool.predict_iter(sentences, args.batch_size))
+        elapsed = time.time() - start
+        # measured while the workers still hold their models
+        stats = pool.get_memory_stats()
+        pool.close()
+        # the next pool forks from this process, which should not hold this pool's pipeline anymore
+        del pool
+        mean = lambda key: sum(worker[key] for worker in stats["workers"]) / len(stats["workers"])
+        logger.info("{0} | workers: {1} x {2} threads | time: {3:.2f}s ({4:.1f} sentences/s) | worker RSS: {5:.0f}MB | "
+                    "worker private: {6:.0f}MB | parent RSS: {7:.0f}MB | total PSS: {8:.0f}MB"
+                    .format(mode, args.workers, args.threads_per_worker, elapsed, len(sentences) / elapsed,
+                            mean("rss"), mean("private"), stats["parent"]["rss"], stats["total_pss"]))
+    if args.benchmark:
+        mismatches = sum(int(a != b) for a, b in zip(predictions["shared"], predictions["copy"]))
+        logger.info("sentences with different predictions: {0}/{1}".format(mismatches, len(sentences)))
+    if args.output:
+        write_predictions(args.output, sentences, predictions["shared"])
+        logger.info("Outputs published in file: {0}".format(args.output))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SplitNER Inference Worker Pool")
+    ap.add_argument("--detector_config", type=str, default=None, help="span detector config json file")
+    ap.add_argument("--classifier_config", type=str, default=None, help="span classifier config json file")
+    ap.add_argument("--bundle", type=str, default=None, help="deployment bundle (bundle.py), replaces the configs")
+    ap.add_argument("--detector_type", type=str, default="qa", help="span detector executor (qa|seqtag|dual)")
+    ap.add_argument("--inference_backend", type=str, default=None,
+                    help="inference backend for both models (torch|int8|mmap), overrides the configs")
+    ap.add_argument("--input", type=str, required=True, help="input file in dataset (TSV) format")
+    ap.add_argument("--output", type=str, default=None, help="output predictions file (token, gold, predicted)")
+    ap.add_argument("--workers", type=int, default=4, help="number of forked inference workers")
+    ap.add_argument("--threads_per_worker", type=int, default=1,
+                    help="intra-op (torch) threads of each worker (0: auto, the cores split between the workers)")
+    ap.add_argument("--affinity", dest="affinity", action="store_true", help="pin each worker to its own cores")
+    ap.add_argument("--batch_size", type=int, default=16, help="sentences per batch sent to a worker")
+    ap.add_argument("--benchmark", dest="benchmark", action="store_true",
+                    help="set this flag to compare time and memory with workers that load their own model copies")
+    ap = ap.parse_args()
+    main(ap)